@@ -0,0 +1,28 @@
+# ttroy1, 2023
+# Exponential backoff shared by the supervised loops in main.py
+
+# -----------------------------------------------------------------------------
+import random
+
+class Backoff(object):
+    # Arguments:
+    #   initial: First delay in seconds
+    #   maximum: Longest delay in seconds
+    #   factor: Multiplier applied after each failure
+    def __init__(self, initial=0.05, maximum=5.0, factor=2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.failures = 0
+
+    # next_delay: Note a failure and return how long to wait before retrying
+    # Returns:
+    #   Delay in seconds, with up to 10% jitter so restarts don't line up
+    def next_delay(self):
+        delay = min(self.maximum, self.initial * (self.factor ** self.failures))
+        self.failures += 1
+        return delay * (1 + random.random() * 0.1)
+
+    # reset: Call after a success so the next failure starts from the beginning
+    def reset(self):
+        self.failures = 0
@@ -0,0 +1,212 @@
+# ttroy1, 2023
+# Refresh-rate calibration: finds the fewest PWM bits that still show every
+# Meleetrix colour distinctly, measures the refresh rate rgbmatrix achieves
+# across PWM bits, LSB timing and GPIO slowdown, and saves the fastest
+# flicker-free settings to the matrix section of config.json
+#
+# Usage (same matrix arguments as main.py):
+#   sudo python3 calibrate.py --led-rows=64 --led-cols=64 --led-gpio-mapping='adafruit-hat'
+
+# -----------------------------------------------------------------------------
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+from samplebase import SampleBase
+
+# rgbmatrix's PWM depth; fewer bits drop the least significant bit planes
+MAX_PWM_BITS = 11
+# Result line printed by a trial process
+RESULT_PREFIX = "RESULT "
+
+# -----------------------------------------------------------------------------
+# palette_colors: Every colour Meleetrix draws with, after its gamma/brightness
+# correction, black excluded
+# Arguments:
+#   config: Loaded config.json
+def palette_colors(config):
+    from palette import Palette, COSTUME_BGS, DEFAULT_FG
+    from minimap import PORT_COLORS, STAGE_COLOR, PLATFORM_COLOR
+    palette = Palette(config['colors'])
+
+    colors = set(COSTUME_BGS.values())
+    for fg, bg in palette.table.values():
+        colors.update((fg, bg))
+    # Text, history line, borders and minimap
+    colors.update([DEFAULT_FG, (255, 255, 255), (150, 150, 150), tuple(config['colors']['borders_rgb']),
+                   STAGE_COLOR, PLATFORM_COLOR])
+    colors.update(PORT_COLORS)
+
+    corrected = set()
+    for color in colors:
+        corrected.add(tuple(int(palette.lut[256 * channel + value]) for channel, value in enumerate(color)))
+    corrected.discard((0, 0, 0))
+    return sorted(corrected)
+
+# pwm_level: The level rgbmatrix gives an 8-bit channel value (its CIE1931
+# luminance mapping to MAX_PWM_BITS bits), kept to the top bits of it
+# Arguments:
+#   value: 0-255
+#   bits: PWM bits in use
+#   brightness: --led-brightness (1-100)
+def pwm_level(value, bits, brightness):
+    lightness = value * brightness / 255.0
+    luminance = lightness / 902.3 if lightness <= 8 else ((lightness + 16) / 116.0) ** 3
+    return int(round(((1 << MAX_PWM_BITS) - 1) * luminance)) >> (MAX_PWM_BITS - bits)
+
+# palette_loss: What a PWM depth does to the palette
+# Returns:
+#   (colours with a channel that goes dark, colours that become the same as
+#    another colour which is distinct at full depth)
+def palette_loss(colors, bits, brightness):
+    dark = []
+    shown = {}
+    for color in colors:
+        levels = tuple(pwm_level(value, bits, brightness) for value in color)
+        if any(value and not level for value, level in zip(color, levels)):
+            dark.append(color)
+        shown.setdefault(levels, set()).add(tuple(pwm_level(value, MAX_PWM_BITS, brightness) for value in color))
+    merged = sum(len(full) - 1 for full in shown.values())
+    return dark, merged
+
+# fewest_bits: Fewest PWM bits that keep every palette colour lit and distinct
+def fewest_bits(colors, brightness):
+    for bits in range(1, MAX_PWM_BITS + 1):
+        dark, merged = palette_loss(colors, bits, brightness)
+        if not dark and not merged:
+            return bits
+    return MAX_PWM_BITS
+
+# -----------------------------------------------------------------------------
+class Trial(SampleBase):
+    # One measurement: run the matrix with the given arguments, showing the
+    # palette, and report the refresh rate it reaches
+    def __init__(self, *args, **kwargs):
+        super(Trial, self).__init__(*args, **kwargs)
+        add_calibration_args(self.parser)
+        self.monitor = None
+
+    def before_matrix(self, options):
+        from scheduling import RefreshMonitor
+        options.show_refresh_rate = 1
+        self.monitor = RefreshMonitor(self.args.seconds)
+        self.monitor.start()
+
+    def run(self):
+        from PIL import Image, ImageDraw
+        config = json.load(open('config.json'))
+        colors = palette_colors(config)
+
+        # A stripe per colour, so the panel is lit the way it is in game
+        image = Image.new("RGB", (self.matrix.width, self.matrix.height))
+        draw = ImageDraw.Draw(image)
+        stripe = max(1, self.matrix.width // max(1, len(colors)))
+        for index, color in enumerate(colors):
+            draw.rectangle((index * stripe, 0, (index + 1) * stripe - 1, self.matrix.height - 1), fill=color)
+        canvas = self.matrix.CreateFrameCanvas()
+        canvas.SetImage(image, 0, 0)
+        self.matrix.SwapOnVSync(canvas)
+
+        # Let the refresh settle, then measure a full window
+        time.sleep(self.args.warmup + self.args.seconds)
+        stats = self.monitor.stats()
+        result = None if stats is None else {'mean': stats[0], 'min': stats[1], 'max': stats[2]}
+        print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+# -----------------------------------------------------------------------------
+# add_calibration_args: Options of the sweep itself, shared with the trials
+def add_calibration_args(parser):
+    parser.add_argument("--min-hz", type=float, default=120.0, help="Lowest refresh rate (at any point in a trial) counted as flicker-free. Default: 120")
+    parser.add_argument("--lsb", default="50,100,130", help="LSB nanoseconds to try, comma separated. Default: 50,100,130")
+    parser.add_argument("--slowdowns", default="1,2,3,4", help="GPIO slowdowns to try, comma separated. Default: 1,2,3,4")
+    parser.add_argument("--seconds", type=float, default=3.0, help="Measuring time per trial. Default: 3")
+    parser.add_argument("--warmup", type=float, default=1.0, help="Time per trial before measuring starts. Default: 1")
+    parser.add_argument("--dry-run", action="store_true", help="Report only; leave config.json alone")
+    parser.add_argument("--trial", action="store_true", help="Internal: run one measurement")
+
+# run_trial: Measure one combination in a fresh process (rgbmatrix can only
+# be set up once per process, and drops root afterwards)
+# Returns:
+#   Dict of mean/min/max Hz, or None if the trial failed
+def run_trial(bits, lsb, slowdown):
+    command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + [
+        "--trial", "--led-pwm-bits=%d" % bits, "--led-pwm-lsb-nanoseconds=%d" % lsb, "--led-slowdown-gpio=%d" % slowdown]
+    try:
+        output = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True, timeout=60).stdout
+    except subprocess.TimeoutExpired:
+        return None
+    for line in output.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    return None
+
+# save_matrix_config: Write the matrix section of config.json, leaving the
+# rest of the file as it is
+def save_matrix_config(settings, path="config.json"):
+    with open(path) as f:
+        text = f.read()
+    section = '"matrix": ' + json.dumps(settings, indent=4).replace("\n", "\n    ")
+    text, replaced = re.subn(r'"matrix":\s*\{[^{}]*\}', lambda match: section, text)
+    if not replaced:
+        config = json.loads(text)
+        config['matrix'] = settings
+        text = json.dumps(config, indent=4) + "\n"
+    with open(path, "w") as f:
+        f.write(text)
+
+# -----------------------------------------------------------------------------
+def main():
+    # main.py's config and assets are relative to the repo
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    if "--trial" in sys.argv:
+        trial = Trial()
+        if not trial.process():
+            trial.print_help()
+        return 0
+
+    base = SampleBase()
+    add_calibration_args(base.parser)
+    args = base.parser.parse_args()
+    config = json.load(open('config.json'))
+
+    colors = palette_colors(config)
+    bits = fewest_bits(colors, args.led_brightness)
+    print("Palette: %d colours, all distinct from %d PWM bits up (brightness %d)"
+          % (len(colors), bits, args.led_brightness))
+    for fewer in range(max(1, bits - 2), bits):
+        dark, merged = palette_loss(colors, fewer, args.led_brightness)
+        print("  %2d bits: %d colour(s) lose a channel, %d merge" % (fewer, len(dark), merged))
+
+    trials = []
+    print("%5s %5s %9s %9s %9s %9s" % ("bits", "lsb", "slowdown", "mean Hz", "min Hz", "max Hz"))
+    for depth in sorted(set([bits, MAX_PWM_BITS])):
+        for lsb in [int(value) for value in args.lsb.split(",")]:
+            for slowdown in [int(value) for value in args.slowdowns.split(",")]:
+                result = run_trial(depth, lsb, slowdown)
+                if result is None:
+                    print("%5d %5d %9d   (no refresh reported)" % (depth, lsb, slowdown))
+                    continue
+                print("%5d %5d %9d %9.0f %9.0f %9.0f" % (depth, lsb, slowdown, result['mean'], result['min'], result['max']))
+                trials.append((result, depth, lsb, slowdown))
+
+    flicker_free = [trial for trial in trials if trial[0]['min'] >= args.min_hz]
+    if not flicker_free:
+        print("No combination stayed above %.0f Hz; config.json left as it is" % args.min_hz)
+        return 1
+
+    # Fastest; on a tie, the slower (more forgiving) GPIO timing
+    result, depth, lsb, slowdown = max(flicker_free, key=lambda trial: (round(trial[0]['mean']), trial[3]))
+    settings = {'pwm_bits': depth, 'pwm_lsb_nanoseconds': lsb, 'slowdown_gpio': slowdown}
+    print("Fastest flicker-free: %d bits, %d ns LSB, slowdown %d (%.0f Hz)" % (depth, lsb, slowdown, result['mean']))
+    print("Check the panel at this slowdown: too little shows up as garbled pixels, not as a lower refresh rate")
+    if not args.dry_run:
+        save_matrix_config(settings)
+        print("Saved to the matrix section of config.json")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+# ttroy1, 2023
+# Per-frame time budget for the in-game screen, stepping quality down under
+# sustained overruns and back up once there's headroom again
+
+# -----------------------------------------------------------------------------
+# Quality levels; each level keeps every step-down below it
+FULL = 0
+NO_ANIMATIONS = 1
+LOW_FPS = 2
+NO_BORDERS = 3
+CACHED_TEXT = 4
+LEVEL_NAMES = ["full", "animations off", "half frame rate", "borders off", "cached text"]
+
+# -----------------------------------------------------------------------------
+class DeadlineMonitor(object):
+    # Arguments:
+    #   budget: Seconds allowed for draw + SetImage + SwapOnVSync
+    #   window: Frames judged together before the level changes
+    #   step_down: Share of a window's frames over budget that lowers the level
+    #   headroom: A window whose slowest frame used at most this share of the
+    #             budget counts towards raising the level again
+    #   recover_windows: Healthy windows in a row needed to raise the level
+    #   max_level: Lowest quality it will go to
+    def __init__(self, budget, window=30, step_down=0.25, headroom=0.5, recover_windows=3, max_level=CACHED_TEXT):
+        self.budget = budget
+        self.window = window
+        self.step_down = step_down
+        self.headroom = headroom
+        self.recover_windows = recover_windows
+        self.max_level = max_level
+
+        self.level = FULL
+        # Every frame over budget, since startup
+        self.overruns = 0
+        self.frames = 0
+        self.window_overruns = 0
+        self.window_slowest = 0.0
+        self.healthy_windows = 0
+
+    # record: Note how long a frame took
+    # Arguments:
+    #   seconds: Time from the start of drawing to the end of the swap
+    # Returns:
+    #   True if the quality level changed
+    def record(self, seconds):
+        self.frames += 1
+        if seconds > self.budget:
+            self.overruns += 1
+            self.window_overruns += 1
+        self.window_slowest = max(self.window_slowest, seconds)
+        if self.frames % self.window:
+            return False
+
+        previous = self.level
+        if self.window_overruns > self.step_down * self.window:
+            self.level = min(self.level + 1, self.max_level)
+            self.healthy_windows = 0
+        elif self.window_overruns == 0 and self.window_slowest <= self.headroom * self.budget:
+            self.healthy_windows += 1
+            if self.healthy_windows >= self.recover_windows:
+                self.level = max(self.level - 1, FULL)
+                self.healthy_windows = 0
+        else:
+            self.healthy_windows = 0
+
+        if self.level != previous:
+            print("Quality: %s (%d of the last %d frames over the %.0f ms budget, slowest %.1f ms)"
+                  % (LEVEL_NAMES[self.level], self.window_overruns, self.window, self.budget * 1000, self.window_slowest * 1000))
+        self.window_overruns = 0
+        self.window_slowest = 0.0
+        return self.level != previous
+
+    # name: The current level, as shown in logs and metrics
+    def name(self):
+        return LEVEL_NAMES[self.level]
@@ -0,0 +1,247 @@
+# ttroy1, 2023
+# Export a recorded session as an animated GIF or raw video frames, off the Pi
+#
+# Usage:
+#   python export.py recordings/session-20230901-190000.jsonl -o set.gif --game 3
+#   python export.py recordings/session-20230901-190000.jsonl -o - --scale 8 |
+#       ffmpeg -f rawvideo -pix_fmt rgb24 -s 512x512 -r 20 -i - bracket.mp4
+
+# -----------------------------------------------------------------------------
+import argparse
+import bisect
+import multiprocessing
+import os
+import sys
+import time
+
+from replay import POSTGAME_SECONDS, message_type, read_session, compress_idle
+
+# Panel size, as drawn by main.py
+SIZE = 64
+# Frames rendered by one worker task
+CHUNK_FRAMES = 600
+
+# -----------------------------------------------------------------------------
+class SessionRenderer(object):
+    # Runs main.py's message handlers and drawing code against a recording,
+    # at whatever times are asked for rather than in real time
+    # Arguments:
+    #   messages: List of (seconds, message dict), sorted by time
+    def __init__(self, messages):
+        # Imported here: main.py loads its config and fonts on import
+        import main
+        self.game = main.Meleetrix()
+        # Nothing exported should reach the live history database, and there's
+        # no panel to diff against
+        self.game.config = dict(self.game.config, history={'active': False}, frame_diff={'active': False})
+        self.game.load_assets()
+        # Animations (e.g. scrolling names) run on session time
+        self.now = 0.0
+        self.game.clock = lambda: self.now
+
+        self.messages = messages
+        self.stamps = [stamp for stamp, message in messages]
+        # Where replay can start from: every gameStart/snapshot sets up a whole game
+        self.game_starts = [i for i, (stamp, message) in enumerate(messages)
+                            if message_type(message) in ("gameStart", "snapshot")]
+        self.next_message = 0
+        self.started_at = None
+        self.ended_at = None
+        self.postgame_drawn = False
+
+    # seek: Jump to a point in the session, replaying only the game in progress
+    # Arguments:
+    #   t: Session time, in the same seconds as the recording
+    def seek(self, t):
+        position = bisect.bisect_right(self.game_starts, bisect.bisect_right(self.stamps, t) - 1) - 1
+        self.next_message = self.game_starts[position] if position >= 0 else 0
+        self.game.game_active = False
+        self.game.postgame = False
+        self.game.player_count = 0
+        self.ended_at = None
+        self.advance(t)
+
+    # advance: Apply every message that had arrived by time t
+    def advance(self, t):
+        while self.next_message < len(self.messages) and self.stamps[self.next_message] <= t:
+            stamp, message = self.messages[self.next_message]
+            # Skipped, as the live websocket handler would
+            try:
+                self.game.apply_message(message)
+            except Exception as e:
+                print("Skipping bad message:", repr(e))
+            if message_type(message) == "gameEnd":
+                self.ended_at = stamp
+                self.postgame_drawn = False
+            elif message_type(message) in ("gameStart", "snapshot"):
+                self.started_at = stamp
+            self.next_message += 1
+
+    # render: Draw the screen the panel would have shown at time t
+    # Arguments:
+    #   t: Session time; must not go backwards between calls (use seek)
+    # Returns:
+    #   The frame as 64x64 RGB bytes (without the panel's gamma correction)
+    def render(self, t):
+        self.advance(t)
+        self.now = t
+        game = self.game
+
+        # Same order of checks as Meleetrix.run
+        if game.game_active:
+            game.draw_in_game()
+        elif game.postgame and t - self.ended_at < POSTGAME_SECONDS:
+            # The winner screen doesn't change, so draw it once
+            if not self.postgame_drawn:
+                game.draw_postgame()
+                self.postgame_drawn = True
+        else:
+            if game.postgame:
+                game.end_postgame()
+            if game.player_count != 0:
+                # Animations start with the game, even when seeking into it
+                self.now = self.started_at
+                game.state_start_game()
+                self.now = t
+                game.draw_in_game()
+            else:
+                # The live ellipsis steps every half second
+                game.draw_waiting(int(t * 2) % 4, "")
+        return game.image.tobytes()
+
+# -----------------------------------------------------------------------------
+# Per-worker renderer, set up by init_worker
+worker_renderer = None
+
+# init_worker: Pool initializer; builds one renderer per worker process
+def init_worker(messages):
+    global worker_renderer
+    # main.py prints as it goes, and stdout may be the video stream
+    sys.stdout = sys.stderr
+    worker_renderer = SessionRenderer(messages)
+
+# render_chunk: Render a run of consecutive output frames
+# Arguments:
+#   task: (first frame time, frame interval, frame count)
+# Returns:
+#   List of [frame bytes, repeat count]; identical frames are sent once
+def render_chunk(task):
+    start, interval, count = task
+    worker_renderer.seek(start)
+    runs = []
+    for i in range(count):
+        frame = worker_renderer.render(start + i * interval)
+        if runs and runs[-1][0] == frame:
+            runs[-1][1] += 1
+        else:
+            runs.append([frame, 1])
+    return runs
+
+# -----------------------------------------------------------------------------
+# game_span: Start and end time of one game in the session
+# Arguments:
+#   messages: List of (seconds, message dict)
+#   number: 1 for the first game, 2 for the second, ...
+def game_span(messages, number):
+    starts = [i for i, (stamp, message) in enumerate(messages) if message_type(message) == "gameStart"]
+    if number < 1 or number > len(starts):
+        raise SystemExit("Session has " + str(len(starts)) + " games; can't export game " + str(number))
+    first = starts[number - 1]
+    end = messages[-1][0] + 1
+    for stamp, message in messages[first + 1:]:
+        if message_type(message) == "gameEnd":
+            end = stamp + POSTGAME_SECONDS
+            break
+        if message_type(message) == "gameStart":
+            end = stamp
+            break
+    return messages[first][0], end
+
+# scale_frame: Nearest-neighbour upscale of one 64x64 frame
+def scale_frame(frame, scale):
+    from PIL import Image
+    image = Image.frombytes("RGB", (SIZE, SIZE), frame)
+    if scale != 1:
+        image = image.resize((SIZE * scale, SIZE * scale), Image.NEAREST)
+    return image
+
+# write_gif: Save frame runs as an animated GIF
+def write_gif(runs, path, scale, interval):
+    images = []
+    durations = []
+    for frame, count in runs:
+        images.append(scale_frame(frame, scale))
+        durations.append(int(round(count * interval * 1000)))
+    images[0].save(path, save_all=True, append_images=images[1:], duration=durations, loop=0)
+
+# -----------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Export a recorded Meleetrix session as a GIF or raw RGB24 video frames.")
+    parser.add_argument("session", help="Session file recorded by main.py (see recording:active in config.json)")
+    parser.add_argument("-o", "--output", required=True, help="Output file; .gif for a GIF, anything else (or - for stdout) for raw frames")
+    parser.add_argument("--format", choices=["gif", "raw"], help="Override the format picked from the output name")
+    parser.add_argument("--fps", type=int, default=20, help="Output frame rate. Default: 20")
+    parser.add_argument("--scale", type=int, default=8, help="Nearest-neighbour upscale factor. Default: 8 (512x512)")
+    parser.add_argument("--game", type=int, help="Export only this game (1 = first game in the session)")
+    parser.add_argument("--max-idle", type=float, default=5.0, help="Longest waiting screen kept between games, in seconds. Default: 5")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Worker processes. Default: one per CPU")
+    args = parser.parse_args()
+
+    output_format = args.format or ("gif" if args.output.lower().endswith(".gif") else "raw")
+    session_path = os.path.abspath(args.session)
+    output_path = args.output if args.output == "-" else os.path.abspath(args.output)
+    # main.py loads config.json and its assets relative to the repo
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    messages = compress_idle(read_session(session_path), args.max_idle)
+    if len(messages) == 0:
+        raise SystemExit("No messages in " + session_path)
+    if args.game is not None:
+        start, end = game_span(messages, args.game)
+    else:
+        # A second of the waiting screen either side
+        start = messages[0][0] - 1
+        end = messages[-1][0] + 1
+        if message_type(messages[-1][1]) == "gameEnd":
+            end += POSTGAME_SECONDS
+
+    interval = 1.0 / args.fps
+    total = int((end - start) * args.fps)
+    tasks = [(start + first * interval, interval, min(CHUNK_FRAMES, total - first))
+             for first in range(0, total, CHUNK_FRAMES)]
+
+    began = time.perf_counter()
+    pool = multiprocessing.Pool(args.jobs, initializer=init_worker, initargs=(messages,))
+    try:
+        results = pool.imap(render_chunk, tasks)
+        if output_format == "gif":
+            runs = []
+            for chunk in results:
+                for frame, count in chunk:
+                    if runs and runs[-1][0] == frame:
+                        runs[-1][1] += count
+                    else:
+                        runs.append([frame, count])
+            write_gif(runs, output_path, args.scale, interval)
+        else:
+            out = sys.stdout.buffer if output_path == "-" else open(output_path, "wb")
+            try:
+                # Runs of identical frames are scaled once and written repeatedly
+                for chunk in results:
+                    for frame, count in chunk:
+                        scaled = scale_frame(frame, args.scale).tobytes()
+                        for repeat in range(count):
+                            out.write(scaled)
+            finally:
+                if out is not sys.stdout.buffer:
+                    out.close()
+    finally:
+        pool.close()
+        pool.join()
+
+    elapsed = time.perf_counter() - began
+    print("Exported %d frames (%.0f s at %d fps, %dx%d) in %.1f s" % (total, total * interval, args.fps,
+          SIZE * args.scale, SIZE * args.scale, elapsed), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
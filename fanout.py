@@ -0,0 +1,248 @@
+# ttroy1, 2023
+# LAN fan-out: one ingest node republishes every message it applies to other
+# Meleetrix nodes (stream desk, crowd wall, commentator monitor), as a single
+# stream of sequence-numbered frames; a node that joins late, or falls behind,
+# gets a snapshot of the game in progress first
+
+# -----------------------------------------------------------------------------
+import asyncio
+import json
+import struct
+import threading
+from collections import deque
+
+import websockets
+
+from backoff import Backoff
+
+# Frame header: kind (uint8), sequence number (uint32), little-endian
+HEADER = struct.Struct("<BI")
+# Frame kinds: a JSON message as index.js sends it, a binary position or input
+# frame passed through unchanged, or a snapshot of the game in progress
+JSON_MESSAGE = 1
+POSITIONS = 2
+SNAPSHOT = 3
+SEQ_MASK = 0xFFFFFFFF
+# Frame number of a binary position or input frame, after its type byte
+POSITIONS_FRAME = struct.Struct("<i")
+
+# -----------------------------------------------------------------------------
+# encode_frame: One fan-out frame
+# Arguments:
+#   kind: JSON_MESSAGE, POSITIONS or SNAPSHOT
+#   seq: Sequence number of the (last) message it carries
+#   message: Decoded message (dict), or bytes for a position or input frame
+def encode_frame(kind, seq, message):
+    if kind != POSITIONS:
+        message = json.dumps(message, separators=(",", ":")).encode()
+    return HEADER.pack(kind, seq) + message
+
+# decode_frame: Inverse of encode_frame
+# Returns:
+#   (kind, seq, message)
+def decode_frame(data):
+    kind, seq = HEADER.unpack_from(data)
+    payload = data[HEADER.size:]
+    if kind == POSITIONS:
+        return kind, seq, bytes(payload)
+    return kind, seq, json.loads(payload.decode())
+
+# -----------------------------------------------------------------------------
+class Subscriber(object):
+    # One connected node's queue of encoded frames
+    def __init__(self):
+        self.queue = deque()
+        self.wake = asyncio.Event()
+        # Set when the node needs a snapshot before anything else: on joining,
+        # and whenever a state message was dropped from its queue
+        self.resync = True
+        self.wake.set()
+
+class FanoutPublisher(object):
+    # Arguments:
+    #   host, port: Address the subscribing nodes connect to
+    #   queue_size: Frames held per node before the oldest are dropped
+    def __init__(self, host, port, queue_size=64):
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.seq = 0
+        # Frames dropped from any node's queue, since startup
+        self.dropped = 0
+        # Game in progress, kept as index.js keeps it for its own snapshots
+        self.game_start = None
+        self.game_end = None
+        self.players = {}
+        self.frame = None
+        self.ended = True
+        self.loop = None
+
+    # start: Serve from a thread of our own, so slow nodes never hold up
+    # handle_connection or the render loop
+    def start(self):
+        ready = threading.Event()
+        threading.Thread(target=self.serve_forever, args=(ready,), name="meleetrix-fanout", daemon=True).start()
+        ready.wait()
+
+    def serve_forever(self, ready):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(websockets.serve(self.handle_subscriber, self.host, self.port))
+            print("Fan-out publishing on ws://" + self.host + ":" + str(self.port) + "/")
+        finally:
+            ready.set()
+        self.loop.run_forever()
+
+    # publish: State listener; takes each message once it has been applied
+    # (websocket thread)
+    def publish(self, message):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.send_all, message)
+
+    def send_all(self, message):
+        self.track(message)
+        self.seq = (self.seq + 1) & SEQ_MASK
+        kind = POSITIONS if isinstance(message, bytes) else JSON_MESSAGE
+        # Encoded once, however many nodes are listening
+        frame = encode_frame(kind, self.seq, message)
+        for subscriber in self.subscribers:
+            if len(subscriber.queue) >= self.queue_size:
+                dropped_kind, _ = subscriber.queue.popleft()
+                self.dropped += 1
+                # A late position or input frame is worthless anyway; anything else
+                # means the node's state is wrong until it gets a snapshot
+                if dropped_kind != POSITIONS:
+                    subscriber.resync = True
+            subscriber.queue.append((kind, frame))
+            subscriber.wake.set()
+
+    # track: Keep the game in progress up to date for snapshots
+    def track(self, message):
+        if isinstance(message, bytes):
+            self.frame = POSITIONS_FRAME.unpack_from(message, 1)[0]
+            return
+        message_type = message.get('messageType')
+        if message_type == "gameStart":
+            self.game_start = message
+            self.game_end = None
+            self.ended = False
+            self.frame = None
+            self.players = {}
+            for player in message['players']:
+                self.players[player['playerIndex']] = {'playerIndex': player['playerIndex'], 'percent': 0,
+                                                       'stocksRemaining': player.get('startStocks', 4)}
+        elif message_type == "snapshot":
+            self.track(message['gameStart'])
+            for player in message['players']:
+                self.players[player['playerIndex']] = dict(player)
+            self.frame = message['frame']
+        elif message_type == "gameEnd":
+            self.game_end = message
+            self.ended = True
+        elif message_type == "clock":
+            self.frame = message['frame']
+        elif message_type in ("playerPercent", "countChange") and message['playerIndex'] in self.players:
+            player = self.players[message['playerIndex']]
+            if message_type == "playerPercent":
+                player['percent'] = message['percent']
+            else:
+                player['stocksRemaining'] = message['stocksRemaining']
+
+    # snapshot: The game so far, in index.js's snapshot format, plus whether
+    # (and how) it has ended
+    def snapshot(self):
+        return {'messageType': 'snapshot', 'gameStart': self.game_start, 'players': list(self.players.values()),
+                'frame': self.frame, 'ended': self.ended, 'gameEnd': self.game_end}
+
+    # handle_subscriber: Send one node its frames, oldest first
+    async def handle_subscriber(self, websocket, path):
+        subscriber = Subscriber()
+        self.subscribers.add(subscriber)
+        print("Fan-out node connected:", websocket.remote_address)
+        try:
+            while True:
+                await subscriber.wake.wait()
+                subscriber.wake.clear()
+                if subscriber.resync:
+                    # Supersedes everything queued; numbered with the last
+                    # message it includes, so the next frame follows on
+                    subscriber.resync = False
+                    subscriber.queue.clear()
+                    await websocket.send(encode_frame(SNAPSHOT, self.seq, self.snapshot()))
+                while subscriber.queue and not subscriber.resync:
+                    kind, frame = subscriber.queue.popleft()
+                    await websocket.send(frame)
+                if subscriber.resync:
+                    subscriber.wake.set()
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.subscribers.discard(subscriber)
+            print("Fan-out node disconnected:", websocket.remote_address)
+
+# -----------------------------------------------------------------------------
+class FanoutSubscriber(object):
+    # Arguments:
+    #   address: Publisher's websocket URL, e.g. "ws://192.168.0.50:8083"
+    #   dispatch: Called with each decoded message, as if index.js had sent it
+    def __init__(self, address, dispatch):
+        self.address = address
+        self.dispatch = dispatch
+        # Sequence number the next frame should have; None until a snapshot
+        self.expected = None
+        # Messages missed (dropped by the publisher or lost), since startup
+        self.missed = 0
+        # Whether the last game applied here is still in progress
+        self.in_game = False
+
+    # Coroutine; stay subscribed, reconnecting with backoff
+    async def run(self):
+        backoff = Backoff(0.5, 10.0)
+        while True:
+            try:
+                async with websockets.connect(self.address) as websocket:
+                    print("Subscribed to fan-out publisher", self.address)
+                    backoff.reset()
+                    self.expected = None
+                    async for data in websocket:
+                        self.receive(data)
+            except (OSError, websockets.WebSocketException) as e:
+                print("Fan-out publisher unreachable:", repr(e))
+            await asyncio.sleep(backoff.next_delay())
+
+    # receive: Apply one frame from the publisher
+    def receive(self, data):
+        kind, seq, message = decode_frame(data)
+        if kind == SNAPSHOT:
+            self.expected = (seq + 1) & SEQ_MASK
+            self.apply_snapshot(message)
+            return
+
+        if self.expected is not None and seq != self.expected:
+            self.missed += (seq - self.expected) & SEQ_MASK
+        self.expected = (seq + 1) & SEQ_MASK
+        if kind == JSON_MESSAGE:
+            if message['messageType'] in ("gameStart", "snapshot"):
+                self.in_game = True
+            elif message['messageType'] == "gameEnd":
+                self.in_game = False
+        self.dispatch(message)
+
+    # apply_snapshot: Catch up with the publisher's game
+    def apply_snapshot(self, snapshot):
+        if snapshot['gameStart'] is None:
+            return
+        if not snapshot['ended']:
+            self.in_game = True
+            self.dispatch(snapshot)
+        # Only a game this node is showing needs its end; a late joiner
+        # shouldn't record (or show the results of) a game it never saw
+        elif self.in_game and snapshot['gameEnd'] is not None:
+            self.in_game = False
+            # Final percents and stocks first, for the results and history
+            for player in snapshot['players']:
+                self.dispatch(dict(player, messageType="playerPercent"))
+                self.dispatch(dict(player, messageType="countChange"))
+            self.dispatch(snapshot['gameEnd'])
@@ -0,0 +1,82 @@
+# ttroy1, 2023
+# Frame diffing: skip identical swaps and limit canvas writes to what changed
+
+# -----------------------------------------------------------------------------
+import numpy as np
+
+# changed_region: Bounding box of the pixels that differ between two frames
+# Arguments:
+#   old, new: (height, width, 3) uint8 arrays
+# Returns:
+#   (mask, (x0, y0, x1, y1)) with x1/y1 exclusive, or (mask, None) if identical
+def changed_region(old, new):
+    mask = np.any(old != new, axis=2)
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return mask, None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return mask, (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+# -----------------------------------------------------------------------------
+class FrameDiffer(object):
+    # Arguments:
+    #   partial_updates: Write only the changed region instead of the full frame
+    #   setpixel_max: Up to this many changed pixels are written with SetPixel
+    def __init__(self, partial_updates=True, setpixel_max=8):
+        self.partial_updates = partial_updates
+        self.setpixel_max = setpixel_max
+        # Pixels currently on the front buffer
+        self.shown = None
+        # Pixels on the back buffer, the next canvas written to; the matrix is
+        # double-buffered and SwapOnVSync hands back the old front buffer, so
+        # the two trade places on every swap. Tracked by position rather than
+        # by canvas object, as each swap returns a new wrapper.
+        self.back_pixels = None
+        # Changed region of the last frame that was swapped, for reporting
+        self.last_region = None
+
+    # write: Bring a canvas up to date with a frame and say whether to swap
+    # Arguments:
+    #   canvas: The offscreen canvas about to be swapped in
+    #   image: Finished PIL image for the frame
+    # Returns:
+    #   'skip' if the frame is already on screen (no swap needed), otherwise
+    #   'full', 'region' or 'pixels' depending on how the canvas was updated
+    def write(self, canvas, image):
+        pixels = np.asarray(image)
+        if self.shown is not None and np.array_equal(pixels, self.shown):
+            return 'skip'
+
+        previous = self.back_pixels
+        if previous is None or not self.partial_updates:
+            canvas.SetImage(image, 0, 0)
+            mode = 'full'
+            self.last_region = (0, 0, pixels.shape[1], pixels.shape[0])
+        else:
+            mask, region = changed_region(previous, pixels)
+            self.last_region = region
+            if region is None:
+                # The canvas already holds this frame; it only needs swapping
+                mode = 'region'
+            elif np.count_nonzero(mask) <= self.setpixel_max:
+                for y, x in zip(*np.nonzero(mask)):
+                    r, g, b = pixels[y, x]
+                    canvas.SetPixel(int(x), int(y), int(r), int(g), int(b))
+                mode = 'pixels'
+            else:
+                x0, y0, x1, y1 = region
+                canvas.SetImage(image.crop(region), x0, y0)
+                mode = 'region'
+
+        self.back_pixels = pixels
+        return mode
+
+    # swapped: Note that the canvas written by write() is now on the front
+    # buffer, and the old front buffer is the one to write next
+    def swapped(self):
+        self.back_pixels, self.shown = self.shown, self.back_pixels
+
+    # forget: Drop what's known about the canvases (e.g. after Clear())
+    def forget(self):
+        self.shown = None
+        self.back_pixels = None
@@ -0,0 +1,196 @@
+# ttroy1, 2023
+# Persistent match history: SQLite (WAL) store fed by a batching writer thread
+
+# -----------------------------------------------------------------------------
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+# Tries at creating the tables and switching to WAL
+SETUP_ATTEMPTS = 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY,
+    started_at REAL,
+    ended_at REAL,
+    stage TEXT,
+    is_teams INTEGER,
+    winner_port INTEGER,
+    end_method INTEGER,
+    timeline TEXT
+);
+CREATE TABLE IF NOT EXISTS match_players (
+    match_id INTEGER REFERENCES matches(id),
+    port INTEGER,
+    player TEXT,
+    nametag TEXT,
+    display_name TEXT,
+    character TEXT,
+    color TEXT,
+    stocks INTEGER,
+    percent TEXT,
+    won INTEGER
+);
+CREATE INDEX IF NOT EXISTS match_players_player ON match_players (player, match_id);
+CREATE INDEX IF NOT EXISTS matches_ended_at ON matches (ended_at);
+"""
+
+# -----------------------------------------------------------------------------
+# player_key: Name a player is tracked under across games
+# Arguments:
+#   player: Dict with display_name, nametag and character
+# Returns:
+#   The Slippi display name, else the nametag, else the character
+def player_key(player):
+    return player.get('display_name') or player.get('nametag') or player['character']
+
+# -----------------------------------------------------------------------------
+class MatchHistory(object):
+    # Open (and create if needed) the database, then start the writer thread
+    # Arguments:
+    #   db_path: Location of the SQLite file
+    #   batch_size: Most matches committed in one transaction
+    #   flush_interval: Seconds a partial batch may wait before it's committed
+    def __init__(self, db_path, batch_size=16, flush_interval=1.0):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Incremented after each commit, so readers know when to re-query
+        self.version = 0
+        # Called (on the writer thread) after each commit, if set
+        self.committed = None
+
+        # Create tables and switch to WAL before anything else touches the file.
+        # With separate_processes both processes get here at startup, and the
+        # switch fails rather than waits if the other is mid-way through it
+        for attempt in range(SETUP_ATTEMPTS):
+            try:
+                conn = sqlite3.connect(self.db_path)
+                try:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.executescript(SCHEMA)
+                    conn.commit()
+                finally:
+                    conn.close()
+                break
+            except sqlite3.OperationalError:
+                if attempt == SETUP_ATTEMPTS - 1:
+                    raise
+                time.sleep(0.05)
+
+        self.pending = queue.Queue()
+        self.local = threading.local()
+        self.writer = threading.Thread(target=self.write_loop, name="history-writer", daemon=True)
+        self.writer.start()
+
+    # record: Queue a finished match; never blocks on the disk
+    # Arguments:
+    #   match: Dict with started_at, ended_at, stage, is_teams, winner_port,
+    #          end_method, timeline and a list of players
+    def record(self, match):
+        self.pending.put(match)
+
+    # close: Flush anything still queued and stop the writer thread
+    def close(self):
+        self.pending.put(None)
+        self.writer.join()
+
+    # write_loop: Writer thread body; commits queued matches in batches
+    def write_loop(self):
+        conn = sqlite3.connect(self.db_path)
+        # WAL + NORMAL only syncs on checkpoints, not on every commit
+        conn.execute("PRAGMA synchronous=NORMAL")
+        running = True
+        while running:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # Keep collecting until the batch is full or the interval is up
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            if batch[-1] is None:
+                running = False
+                batch.pop()
+            if batch:
+                try:
+                    with conn:
+                        for match in batch:
+                            self.insert(conn, match)
+                    self.version += 1
+                    if self.committed is not None:
+                        self.committed()
+                except sqlite3.Error as e:
+                    print("Failed to write match history:", e)
+        conn.close()
+
+    # insert: Write a single match and its players (inside the caller's transaction)
+    def insert(self, conn, match):
+        cursor = conn.execute(
+            "INSERT INTO matches (started_at, ended_at, stage, is_teams, winner_port, end_method, timeline) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (match['started_at'], match['ended_at'], match['stage'], int(bool(match['is_teams'])),
+             match['winner_port'], match['end_method'], json.dumps(match['timeline'], separators=(',', ':'))))
+        match_id = cursor.lastrowid
+        conn.executemany(
+            "INSERT INTO match_players (match_id, port, player, nametag, display_name, character, color, stocks, percent, won) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(match_id, player['port'], player_key(player), player.get('nametag'), player.get('display_name'),
+              player['character'], player['color'], player['stocks'], player['percent'],
+              int(player['port'] == match['winner_port'])) for player in match['players']])
+
+    # reader: Per-thread read-only connection (sqlite connections can't be shared)
+    def reader(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path)
+            self.local.conn = conn
+        return conn
+
+    # head_to_head: Wins for each of two players in games they both played
+    # Arguments:
+    #   player_a, player_b: Names as stored by player_key
+    # Returns:
+    #   (wins for player_a, wins for player_b), or None if both have the same
+    #   name (e.g. two unnamed players on one character), as their games
+    #   can't be told apart
+    def head_to_head(self, player_a, player_b):
+        if player_a == player_b:
+            return None
+        row = self.reader().execute(
+            "SELECT COALESCE(SUM(a.won), 0), COALESCE(SUM(b.won), 0) FROM match_players a "
+            "JOIN match_players b ON a.match_id = b.match_id AND a.port <> b.port "
+            "WHERE a.player = ? AND b.player = ?", (player_a, player_b)).fetchone()
+        return (row[0], row[1])
+
+    # recent_results: Most recently finished matches, newest first
+    # Arguments:
+    #   limit: Number of matches to return
+    # Returns:
+    #   List of dicts with stage, winner_port, ended_at and players
+    def recent_results(self, limit=5):
+        conn = self.reader()
+        matches = conn.execute(
+            "SELECT id, stage, winner_port, ended_at FROM matches ORDER BY ended_at DESC LIMIT ?", (limit,)).fetchall()
+        results = []
+        for match_id, stage, winner_port, ended_at in matches:
+            players = conn.execute(
+                "SELECT port, player, nametag, character, color, stocks, won FROM match_players "
+                "WHERE match_id = ? ORDER BY port", (match_id,)).fetchall()
+            results.append({
+                'stage': stage,
+                'winner_port': winner_port,
+                'ended_at': ended_at,
+                'players': [{'port': p[0], 'player': p[1], 'nametag': p[2], 'character': p[3], 'color': p[4],
+                             'stocks': p[5], 'won': bool(p[6])}
+                            for p in players],
+            })
+        return results
@@ -18,66 +18,314 @@ const { ConnectionStatus, SlpLiveStream, SlpRealTime, getStageInfo, getCharacter
 
 // ----------------------------------------------------------------------------
 // Set the address values for connecting to Dolphin/Wii
-// First, check if the active connection is console or Dolphin based
-if (settings.active_conn_type == "console") {
-	var ADDRESS = settings.console_address; 
-	var connectionType = "console";
+// With dual_source, both the console and the Dolphin relay are connected and
+// whichever delivers an event first wins; otherwise active_conn_type picks one
+const SOURCES = [];
+if (settings.dual_source) {
+	SOURCES.push({ name: "console", connectionType: "console", address: settings.console_address });
+	SOURCES.push({ name: "dolphin", connectionType: "dolphin", address: settings.slippi_dolphin_address });
+}
+else if (settings.active_conn_type == "console") {
+	SOURCES.push({ name: "console", connectionType: "console", address: settings.console_address });
 }
 else {
-	var ADDRESS = settings.slippi_dolphin_address
-	var connectionType = "dolphin";
+	SOURCES.push({ name: "dolphin", connectionType: "dolphin", address: settings.slippi_dolphin_address });
 }
 
 const PORT = Ports.DEFAULT;  
 
-// Connect to Dolphin or the relay
-const livestream = new SlpLiveStream(connectionType, {
-  outputFiles: false,
-});
+// Reconnect delays (ms): doubled after each failure, up to the maximum
+const RECONNECT_INITIAL_MS = 250;
+const RECONNECT_MAX_MS = 10000;
 
-// Connect to the livestream
-livestream.start(ADDRESS, PORT)
-  .then(() => {
-    console.log("Connected to Slippi");
-  })
-  .catch(console.error);
-
-// Write out the files when we've been disconnected
-livestream.connection.on("statusChange", (status) => {
-  if (status === ConnectionStatus.DISCONNECTED) {
-    console.log("Disconnected from the relay.");
-  }
-});
+// Returns an object whose next() gives the next delay and reset() starts over
+function createBackoff() {
+	let failures = 0;
+	return {
+		next: () => {
+			const delay = Math.min(RECONNECT_MAX_MS, RECONNECT_INITIAL_MS * Math.pow(2, failures));
+			failures += 1;
+			// Up to 10% jitter so both sides don't retry in lockstep
+			return delay * (1 + Math.random() * 0.1);
+		},
+		reset: () => { failures = 0; },
+	};
+}
+
+// Connect a source to Dolphin or the relay; each source has its own
+// livestream, reconnect backoff and realtime reader
+function createSource(source) {
+	source.livestream = new SlpLiveStream(source.connectionType, {
+	  outputFiles: false,
+	});
+	source.backoff = createBackoff();
+	source.retryPending = false;
+	// Game and frame this source is on, for de-duplicating its events
+	source.game = null;
+	source.frame = null;
+	// Events this source delivered first, since its last game start
+	source.wins = 0;
+
+	connectSlippi(source);
+
+	// Reconnect when we've been disconnected
+	source.livestream.connection.on("statusChange", (status) => {
+	  if (status === ConnectionStatus.DISCONNECTED) {
+	    console.log("Disconnected from the " + source.name + " relay, reconnecting.");
+	    scheduleSlippiReconnect(source);
+	  }
+	});
+
+	// Connecting to the relay with the connection parameters
+	source.realtime = new SlpRealTime();
+	// Reading from the SlpLiveStream object
+	source.realtime.setStream(source.livestream);
+	return source;
+}
+
+// Connect to the livestream, retrying with backoff until it succeeds
+function connectSlippi(source) {
+	source.retryPending = false;
+	source.livestream.start(source.address, PORT)
+	  .then(() => {
+	    console.log("Connected to Slippi (" + source.name + ")");
+	    source.backoff.reset();
+	  })
+	  .catch((err) => {
+	    console.error(err);
+	    scheduleSlippiReconnect(source);
+	  });
+}
+
+function scheduleSlippiReconnect(source) {
+	if (source.retryPending) {
+		return;
+	}
+	source.retryPending = true;
+	setTimeout(() => connectSlippi(source), source.backoff.next());
+}
+
+SOURCES.forEach(createSource);
+
+// ----------------------------------------------------------------------------
+// First-arrival-wins merging: an event is identified by (game, frame, player,
+// type, value) and only the first copy of it, from either source, is
+// forwarded. The value is part of it so a rollback correction on the same
+// frame still goes through
+const merged = {
+	game: null,       // game key of the game being forwarded
+	frame: null,      // latest frame forwarded
+	seen: new Set(),  // keys of the events forwarded this game
+};
+// Most event keys remembered; a game has far fewer percent/stock changes
+const MAX_SEEN_EVENTS = 4096;
+
+// Identifies a game the same way on both sources
+function gameKey(payload) {
+	if (payload.randomSeed != null) {
+		return String(payload.randomSeed);
+	}
+	return [payload.stageId].concat(payload.players.map((player) =>
+		player.playerIndex + "-" + player.characterId + "-" + player.characterColor)).join(":");
+}
+
+// Returns true if this source delivered the event first (always, with a
+// single source)
+function firstArrival(source, type, playerIndex, value = "") {
+	if (SOURCES.length < 2) {
+		return true;
+	}
+	if (source.game === null || source.game !== merged.game) {
+		// A source still on a game that has already been replaced
+		return false;
+	}
+	const key = source.game + ":" + source.frame + ":" + playerIndex + ":" + type + ":" + value;
+	if (merged.seen.has(key)) {
+		return false;
+	}
+	merged.seen.add(key);
+	if (merged.seen.size > MAX_SEEN_EVENTS) {
+		merged.seen.delete(merged.seen.values().next().value);
+	}
+	source.wins += 1;
+	return true;
+}
+
+// ----------------------------------------------------------------------------
+// Latest full game state, sent as one snapshot whenever main.py (re)connects
+const gameState = {
+	start: null,      // gameStart payload, as sent
+	players: {},      // playerIndex -> { playerIndex, percent, stocksRemaining }
+	frame: null,      // latest frame number seen
+	ended: true,      // no game in progress
+};
+
+// Minimap: send every player's position each frame, as a small binary message
+const SEND_POSITIONS = Boolean(settings.minimap && settings.minimap.active);
+// Must match POSITIONS_MESSAGE in minimap.py
+const POSITIONS_MESSAGE = 1;
+// Position frames are dropped rather than queued once this much is unsent
+const MAX_BUFFERED_BYTES = 16 * 1024;
+
+// Binary position frame: type (uint8), frame (int32), player count (uint8),
+// then player index (uint8) and x, y (float32) per player; little-endian
+function encodePositions(frameEntry) {
+	const players = Object.values(frameEntry.players).filter((player) => player && player.post);
+	const buffer = Buffer.alloc(6 + players.length * 9);
+	buffer.writeUInt8(POSITIONS_MESSAGE, 0);
+	buffer.writeInt32LE(frameEntry.frame, 1);
+	buffer.writeUInt8(players.length, 5);
+	players.forEach((player, i) => {
+		const offset = 6 + i * 9;
+		buffer.writeUInt8(player.post.playerIndex, offset);
+		buffer.writeFloatLE(player.post.positionX, offset + 1);
+		buffer.writeFloatLE(player.post.positionY, offset + 5);
+	});
+	return buffer;
+}
+
+// Input display: send every port's controller state each frame, as a small
+// binary message; must match INPUTS_MESSAGE in inputs.py
+const SEND_INPUTS = Boolean(settings.inputs && settings.inputs.active);
+const INPUTS_MESSAGE = 2;
+
+// Stick (-1 to 1) and trigger (0 to 1) values, packed into a byte each
+function stickByte(value) {
+	return Math.max(-127, Math.min(127, Math.round((value || 0) * 127)));
+}
+function triggerByte(value) {
+	return Math.max(0, Math.min(255, Math.round((value || 0) * 255)));
+}
+
+// Binary input frame: type (uint8), frame (int32), player count (uint8), then
+// per player: index (uint8), physicalButtons bitmask (uint16), main and C
+// stick x, y (int8) and L, R triggers (uint8); little-endian
+function encodeInputs(frameEntry) {
+	const players = Object.values(frameEntry.players).filter((player) => player && player.pre);
+	const buffer = Buffer.alloc(6 + players.length * 9);
+	buffer.writeUInt8(INPUTS_MESSAGE, 0);
+	buffer.writeInt32LE(frameEntry.frame, 1);
+	buffer.writeUInt8(players.length, 5);
+	players.forEach((player, i) => {
+		const pre = player.pre;
+		const offset = 6 + i * 9;
+		buffer.writeUInt8(pre.playerIndex, offset);
+		buffer.writeUInt16LE(pre.physicalButtons || 0, offset + 1);
+		buffer.writeInt8(stickByte(pre.joystickX), offset + 3);
+		buffer.writeInt8(stickByte(pre.joystickY), offset + 4);
+		buffer.writeInt8(stickByte(pre.cStickX), offset + 5);
+		buffer.writeInt8(stickByte(pre.cStickY), offset + 6);
+		buffer.writeUInt8(triggerByte(pre.physicalLTrigger), offset + 7);
+		buffer.writeUInt8(triggerByte(pre.physicalRTrigger), offset + 8);
+	});
+	return buffer;
+}
 
-// Connecting to the relay with the connection parameters
-const realtime = new SlpRealTime();
-// Reading from the SlpLiveStream object
-realtime.setStream(livestream);
+// Match clock: the frame number is sent once per second of game time, when
+// the clock's shown second changes; must match FIRST_PLAYABLE_FRAME in main.py
+const SEND_CLOCK = Boolean(settings.clock && settings.clock.active);
+const FIRST_PLAYABLE_FRAME = -39;
+let lastClockSecond = null;
+
+// Keep the frame number current; one field write per frame. Only a frame
+// newer than any forwarded yet is used, so the leading source sets the pace
+function onFrame(source, frameEntry) {
+	source.frame = frameEntry.frame;
+	if (source.game !== merged.game || (merged.frame !== null && frameEntry.frame <= merged.frame)) {
+		return;
+	}
+	merged.frame = frameEntry.frame;
+	gameState.frame = frameEntry.frame;
+	if (SEND_CLOCK && !gameState.ended && ws !== null && ws.readyState === WebSocket.OPEN) {
+		const second = Math.floor((frameEntry.frame - FIRST_PLAYABLE_FRAME) / 60);
+		if (second !== lastClockSecond) {
+			lastClockSecond = second;
+			ws.send(JSON.stringify({ messageType: 'clock', frame: frameEntry.frame }));
+		}
+	}
+	// Positions are stale a frame later, so they're never queued
+	if (SEND_POSITIONS && !gameState.ended && ws !== null && ws.readyState === WebSocket.OPEN
+	    && ws.bufferedAmount < MAX_BUFFERED_BYTES) {
+		ws.send(encodePositions(frameEntry));
+	}
+	// Inputs too; the next frame supersedes them
+	if (SEND_INPUTS && !gameState.ended && ws !== null && ws.readyState === WebSocket.OPEN
+	    && ws.bufferedAmount < MAX_BUFFERED_BYTES) {
+		ws.send(encodeInputs(frameEntry));
+	}
+}
+
+// Build the snapshot message, or null if no game is in progress
+function buildSnapshot() {
+	if (gameState.start === null || gameState.ended) {
+		return null;
+	}
+	return JSON.stringify({
+		messageType: 'snapshot',
+		gameStart: gameState.start,
+		players: Object.values(gameState.players),
+		frame: gameState.frame,
+	});
+}
 
 // ----------------------------------------------------------------------------
 // Socket Data
 
-// Create Websocket
-const ws = new WebSocket('ws://localhost:8081');
+// Messages held while the Python side is unreachable (oldest dropped first)
+const MAX_PENDING_MESSAGES = 256;
+const pendingMessages = [];
+const socketBackoff = createBackoff();
+let ws = null;
 
-ws.on('open', function() {
-	// Connection is established, ready to send data
-	console.log("Socket connection established")
-});
+// Create Websocket; reconnects with backoff whenever it closes
+function connectSocket() {
+	ws = new WebSocket('ws://localhost:8081');
+
+	ws.on('open', function() {
+		// Connection is established, ready to send data
+		console.log("Socket connection established")
+		socketBackoff.reset();
+		// Mid-game, the snapshot supersedes anything queued while disconnected
+		const snapshot = buildSnapshot();
+		if (snapshot !== null) {
+			pendingMessages.length = 0;
+			ws.send(snapshot);
+		}
+		while (pendingMessages.length > 0 && ws.readyState === WebSocket.OPEN) {
+			ws.send(pendingMessages.shift());
+		}
+	});
+
+	ws.on('close', function() {
+		const delay = socketBackoff.next();
+		console.log("Socket connection lost, retrying in " + Math.round(delay) + "ms");
+		setTimeout(connectSocket, delay);
+	});
+
+	// 'close' follows every error; this just stops the process from exiting
+	ws.on('error', function(err) {
+		console.error("Socket error:", err.message);
+	});
+}
+
+connectSocket();
 
 // Data Function
 function sendData(dataStr) {
     if (ws.readyState === WebSocket.OPEN) {
         ws.send(dataStr);
     } else {
-        setTimeout(sendData, 100); // Retry in 100ms
+        pendingMessages.push(dataStr);
+        if (pendingMessages.length > MAX_PENDING_MESSAGES) {
+            pendingMessages.shift();
+        }
     }
 }
 
 // ----------------------------------------------------------------------------
 // We can choose exactly which events we want to subscribe for
 // by using the pipe command. Learn more by reading the RxJS docs.
-realtime.game.start$.subscribe(payload => {
+function onGameStart(source, payload) {
 	// Game Start Payload - Write to file
 	// GameStartType
 		// slpVersion: string | null
@@ -85,6 +333,21 @@ realtime.game.start$.subscribe(payload => {
 		// isPAL: boolean | null
 		// stageId: number | null
 		// players: PlayerType[]
+
+	source.game = gameKey(payload);
+	source.frame = null;
+	if (source.game === merged.game) {
+		// The other source already started this game
+		return;
+	}
+	if (SOURCES.length > 1 && merged.game !== null) {
+		console.log("Previous game: " + SOURCES.map((s) => s.name + " first on " + s.wins).join(", ") + " events");
+	}
+	merged.game = source.game;
+	merged.frame = null;
+	merged.seen.clear();
+	SOURCES.forEach((s) => { s.wins = 0; });
+	source.wins = 1;
 	
 	// Extract data from payload using built in functions
 	payload.stageInfo = getStageInfo(payload.stageId);
@@ -95,36 +358,80 @@ realtime.game.start$.subscribe(payload => {
 	}
 
 	payload.messageType = 'gameStart'
+
+	// Reset the snapshot state for the new game
+	gameState.start = payload;
+	gameState.players = {};
+	gameState.ended = false;
+	lastClockSecond = null;
+	for (let player of payload.players) {
+		gameState.players[player.playerIndex] = {
+			playerIndex: player.playerIndex,
+			percent: 0,
+			stocksRemaining: player.startStocks != null ? player.startStocks : 4,
+		};
+	}
+
 	dataString = JSON.stringify(payload);
 	sendData(dataString);
-});
+}
 
 // Game End
-realtime.game.end$.subscribe(payload => {
+function onGameEnd(source, payload) {
+	// Once per game, whatever frame each source ended on; null also keeps
+	// any later change's frame out of main.py's settle window
+	source.frame = null;
+	if (!firstArrival(source, 'gameEnd', -1)) {
+		return;
+	}
+	gameState.ended = true;
 	payload.messageType = 'gameEnd'
 	dataString = JSON.stringify(payload);
 	sendData(dataString);
-})
+}
 	  
 // Stock Percentage Tracker
-realtime.stock.percentChange$.subscribe((payload) => {
+function onPercentChange(source, payload) {
+	if (!firstArrival(source, 'playerPercent', payload.playerIndex, payload.percent)) {
+		return;
+	}
 	// Integer; player indexes of 1-4
 	const player = payload.playerIndex + 1;
 	payload.messageType = 'playerPercent'
+	// Frame the change was seen on, for main.py's settle window
+	payload.frame = source.frame;
+	if (gameState.players[payload.playerIndex]) {
+		gameState.players[payload.playerIndex].percent = payload.percent;
+	}
 	// Write to folder with player percentages
 	dataString = JSON.stringify(payload);
 	sendData(dataString);
-});
+}
 
 // Stock Count Change
-realtime.stock.countChange$.subscribe((payload) => {
+function onCountChange(source, payload) {
+	if (!firstArrival(source, 'countChange', payload.playerIndex, payload.stocksRemaining)) {
+		return;
+	}
 	// Integer; player indexes of 1-4
 	const player = payload.playerIndex + 1;
 	payload.messageType = 'countChange'
+	// Frame the change was seen on, for main.py's settle window
+	payload.frame = source.frame;
+	if (gameState.players[payload.playerIndex]) {
+		gameState.players[payload.playerIndex].stocksRemaining = payload.stocksRemaining;
+	}
 	// Write to folder with player percentages
 	dataString = JSON.stringify(payload);
 	sendData(dataString);
-});
-
-
+}
 
+// The frame subscription comes first, so a source's frame number is current
+// by the time the stock events of that frame reach their handlers
+SOURCES.forEach((source) => {
+	source.livestream.playerFrame$.subscribe((frameEntry) => onFrame(source, frameEntry));
+	source.realtime.game.start$.subscribe((payload) => onGameStart(source, payload));
+	source.realtime.game.end$.subscribe((payload) => onGameEnd(source, payload));
+	source.realtime.stock.percentChange$.subscribe((payload) => onPercentChange(source, payload));
+	source.realtime.stock.countChange$.subscribe((payload) => onCountChange(source, payload));
+});
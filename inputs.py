@@ -0,0 +1,156 @@
+# ttroy1, 2023
+# Controller input display: each port's sticks, triggers and buttons, from the
+# pre-frame input frames index.js packs every game frame
+
+# -----------------------------------------------------------------------------
+import struct
+
+from PIL import Image, ImageDraw
+
+from minimap import PORT_COLORS
+
+# Binary input frames from index.js: message type, frame number, player
+# count, then per player the port index, Slippi's physicalButtons bitmask,
+# main and C stick x/y (-127 to 127) and L/R triggers (0 to 255)
+INPUTS_HEADER = struct.Struct("<BiB")
+INPUTS_ENTRY = struct.Struct("<BHbbbbBB")
+INPUTS_MESSAGE = 2
+
+# physicalButtons bits, and each button's colour, in the order they're drawn
+BUTTONS = [
+    ("A", 0x0100, (0, 200, 120)),
+    ("B", 0x0200, (230, 40, 40)),
+    ("X", 0x0400, (200, 200, 200)),
+    ("Y", 0x0800, (200, 200, 200)),
+    ("Z", 0x0010, (140, 60, 230)),
+    ("START", 0x1000, (255, 255, 255)),
+]
+L_BUTTON = 0x0040
+R_BUTTON = 0x0020
+
+# Cell layout, in pixels from the top left of a port's 32x32 cell
+CELL_SIZE = 32
+STICK_BOX = (1, 8, 15)     # left, top, size of the main stick's gate
+C_STICK_BOX = (18, 10, 11)
+TRIGGER_BARS = [(11, 2), (21, 2)]  # left, top of the L and R bars
+TRIGGER_SIZE = (9, 3)
+BUTTON_ROW = (1, 26)       # left, top of the first button
+BUTTON_SIZE = 4
+BUTTON_STEP = 5
+
+GATE_COLOR = (70, 70, 70)
+C_STICK_COLOR = (255, 200, 0)
+STICK_COLOR = (255, 255, 255)
+RELEASED_COLOR = (60, 60, 60)
+TRIGGER_COLOR = (150, 150, 150)
+
+# -----------------------------------------------------------------------------
+# decode_inputs: Read a binary input frame
+# Arguments:
+#   data: Bytes as sent by index.js
+# Returns:
+#   (frame number, {port index: (buttons, stick x, stick y, c x, c y, l, r)})
+def decode_inputs(data):
+    message_type, frame, count = INPUTS_HEADER.unpack_from(data, 0)
+    if message_type != INPUTS_MESSAGE:
+        raise ValueError("Unknown binary message type " + str(message_type))
+    end = INPUTS_HEADER.size + count * INPUTS_ENTRY.size
+    inputs = {}
+    for entry in INPUTS_ENTRY.iter_unpack(data[INPUTS_HEADER.size:end]):
+        inputs[entry[0]] = entry[1:]
+    return frame, inputs
+
+# gate_tile: A stick's octagonal gate, as a square tile
+def gate_tile(size, color):
+    tile = Image.new("RGB", (size, size))
+    corner = size // 3
+    last = size - 1
+    ImageDraw.Draw(tile).polygon([(corner, 0), (last - corner, 0), (last, corner), (last, last - corner),
+                                  (last - corner, last), (corner, last), (0, last - corner), (0, corner)], outline=color)
+    return tile
+
+# -----------------------------------------------------------------------------
+class InputDisplay(object):
+    # Every sprite is drawn once here; updates only paste them
+    # Arguments:
+    #   font: Font for the port labels
+    def __init__(self, font):
+        self.font = font
+        self.image = Image.new("RGB", (64, 64))
+        self.gates = [gate_tile(STICK_BOX[2], GATE_COLOR), gate_tile(C_STICK_BOX[2], tuple(v // 3 for v in C_STICK_COLOR))]
+        self.dots = [Image.new("RGB", (3, 3), STICK_COLOR), Image.new("RGB", (3, 3), C_STICK_COLOR)]
+        # (released, pressed) sprite per button
+        self.button_sprites = []
+        for name, bit, color in BUTTONS:
+            released = Image.new("RGB", (BUTTON_SIZE, BUTTON_SIZE))
+            ImageDraw.Draw(released).rectangle((0, 0, BUTTON_SIZE - 1, BUTTON_SIZE - 1), outline=RELEASED_COLOR)
+            self.button_sprites.append((released, Image.new("RGB", (BUTTON_SIZE, BUTTON_SIZE), color)))
+        # Trigger bars, by how far in (0 to the bar's inner width) and
+        # whether the digital press clicked
+        inner = TRIGGER_SIZE[0] - 2
+        self.trigger_sprites = {}
+        for clicked in (False, True):
+            for level in range(inner + 1):
+                bar = Image.new("RGB", TRIGGER_SIZE)
+                bar_draw = ImageDraw.Draw(bar)
+                bar_draw.rectangle((0, 0, TRIGGER_SIZE[0] - 1, TRIGGER_SIZE[1] - 1), outline=RELEASED_COLOR)
+                if level:
+                    bar_draw.line((1, 1, level, 1), fill=STICK_COLOR if clicked else TRIGGER_COLOR)
+                self.trigger_sprites[(level, clicked)] = bar
+        self.set_players([])
+
+    # set_players: Lay out the cells for a new game's ports
+    # Arguments:
+    #   indexes: Active port indexes (0-3); each has a fixed corner
+    def set_players(self, indexes):
+        self.image.paste((0, 0, 0), (0, 0, 64, 64))
+        draw = ImageDraw.Draw(self.image)
+        # Last state drawn per port; None until its first frame arrives
+        self.shown = {}
+        for index in indexes:
+            left, top = self.cell_origin(index)
+            draw.text((left + 1, top + 1), "P" + str(index + 1), font=self.font, fill=PORT_COLORS[index])
+            self.shown[index] = None
+            self.update_port(index, (0, 0, 0, 0, 0, 0, 0))
+
+    def cell_origin(self, index):
+        return ((index % 2) * CELL_SIZE, (index // 2) * CELL_SIZE)
+
+    # update: Redraw whatever changed since the last frame
+    # Arguments:
+    #   inputs: Port index -> input tuple, from decode_inputs
+    def update(self, inputs):
+        for index, state in inputs.items():
+            if index in self.shown and state != self.shown[index]:
+                self.update_port(index, state)
+
+    # update_port: Redraw only the parts of a port's cell whose input changed
+    def update_port(self, index, state):
+        left, top = self.cell_origin(index)
+        previous = self.shown[index]
+        buttons, stick_x, stick_y, c_x, c_y, l_trigger, r_trigger = state
+
+        for stick, (box, offset) in enumerate(((STICK_BOX, 1), (C_STICK_BOX, 3))):
+            if previous is None or previous[offset:offset + 2] != state[offset:offset + 2]:
+                box_left, box_top, size = box
+                self.image.paste(self.gates[stick], (left + box_left, top + box_top))
+                # Stick values are -127 to 127, up positive; the dot stays inside the gate
+                reach = (size - 3) / 254.0
+                x = left + box_left + (size - 3) // 2 + int(round(state[offset] * reach))
+                y = top + box_top + (size - 3) // 2 - int(round(state[offset + 1] * reach))
+                self.image.paste(self.dots[stick], (x, y))
+
+        for button, (name, bit, color) in enumerate(BUTTONS):
+            pressed = bool(buttons & bit)
+            if previous is None or bool(previous[0] & bit) != pressed:
+                self.image.paste(self.button_sprites[button][pressed],
+                                 (left + BUTTON_ROW[0] + button * BUTTON_STEP, top + BUTTON_ROW[1]))
+
+        inner = TRIGGER_SIZE[0] - 2
+        for trigger, (value, bit) in enumerate(((l_trigger, L_BUTTON), (r_trigger, R_BUTTON))):
+            sprite_key = (int(round(value * inner / 255.0)), bool(buttons & bit))
+            if previous is None or (int(round(previous[5 + trigger] * inner / 255.0)), bool(previous[0] & bit)) != sprite_key:
+                bar_left, bar_top = TRIGGER_BARS[trigger]
+                self.image.paste(self.trigger_sprites[sprite_key], (left + bar_left, top + bar_top))
+
+        self.shown[index] = state
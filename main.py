@@ -2,22 +2,68 @@
 # Using websockets, retrieve information from slp-realtime and display on matrix
 
 # -----------------------------------------------------------------------------
+# Startup timing begins before anything heavy is imported
+from startup import PhaseTimer, notify_ready, clear_ready
+startup_timer = PhaseTimer()
+
 import os
 import time
 import sys
-import websockets
 import threading
 import asyncio
-from rgbmatrix import RGBMatrix, RGBMatrixOptions, graphics
+import concurrent.futures
 from PIL import Image
 from PIL import ImageDraw, ImageFont
-import numpy as np
 # Base matrix instance from rpi-rgb-led-matrix library
+# (rgbmatrix itself is imported when the matrix is created)
 from samplebase import SampleBase
+# Prometheus-format counters and timings, served from the websocket loop
+from metrics import Metrics
+# Retry delays for the supervised server and render loops
+from backoff import Backoff
+from deadline import DeadlineMonitor, NO_ANIMATIONS, LOW_FPS, NO_BORDERS, CACHED_TEXT
+from scheduling import RefreshMonitor, apply_policy, thread_ids, python_thread_ids
+# Stage minimap layout and the binary position frames that drive it
+from minimap import Minimap, PORT_COLORS, POSITIONS_MESSAGE, decode_positions
+# Controller input layout and the binary input frames that drive it
+from inputs import InputDisplay, INPUTS_MESSAGE, decode_inputs
+# Scrolling name rows for the 2P and 4P list layouts
+from marquee import Marquee
+# Settle window that holds percent/stock updates rollback may still undo
+from settle import SettleWindow
 import json
 import traceback
-from PIL import BdfFontFile
-from datetime import datetime
+from collections import OrderedDict
+# websockets is imported by the server thread, and the palette (numpy) and
+# match history by load_assets, so none of them delay the splash screen
+
+startup_timer.mark("imports")
+
+# Game state written by the message handlers, as exchanged between processes
+SHARED_FIELDS = ['active_indexes', 'player_count', 'stage', 'stage_id', 'stage_x_loc', 'is_teams',
+                 'winner_index', 'gameEnd_method', 'frame', 'positions', 'timer_seconds']
+# Binary messages by their first byte, as counted in metrics
+BINARY_TYPES = {POSITIONS_MESSAGE: "positions", INPUTS_MESSAGE: "inputs"}
+# Finished backgrounds kept for rematches; a set is rarely more than a few matchups
+BACKGROUND_CACHE_SIZE = 8
+# Match clock: Slippi's first playable frame, where the game timer starts, and
+# the clock's width on the stage name row (up to "99:59" in the 4x6 font)
+FIRST_PLAYABLE_FRAME = -39
+CLOCK_WIDTH = 20
+# Slippi's timerType for a counting-down timer
+TIMER_DECREASING = 2
+# 2P damage sparklines: left edge, size and offset from the top of each row;
+# the stock icons move left to make room
+SPARKLINE_X = 51
+SPARKLINE_WIDTH = 11
+SPARKLINE_HEIGHT = 7
+SPARKLINE_Y = 17
+# Name rows: left edge and width of the window, in pixels
+MARQUEE_X = 26
+MARQUEE_WIDTH = 36
+# Per-player fields, stored as p1_<field> .. p4_<field>
+PLAYER_FIELDS = ['color', 'bg_color', 'fg_color', 'character', 'icon_path', 'nametag',
+                 'display_name', 'perc', 'stocks']
 
 # -----------------------------------------------------------------------------
 # Square class (for example)
@@ -31,14 +77,36 @@ class Meleetrix(SampleBase):
         self.draw = ImageDraw.Draw(self.image)
         self.background = Image.new("RGB", (64, 64))
         self.background_draw = ImageDraw.Draw(self.background)
+        # Finished backgrounds by background_key, least recently used first,
+        # each with the clock origin its layout uses
+        self.background_cache = OrderedDict()
         
         # Load configuration JSON, apply to requisite fields
         self.config = json.load(open('config.json'))
+        # Matrix timing saved by calibrate.py
+        self.set_matrix_defaults(self.config.get('matrix', {}))
         # Display borders toggle; load chosen border color
         self.borders_active = self.config['colors']['borders_active']
         self.borders_rgb = tuple(self.config['colors']['borders_rgb'])
         # Four player grid view toggle
         self.grid_view = self.config['grid_view_4p']
+        # Scrolling name rows (2P and 4P list layouts)
+        self.marquee_config = self.config.get('marquee', {})
+        self.marquee_active = self.marquee_config.get('active', False)
+        # Percent-over-time sparklines in the 2P layout
+        self.sparkline_config = self.config.get('sparkline', {})
+        self.sparkline_active = self.sparkline_config.get('active', False)
+        # Settle window for percent/stock updates; on netplay only, unless
+        # netplay_only is turned off, so offline play is never delayed
+        settle_config = self.config.get('settle', {})
+        self.settle = SettleWindow(settle_config.get('frames', 4)) if settle_config.get('active', False) else None
+        self.settle_netplay_only = settle_config.get('netplay_only', True)
+        # Whether the current game's updates are held, and the server loop's
+        # timer for releasing them
+        self.settle_holding = False
+        self.settle_timer = None
+        # Match clock on the stage name row
+        self.clock_active = self.config.get('clock', {}).get('active', False)
         # General background color toggle
         self.backgrounds_active = self.config['colors']['backgrounds_active']
         # Toggles for disabling/enabling colors for characters
@@ -47,6 +115,14 @@ class Meleetrix(SampleBase):
         # Load custom character/color specific RGB pairings
         self.custom_char_bgs = self.config['colors']['custom_char_bgs']
         self.custom_char_fgs = self.config['colors']['custom_char_fgs']
+        # Character/color table and gamma LUT; built by load_assets
+        self.palette = None
+        # Set once load_assets has finished
+        self.assets_ready = threading.Event()
+        # Skips unchanged frames and limits writes to changed regions
+        self.frame_differ = None
+        # Serves the panel's frames to browsers; started by run() if active
+        self.mirror = None
 
         # Player Stock Counts
         self.p1_stocks = 4
@@ -67,6 +143,41 @@ class Meleetrix(SampleBase):
         # Splash screen and game active flags
         self.seen_splash = False
         self.game_active = False
+
+        # Held while game state is updated or drawn; re-entrant so snapshots
+        # can reuse the individual message handlers
+        self.state_lock = threading.RLock()
+        # Set when a new game arrives, so idle screens can stop early
+        self.state_changed = threading.Event()
+        # Latest Slippi frame number reported by index.js
+        self.frame = None
+        # Bumped by every gameStart/gameEnd, so state copies can tell what's new
+        self.game_seq = 0
+        self.end_seq = 0
+        # game_seq of the last game whose postgame screen has finished here
+        self.finished_seq = 0
+        # Identifies the game in progress (see game_key); None between games
+        self.current_game = None
+        # Callables run with each message once it has been applied
+        self.state_listeners = []
+        # Shared memory state from a separate ingest process, if one is used
+        self.state_reader = None
+        self.state_reader_seq = 0
+        # Writes every received message to a session file, for export.py
+        self.recorder = None
+        # LAN fan-out publisher or subscriber, if this node is either
+        self.fanout = None
+        # Thread placement, from the scheduling section of the config; the
+        # server thread sets the event once it has applied its own
+        self.scheduling = self.config.get('scheduling', {})
+        self.server_scheduled = threading.Event()
+        self.threads_before_matrix = set()
+        # Refresh rates rgbmatrix reports, with scheduling:refresh_report
+        self.refresh_monitor = None
+        # async_render only: set by every applied message, and the single
+        # thread SwapOnVSync runs on
+        self.state_event = None
+        self.swap_executor = None
         
         # Icon Paths
         self.p1_icon_path = ""
@@ -74,29 +185,214 @@ class Meleetrix(SampleBase):
         self.p3_icon_path = ""
         self.p4_icon_path = ""
         
+        # Last frame sent to the matrix, re-shown while recovering from errors
+        self.last_frame = None
+
         # Current stage
         self.stage = ""
+        self.stage_id = None
         self.stage_x_loc = 5
 
+        # Minimap layout (if enabled) and the latest [index, x, y] of each player
+        self.minimap = None
+        self.positions = []
+        # Input display layout (if enabled) and the latest inputs per port
+        self.input_display = None
+        self.inputs = {}
+        # Seconds between in-game frames
+        self.frame_interval = 0.05
+        # Current estimate and brightness limiting, with power:active
+        self.power = None
+        # Per-frame budget and quality level, with deadline:active
+        self.deadline = None
+        # Masks of in-game text, for the cached-text quality level
+        self.text_cache = {}
+        # Sparkline per player index, for 2P games with sparklines on
+        self.sparklines = {}
+        # Name row per player index, built when the game's background is
+        self.marquees = {}
+        # Starting time of a counting-down game timer (None counts up), and
+        # where the clock goes; its text is only redrawn when it changes
+        self.timer_seconds = None
+        self.clock_origin = (64 - CLOCK_WIDTH, 58)
+        self.clock_text = None
+        self.clock_tile = None
+        # Time source for animations; export.py swaps in the replay's clock
+        self.clock = time.monotonic
+
         # Game End Specific Info
         self.postgame = False
         self.winner_index = None
         self.gameEnd_method = None
+
+        # Match history: timeline of percent/stock events for the current game
+        self.match_started = None
+        self.timeline = []
+        # Opened by load_assets if match history is active
+        self.history = None
+        # Ingest/render counters and timings; only served if metrics are active
+        self.metrics = Metrics()
+        # Last line drawn on the waiting screen, and the history version it came from
+        self.history_line = ""
+        self.history_version = -1
+        # History version from the ingest process, which does the writing,
+        # when that's a separate process
+        self.shared_history_version = None
         
-        # Font objects
+        # Font objects; only the splash screen's font is loaded up front
         self.stage_font = ImageFont.load("./assets/fonts/4x6.pil")
+        self.wait_font = None
+        self.grid_font = None
+        self.font = None
+        self.winner_font = None
+
+    # load_assets: Load everything the splash screen doesn't need
+    # Runs on its own thread at startup, while the splash is showing
+    def load_assets(self):
+        # Imported here: numpy alone takes a noticeable while on a cold SD card
+        from palette import Palette
+        from history import MatchHistory
+
+        # Character/color table and gamma LUT, built once from the config
+        self.palette = Palette(self.config['colors'])
+
+        # The input display takes the place of every other layout
+        inputs_config = self.config.get('inputs', {})
+        minimap_config = self.config.get('minimap', {})
+        if inputs_config.get('active', False):
+            self.input_display = InputDisplay(self.stage_font)
+            self.frame_interval = 1.0 / inputs_config.get('fps', 60)
+        elif minimap_config.get('active', False):
+            self.minimap = Minimap()
+            self.frame_interval = 1.0 / minimap_config.get('fps', 60)
+
+        # Names need a higher frame rate to scroll smoothly
+        if self.marquee_active:
+            self.frame_interval = min(self.frame_interval, 1.0 / self.marquee_config.get('fps', 30))
+
+        power_config = self.config.get('power', {})
+        if power_config.get('active', False):
+            from power import PowerLimiter
+            self.power = PowerLimiter(power_config)
+            self.metrics.add_probe("meleetrix_power_watts", "Estimated power draw of the last frame.", lambda: round(self.power.watts, 2))
+
+        deadline_config = self.config.get('deadline', {})
+        if deadline_config.get('active', False):
+            budget = deadline_config.get('budget_ms', self.frame_interval * 1000) / 1000.0
+            self.deadline = DeadlineMonitor(budget, deadline_config.get('window', 30),
+                                            max_level=deadline_config.get('max_level', CACHED_TEXT))
+            self.metrics.add_probe("meleetrix_quality_level", "Quality level the deadline monitor has stepped down to (0 = full).",
+                                   lambda: self.deadline.level)
+
+        if self.settle is not None:
+            self.metrics.add_probe("meleetrix_settle_reverted", "Percent/stock updates undone within the settle window, never shown.",
+                                   lambda: self.settle.reverted)
+
+        diff_config = self.config.get('frame_diff', {})
+        if diff_config.get('active', True):
+            from framediff import FrameDiffer
+            self.frame_differ = FrameDiffer(diff_config.get('partial_updates', True), diff_config.get('setpixel_max', 8))
+
+        history_config = self.config.get('history', {})
+        if history_config.get('active', False):
+            self.history = MatchHistory(history_config.get('db_path', './history.db'),
+                                        history_config.get('batch_size', 16),
+                                        history_config.get('flush_interval', 1.0))
+            self.metrics.add_probe("meleetrix_history_queue_depth", "Finished games waiting for the history writer.",
+                                   self.history.pending.qsize)
+
         self.wait_font = ImageFont.load("./assets/fonts/5x7.pil")
         self.grid_font = ImageFont.load("./assets/fonts/6x10.pil")
         self.font = ImageFont.load("./assets/fonts/7x13.pil")
         self.winner_font = ImageFont.load("./assets/fonts/7x13B.pil")
 
-    # if_valid: 
+        self.assets_ready.set()
+        startup_timer.mark("assets")
+
+    # before_matrix: Runs on the render thread while still root, just before
+    # rgbmatrix starts its refresh thread and drops privileges
+    def before_matrix(self, options):
+        # Real-time policies need root, so let the server thread set its own first
+        if self.scheduling.get('server') and self.state_reader is None and not self.config.get('async_render', False):
+            self.server_scheduled.wait(1.0)
+        apply_policy("render", self.scheduling.get('render'))
+
+        if self.scheduling.get('refresh_report', False):
+            options.show_refresh_rate = 1
+            self.refresh_monitor = RefreshMonitor(self.scheduling.get('report_interval', 10))
+            self.refresh_monitor.start()
+        self.threads_before_matrix = thread_ids()
+
+    # after_matrix: Place the threads rgbmatrix started (its refresh thread)
+    def after_matrix(self):
+        refresh_settings = self.scheduling.get('refresh')
+        if refresh_settings:
+            for tid in thread_ids() - self.threads_before_matrix - python_thread_ids():
+                apply_policy("rgbmatrix refresh", refresh_settings, tid)
+
+        if self.refresh_monitor is not None:
+            self.metrics.add_probe("meleetrix_refresh_hz", "Refresh rate rgbmatrix last reported.", self.refresh_monitor.latest)
+            threading.Thread(target=self.report_refresh, daemon=True).start()
+
+    # report_refresh: Print the refresh rate rgbmatrix achieved, along with
+    # what the render loop was doing meanwhile (runs on its own thread)
+    def report_refresh(self):
+        interval = self.scheduling.get('report_interval', 10)
+        last_frames = self.metrics.frames.total()
+        while True:
+            time.sleep(interval)
+            frames = self.metrics.frames.total()
+            fps = (frames - last_frames) / float(interval)
+            last_frames = frames
+            stats = self.refresh_monitor.stats()
+            if stats is None:
+                print("Refresh: no report from rgbmatrix yet")
+                continue
+            print("Refresh: %.0f Hz mean, %.0f min, %.0f max over %ds; rendering %.1f fps (%s)"
+                  % (stats + (interval, fps, self.metrics.state)))
+
+    # animations_on: False once the deadline monitor has turned animations off
+    def animations_on(self):
+        return self.deadline is None or self.deadline.level < NO_ANIMATIONS
+
+    # borders_shown: Borders are on and the deadline monitor hasn't dropped them
+    def borders_shown(self):
+        return self.borders_active and (self.deadline is None or self.deadline.level < NO_BORDERS)
+
+    # frame_time: Seconds between in-game frames at the current quality level
+    def frame_time(self):
+        if self.deadline is not None and self.deadline.level >= LOW_FPS:
+            return self.frame_interval * 2
+        return self.frame_interval
+
+    # track_deadline: Check an in-game frame against the budget and apply any
+    # change of quality level
+    # Arguments:
+    #   seconds: Time taken by draw_in_game, SetImage and SwapOnVSync
+    def track_deadline(self, seconds):
+        if seconds > self.deadline.budget:
+            self.metrics.frame_overruns.inc()
+        borders_before = self.borders_shown()
+        if self.deadline.record(seconds) and self.borders_shown() != borders_before:
+            # Borders are part of the background
+            with self.state_lock:
+                self.load_background()
+
+    # correct_image: Colour-correct an image if the palette has been loaded
+    def correct_image(self, image):
+        if self.palette is None:
+            return image
+        return self.palette.apply(image)
+
+    # if_valid: Load a character icon, falling back to Mario if it's missing
+    # The file is read in full and closed straight away; Image.open alone is
+    # lazy and would hold a file handle for as long as the image is kept
     def if_valid(self, path):
-        if os.path.exists(path):
-            return Image.open(path)
-        else:
+        if not os.path.exists(path):
             print("Failed to open image! Provided path:", path)
-            return Image.open("./assets/icons/mario-default.png")
+            path = "./assets/icons/mario-default.png"
+        with Image.open(path) as image:
+            return image.copy()
 
     # create_icon_path: Create character icon path
     # Arguments:
@@ -117,49 +413,9 @@ class Meleetrix(SampleBase):
     #   char_color: The name of the active color
     #   char_name: The name of the active character
     def get_colors(self, char_color, char_name):
-
-        # Recreate naming convention to determine if there are custom assignments
-        color_pairing = char_name.lower() + "-" + char_color.lower()
-        
-        # First, check if the character/skin specific foreground color
-        if self.custom_foregrounds_active == True and color_pairing in self.custom_char_fgs.keys():
-            ret_colors = [tuple(self.custom_char_fgs[color_pairing])]
-        else:
-            ret_colors = [(255,255,0)]
-
-        # Check if backgrounds have been disabled in general, or if the char is using a default color
-        if self.backgrounds_active == False or char_color in ['Default', 'Black']:
-            ret_colors.append((0, 0, 0))
-        # Then, check if the active character has a custom background color
-        elif self.custom_backgrounds_active == True and color_pairing in self.custom_char_bgs.keys():
-            ret_colors.append(tuple(self.custom_char_bgs[color_pairing]))
-        # Otherwise, check for the remaining generic colors
-        elif char_color == 'Red':
-            ret_colors.append((102, 0, 0))
-        elif char_color == 'Blue':
-            ret_colors.append((102, 102, 255))
-        elif char_color == 'Green':
-            ret_colors.append((0, 153, 56))
-        elif char_color == 'White':
-            ret_colors.append((130, 130, 130))
-        elif char_color == 'Yellow':
-            ret_colors.append((117, 106, 45))
-        elif char_color == 'Purple':
-            ret_colors.append((37, 12, 46))
-        # Pikachu-specific
-        elif char_color == "Party Hat":
-            ret_colors.append((102, 102, 255))
-        # Pikachu-specific
-        elif char_color == "Cowboy Hat":
-            ret_colors.append((0, 153, 56))
-        # Puff-specific
-        elif char_color == "Crown":
-            ret_colors.append((133, 103, 27))
-        # Puff-specific
-        elif char_color == "Headband":
-            ret_colors.append((7, 125, 94))
-            
-        return ret_colors
+        # Pairings are resolved when the palette is built; this is a table lookup
+        fg_color, bg_color = self.palette.lookup(char_color, char_name)
+        return [fg_color, bg_color]
 
     # perc_loc_determ: Determine the x-axis location of the percentage
     # Arguments:
@@ -181,23 +437,195 @@ class Meleetrix(SampleBase):
         elif len(curr_percent) == 4:
             return 30
     
+    # push_frame: Colour-correct a finished frame and swap it onto the matrix
+    # Arguments:
+    #   offscreen_canvas: The canvas to draw the frame to
+    #   image: The PIL image holding the finished frame
+    # Returns:
+    #   The canvas to draw the next frame to (unchanged if the swap was skipped)
+    def push_frame(self, offscreen_canvas, image):
+        frame = self.stage_frame(offscreen_canvas, image)
+        if frame is None:
+            return offscreen_canvas
+        swap_start = time.perf_counter()
+        next_canvas = self.matrix.SwapOnVSync(offscreen_canvas)
+        return self.frame_swapped(offscreen_canvas, next_canvas, image, frame, swap_start)
+
+    # push_frame_async: push_frame for async_render; only the swap, which
+    # blocks until the next vsync, runs off the event loop
+    async def push_frame_async(self, offscreen_canvas, image):
+        frame = self.stage_frame(offscreen_canvas, image)
+        if frame is None:
+            return offscreen_canvas
+        swap_start = time.perf_counter()
+        next_canvas = await asyncio.get_event_loop().run_in_executor(
+            self.swap_executor, self.matrix.SwapOnVSync, offscreen_canvas)
+        return self.frame_swapped(offscreen_canvas, next_canvas, image, frame, swap_start)
+
+    # stage_frame: Write a finished frame to the offscreen canvas
+    # Returns:
+    #   The colour-corrected frame, or None if nothing changed since the last
+    #   swap and the panel can be left alone
+    def stage_frame(self, offscreen_canvas, image):
+        set_start = time.perf_counter()
+        frame = self.correct_image(image)
+        if self.power is not None:
+            # Idle screens are dimmed; anything over the current budget is too
+            brightness = getattr(getattr(self, 'args', None), 'led_brightness', 100)
+            frame = self.power.limit(frame, brightness, idle=self.metrics.state == "waiting")
+        if self.frame_differ is None:
+            offscreen_canvas.SetImage(frame, 0, 0)
+        else:
+            mode = self.frame_differ.write(offscreen_canvas, frame)
+            if mode == 'skip':
+                self.metrics.frames_skipped.inc()
+                return None
+            if mode != 'full':
+                self.metrics.partial_updates.inc()
+        self.metrics.set_image_time.observe(time.perf_counter() - set_start)
+        return frame
+
+    # frame_swapped: Bookkeeping once a staged frame is on the panel
+    # Returns:
+    #   The canvas to draw the next frame to
+    def frame_swapped(self, shown_canvas, next_canvas, image, frame, swap_start):
+        self.metrics.swap_time.observe(time.perf_counter() - swap_start)
+        if self.frame_differ is not None:
+            self.frame_differ.swapped()
+        self.metrics.frames.inc()
+        # Browsers get the frame before gamma correction, which is for the LEDs
+        if self.mirror is not None:
+            self.mirror.publish(image)
+        # Keep a private copy; callers keep drawing into their image
+        self.last_frame = frame.copy()
+        return next_canvas
+
+    # canvas_changed: Call after drawing to the matrix/canvases outside push_frame
+    def canvas_changed(self):
+        if self.frame_differ is not None:
+            self.frame_differ.forget()
+
+    # show_last_frame: Put the last good frame back on the matrix after an error
+    # Arguments:
+    #   offscreen_canvas: The canvas to draw the frame to
+    # Returns:
+    #   The canvas to use for the next frame
+    def show_last_frame(self, offscreen_canvas):
+        if self.last_frame is None:
+            return offscreen_canvas
+        self.canvas_changed()
+        try:
+            offscreen_canvas.SetImage(self.last_frame, 0, 0)
+            return self.matrix.SwapOnVSync(offscreen_canvas)
+        except Exception:
+            traceback.print_exc()
+            return offscreen_canvas
+
     # Clear the matrix through creating a black rectangle
     def Clear_Image(self):
         self.draw.rectangle((0, 0, 63, 63), fill=(0, 0, 0), outline=(0, 0, 0))
 
-    # create_background
+    # background_key: Everything the static background depends on
+    # Returns:
+    #   A hashable key; games with equal keys have identical backgrounds
+    def background_key(self):
+        players = tuple((index, getattr(self, "p" + str(index + 1) + "_icon_path"),
+                         tuple(getattr(self, "p" + str(index + 1) + "_bg_color")))
+                        for index in self.active_indexes)
+        return (self.minimap is not None, self.input_display is not None, self.clock_active, self.player_count, self.grid_view, self.borders_shown(),
+                self.borders_rgb, self.stage, self.stage_x_loc, self.stage_id, players)
+
+    # create_background: Set up the static layer for a new game, reusing the
+    # finished background of an earlier game with the same matchup
     def create_background(self):
+
+        # Per-game state that isn't part of the image
+        if self.input_display is not None:
+            self.input_display.set_players(self.active_indexes)
+        elif self.minimap is not None:
+            self.minimap.set_stage(self.stage_id)
+        else:
+            # Name rows are drawn into strips once per game
+            self.create_marquees()
+
+        self.load_background()
+
+    # load_background: Use the cached background for the current game, drawing
+    # it first if there isn't one
+    def load_background(self):
+        key = self.background_key()
+        cached = self.background_cache.get(key)
+        if cached is not None:
+            self.background_cache.move_to_end(key)
+            # The clock's spot is set while drawing, so it's kept alongside
+            self.background, self.clock_origin = cached
+            self.background_draw = ImageDraw.Draw(self.background)
+            return
+
+        self.draw_background()
+        # Only ever copied from once finished, so the cached image can be shared
+        self.background_cache[key] = (self.background, self.clock_origin)
+        if len(self.background_cache) > BACKGROUND_CACHE_SIZE:
+            self.background_cache.popitem(last=False)
+
+    # draw_stage_name: Stage name row of the background; with the clock on, the
+    # name moves left (shortened if needed) to leave the clock room on the right
+    # Arguments:
+    #   row_y: Top of the row, in pixels
+    def draw_stage_name(self, row_y):
+        if self.clock_active:
+            self.clock_origin = (64 - CLOCK_WIDTH, row_y)
+            name = self.stage[:(64 - CLOCK_WIDTH) // 4]
+            self.background_draw.text((0, row_y), name, font=self.stage_font, fill=(255, 255, 255, 255))
+        else:
+            self.background_draw.text((self.stage_x_loc, row_y), self.stage, font=self.stage_font, fill=(255, 255, 255, 255))
+
+    # clock_str: Game timer as shown in game, from the latest frame number
+    # Returns:
+    #   "M:SS"; counts down from the starting time for timed games, else up
+    def clock_str(self):
+        elapsed = 0 if self.frame is None else max(0, self.frame - FIRST_PLAYABLE_FRAME)
+        if self.timer_seconds:
+            # Melee shows the starting time for the whole first second
+            seconds = (max(0, self.timer_seconds * 60 - elapsed) + 59) // 60
+        else:
+            seconds = elapsed // 60
+        return "%d:%02d" % divmod(seconds, 60)
+
+    # draw_clock: Paste the clock over its spot on the stage name row; its
+    # text is only drawn again when the shown second changes
+    def draw_clock(self):
+        text = self.clock_str()
+        if text != self.clock_text:
+            self.clock_tile = Image.new("RGB", (CLOCK_WIDTH, 6))
+            ImageDraw.Draw(self.clock_tile).text((CLOCK_WIDTH - 4 * len(text), 0), text, font=self.stage_font, fill=(255, 255, 255))
+            self.clock_text = text
+        Image.Image.paste(self.image, self.clock_tile, self.clock_origin)
+
+    # draw_background: Draw the static layer (icons, rectangles, borders and
+    # stage name) for the current game
+    def draw_background(self):
         
         # Reset background values
         self.background = Image.new("RGB", (64, 64))
         self.background_draw = ImageDraw.Draw(self.background)
-        
+
+        # Input display layout: the display keeps its own image
+        if self.input_display is not None:
+            return
+
+        # Minimap layout: stage outline and name; players are drawn per frame
+        if self.minimap is not None:
+            self.minimap.draw_stage(self.background_draw)
+            self.draw_stage_name(58)
+            return
+
         # ---------------------------------------------------------------------
         # Drawing indexes based on no. of players
         if self.player_count == 2:
 
             # First, check if borders are active
-            if self.borders_active == True:
+            if self.borders_shown():
                 self.background_draw.rectangle((0, 0, 63, 50), fill=(0, 0, 0, 0), outline=self.borders_rgb)
                 self.background_draw.rectangle((0, 0, 63, 25), fill=(0, 0, 0, 0), outline=self.borders_rgb)
 
@@ -233,7 +661,7 @@ class Meleetrix(SampleBase):
                     Image.Image.paste(self.background, icon, (1, 26))
 
             # Finally, adding stage name
-            self.background_draw.text((self.stage_x_loc, 54), self.stage, font=self.stage_font, fill=(255, 255, 255, 255))
+            self.draw_stage_name(54)
 
         
         # Drawing indexes based on no. of players
@@ -242,7 +670,7 @@ class Meleetrix(SampleBase):
             newsize = (16, 16)
 
             # First, check if borders are active
-            if self.borders_active == True:
+            if self.borders_shown():
                 self.background_draw.rectangle((0, 0, 63, 51), fill=(0, 0, 0, 0), outline=self.borders_rgb)
                 self.background_draw.rectangle((0, 0, 63, 34), fill=(0, 0, 0, 0), outline=self.borders_rgb)
                 self.background_draw.rectangle((0, 0, 63, 17), fill=(0, 0, 0, 0), outline=self.borders_rgb)
@@ -285,7 +713,7 @@ class Meleetrix(SampleBase):
                     Image.Image.paste(self.background, icon, (1, 35))
             
             # Finally, adding stage name
-            self.background_draw.text((self.stage_x_loc, 55), self.stage, font=self.stage_font, fill=(255, 255, 255, 255))
+            self.draw_stage_name(55)
         
         # Four player background, bar view
         elif self.player_count == 4 and self.grid_view == False:
@@ -293,7 +721,7 @@ class Meleetrix(SampleBase):
             newsize = (13, 13)
 
             # First, check if borders are active
-            if self.borders_active == True:
+            if self.borders_shown():
                 self.background_draw.rectangle((0, 0, 63, 56), fill=(0, 0, 0, 0), outline=self.borders_rgb)
                 self.background_draw.rectangle((0, 0, 63, 42), fill=(0, 0, 0, 0), outline=self.borders_rgb)
                 self.background_draw.rectangle((0, 0, 63, 28), fill=(0, 0, 0, 0), outline=self.borders_rgb)
@@ -343,7 +771,7 @@ class Meleetrix(SampleBase):
                     Image.Image.paste(self.background, icon, (1, 43))
             
             # Finally, adding stage name
-            self.background_draw.text((self.stage_x_loc, 58), self.stage, font=self.stage_font, fill=(255, 255, 255, 255))
+            self.draw_stage_name(58)
 
         # Four player background, grid view
         elif self.player_count == 4 and self.grid_view == True:
@@ -397,7 +825,107 @@ class Meleetrix(SampleBase):
                     Image.Image.paste(self.background, icon, (33, 29))
                 
             # Finally, adding stage name
-            self.background_draw.text((self.stage_x_loc, 56), self.stage, font=self.stage_font, fill=(255, 255, 255, 255))
+            self.draw_stage_name(56)
+
+    # marquee_text: Name to scroll for a player
+    # Arguments:
+    #   index: Player index (0-3)
+    # Returns:
+    #   The Slippi display name and/or nametag, per marquee:text; may be ""
+    def marquee_text(self, index):
+        prefix = "p" + str(index + 1) + "_"
+        display_name = getattr(self, prefix + "display_name", "") or ""
+        nametag = getattr(self, prefix + "nametag", "") or ""
+        show = self.marquee_config.get('text', 'display_name')
+        if show == 'nametag':
+            return nametag or display_name
+        if show == 'both' and display_name and nametag:
+            return display_name + " (" + nametag + ")"
+        return display_name or nametag
+
+    # create_marquees: Render each player's name strip for the new game
+    def create_marquees(self):
+        self.marquees = {}
+        if not self.marquee_active:
+            return
+        # Only the 2P and 4P list layouts have room for a name row
+        if self.player_count != 2 and not (self.player_count == 4 and self.grid_view == False):
+            return
+        start = self.clock()
+        for index in self.active_indexes:
+            text = self.marquee_text(index)
+            if text:
+                prefix = "p" + str(index + 1) + "_"
+                self.marquees[index] = Marquee(text, self.stage_font, MARQUEE_WIDTH, getattr(self, prefix + "fg_color"),
+                                               getattr(self, prefix + "bg_color"), self.marquee_config.get('speed', 15), start)
+
+    # draw_text: Draw in-game text; at the cached-text quality level each
+    # string is rendered to a mask once and filled with its color from then on
+    def draw_text(self, xy, text, font, fill):
+        if self.deadline is None or self.deadline.level < CACHED_TEXT:
+            self.draw.text(xy, text, font=font, fill=fill)
+            return
+        key = (text, id(font))
+        mask = self.text_cache.get(key)
+        if mask is None:
+            # Percents, stocks and names: a few hundred strings at most
+            if len(self.text_cache) > 512:
+                self.text_cache.clear()
+            size = font.getsize(text) if hasattr(font, "getsize") else font.getbbox(text)[2:]
+            mask = self.text_cache[key] = Image.new("L", size)
+            ImageDraw.Draw(mask).text((0, 0), text, font=font, fill=255)
+        self.image.paste(tuple(fill), xy, mask)
+
+    # draw_percent_2p: Percent for a 2P row, moved down under the name row if there is one
+    def draw_percent_2p(self, player, perc_loc, row_y, percentage, foreground_rgb):
+        if player in self.marquees:
+            Image.Image.paste(self.image, self.marquee_window(player), (MARQUEE_X, row_y - 1))
+            row_y += 3
+        self.draw_text((perc_loc, row_y), percentage, self.font, foreground_rgb)
+
+    # draw_sparkline: Paste a player's sparkline beside their stocks (2P layout)
+    # Arguments:
+    #   player: Player index (0-3)
+    #   row_top: Top of the player's row, in pixels
+    def draw_sparkline(self, player, row_top):
+        sparkline = self.sparklines.get(player)
+        if sparkline is not None:
+            prefix = "p" + str(player + 1) + "_"
+            tile = sparkline.image(getattr(self, prefix + "fg_color"), getattr(self, prefix + "bg_color"))
+            Image.Image.paste(self.image, tile, (SPARKLINE_X, row_top + SPARKLINE_Y))
+
+    # marquee_window: A player's name row as it should look right now; frozen
+    # at its start once animations are turned off
+    def marquee_window(self, player):
+        marquee = self.marquees[player]
+        return marquee.window(self.clock() if self.animations_on() else marquee.start)
+
+    # draw_percent_list: Percent for a 4P list row; with a name row above it,
+    # the smaller font is used so both fit
+    def draw_percent_list(self, player, perc_loc, row_y, percentage, foreground_rgb):
+        if player in self.marquees:
+            Image.Image.paste(self.image, self.marquee_window(player), (MARQUEE_X, row_y))
+            self.draw_text((62 - 5 * len(percentage), row_y + 6), percentage, self.wait_font, foreground_rgb)
+        else:
+            self.draw_text((perc_loc, row_y), percentage, self.font, foreground_rgb)
+
+    # draw_minimap: Minimap layout; percents and stocks along the top, then
+    # a dot per player on the stage outline
+    def draw_minimap(self):
+        slot_width = 64 // max(1, len(self.active_indexes))
+        for slot, index in enumerate(self.active_indexes):
+            prefix = "p" + str(index + 1) + "_"
+            slot_x = slot * slot_width
+            self.draw_text((slot_x + 1, 0), getattr(self, prefix + "perc"), self.stage_font, PORT_COLORS[index])
+            for stock in range(getattr(self, prefix + "stocks")):
+                self.draw.point((slot_x + 1 + stock * 2, 7), fill=PORT_COLORS[index])
+        self.minimap.draw_players(self.draw, self.positions)
+
+    # draw_inputs: Input display layout; a cell per port, with only the parts
+    # whose input changed drawn again
+    def draw_inputs(self):
+        self.input_display.update(self.inputs)
+        Image.Image.paste(self.image, self.input_display.image, (0, 0))
 
     # draw_in_game
     def draw_in_game(self):
@@ -405,6 +933,17 @@ class Meleetrix(SampleBase):
         # Reset the active image to the current background image
         self.image = self.background.copy()
         self.draw = ImageDraw.Draw(self.image)
+
+        if self.input_display is not None:
+            self.draw_inputs()
+            return
+
+        if self.clock_active:
+            self.draw_clock()
+
+        if self.minimap is not None:
+            self.draw_minimap()
+            return
         
 
         # Add default variables for active players
@@ -549,25 +1088,29 @@ class Meleetrix(SampleBase):
                     perc_loc = p4_perc_loc
 
                 # Iterating over list of indexes, and assigning locations based on which player listed first
+                # Stocks sit left of the sparkline, if there is one
+                stock_x = 27 if player in self.sparklines else 33
                 if idx == 0:
                     # First Player Stock Icons
-                    self.draw.rectangle((33, 18, 36, 21), fill=stockOne_fill, outline=foreground_rgb)
-                    self.draw.rectangle((39, 18, 42, 21), fill=stockTwo_fill, outline=foreground_rgb)
-                    self.draw.rectangle((45, 18, 48, 21), fill=stockThree_fill, outline=foreground_rgb)
-                    self.draw.rectangle((51, 18, 54, 21), fill=stockFour_fill, outline=foreground_rgb)
+                    self.draw.rectangle((stock_x, 18, stock_x + 3, 21), fill=stockOne_fill, outline=foreground_rgb)
+                    self.draw.rectangle((stock_x + 6, 18, stock_x + 9, 21), fill=stockTwo_fill, outline=foreground_rgb)
+                    self.draw.rectangle((stock_x + 12, 18, stock_x + 15, 21), fill=stockThree_fill, outline=foreground_rgb)
+                    self.draw.rectangle((stock_x + 18, 18, stock_x + 21, 21), fill=stockFour_fill, outline=foreground_rgb)
+                    self.draw_sparkline(player, 0)
 
                     # Percentage Text
-                    self.draw.text((perc_loc, 3), percentage, font=self.font, fill=foreground_rgb)
+                    self.draw_percent_2p(player, perc_loc, 3, percentage, foreground_rgb)
 
                 elif idx == 1:
                     # Second Player Stock Icons
-                    self.draw.rectangle((33, 43, 36, 46), fill=stockOne_fill, outline=foreground_rgb)
-                    self.draw.rectangle((39, 43, 42, 46), fill=stockTwo_fill, outline=foreground_rgb)
-                    self.draw.rectangle((45, 43, 48, 46), fill=stockThree_fill, outline=foreground_rgb)
-                    self.draw.rectangle((51, 43, 54, 46), fill=stockFour_fill, outline=foreground_rgb)
+                    self.draw.rectangle((stock_x, 43, stock_x + 3, 46), fill=stockOne_fill, outline=foreground_rgb)
+                    self.draw.rectangle((stock_x + 6, 43, stock_x + 9, 46), fill=stockTwo_fill, outline=foreground_rgb)
+                    self.draw.rectangle((stock_x + 12, 43, stock_x + 15, 46), fill=stockThree_fill, outline=foreground_rgb)
+                    self.draw.rectangle((stock_x + 18, 43, stock_x + 21, 46), fill=stockFour_fill, outline=foreground_rgb)
+                    self.draw_sparkline(player, 25)
 
                     # Percentage Text
-                    self.draw.text((perc_loc, 28), percentage, font=self.font, fill=foreground_rgb)
+                    self.draw_percent_2p(player, perc_loc, 28, percentage, foreground_rgb)
         
         # ---------------------------------------------------------------------
         # Drawing indexes based on no. of players
@@ -628,7 +1171,7 @@ class Meleetrix(SampleBase):
                     self.draw.rectangle((47, 12, 49, 14), fill=stockFour_fill, outline=foreground_rgb)
 
                     # Percentage Text
-                    self.draw.text((perc_loc, 3), percentage, font=self.wait_font, fill=foreground_rgb)
+                    self.draw_text((perc_loc, 3), percentage, self.wait_font, foreground_rgb)
 
                 elif idx == 1:
                     # Background Rectangle
@@ -640,7 +1183,7 @@ class Meleetrix(SampleBase):
                     self.draw.rectangle((47, 29, 49, 31), fill=stockFour_fill, outline=foreground_rgb)
 
                     # Percentage Text
-                    self.draw.text((perc_loc, 20), percentage, font=self.wait_font, fill=foreground_rgb)
+                    self.draw_text((perc_loc, 20), percentage, self.wait_font, foreground_rgb)
                 
                 elif idx == 2:
                     # Background Rectangle
@@ -652,7 +1195,7 @@ class Meleetrix(SampleBase):
                     self.draw.rectangle((47, 46, 49, 48), fill=stockFour_fill, outline=foreground_rgb)
 
                     # Percentage Text
-                    self.draw.text((perc_loc, 37), percentage, font=self.wait_font, fill=foreground_rgb)
+                    self.draw_text((perc_loc, 37), percentage, self.wait_font, foreground_rgb)
         
         # ---------------------------------------------------------------------
         # Drawing indexes based on no. of players
@@ -707,7 +1250,7 @@ class Meleetrix(SampleBase):
                     self.draw.rectangle((16, 8, 19, 11), fill=stockThree_fill, outline=foreground_rgb)
                     self.draw.rectangle((21, 8, 24, 11), fill=stockFour_fill, outline=foreground_rgb)
                     # Percentage Text
-                    self.draw.text((perc_loc, 1), percentage, font=self.font, fill=foreground_rgb)
+                    self.draw_percent_list(player, perc_loc, 1, percentage, foreground_rgb)
 
                 elif idx == 1:
                     # Second Player Stock Icons
@@ -716,7 +1259,7 @@ class Meleetrix(SampleBase):
                     self.draw.rectangle((16, 22, 19, 25), fill=stockThree_fill, outline=foreground_rgb)
                     self.draw.rectangle((21, 22, 24, 25), fill=stockFour_fill, outline=foreground_rgb)
                     # Percentage Text
-                    self.draw.text((perc_loc, 15), percentage, font=self.font, fill=foreground_rgb)                    
+                    self.draw_percent_list(player, perc_loc, 15, percentage, foreground_rgb)                    
                 elif idx == 2:
                     # Third Player Stock Icons
                     self.draw.rectangle((16, 31, 19, 34), fill=stockOne_fill, outline=foreground_rgb)
@@ -724,7 +1267,7 @@ class Meleetrix(SampleBase):
                     self.draw.rectangle((16, 36, 19, 39), fill=stockThree_fill, outline=foreground_rgb)
                     self.draw.rectangle((21, 36, 24, 39), fill=stockFour_fill, outline=foreground_rgb)
                     # Percentage Text
-                    self.draw.text((perc_loc, 29), percentage, font=self.font, fill=foreground_rgb)
+                    self.draw_percent_list(player, perc_loc, 29, percentage, foreground_rgb)
 
                 elif idx == 3:
                     # Fourth Player Stock Icons
@@ -733,7 +1276,7 @@ class Meleetrix(SampleBase):
                     self.draw.rectangle((16, 50, 19, 53), fill=stockThree_fill, outline=foreground_rgb)
                     self.draw.rectangle((21, 50, 24, 53), fill=stockFour_fill, outline=foreground_rgb)
                     # Percentage Text
-                    self.draw.text((perc_loc, 43), percentage, font=self.font, fill=foreground_rgb)
+                    self.draw_percent_list(player, perc_loc, 43, percentage, foreground_rgb)
                 
         # -------------------------------------------------------------
         # Grid View
@@ -788,7 +1331,7 @@ class Meleetrix(SampleBase):
                     self.draw.rectangle((19, 10, 22, 13), fill=stockThree_fill, outline=foreground_rgb)
                     self.draw.rectangle((25, 10, 28, 13), fill=stockFour_fill, outline=foreground_rgb)
                     # Percentage Text
-                    self.draw.text((perc_loc, 16), percentage, font=self.grid_font, fill=foreground_rgb)
+                    self.draw_text((perc_loc, 16), percentage, self.grid_font, foreground_rgb)
 
                 elif idx == 1:
                     # Second Player Stock Icons
@@ -797,7 +1340,7 @@ class Meleetrix(SampleBase):
                     self.draw.rectangle((50, 10, 53, 13), fill=stockThree_fill, outline=foreground_rgb)
                     self.draw.rectangle((56, 10, 59, 13), fill=stockFour_fill, outline=foreground_rgb)
                     # Percentage Text
-                    self.draw.text((perc_loc, 16), percentage, font=self.grid_font, fill=foreground_rgb)
+                    self.draw_text((perc_loc, 16), percentage, self.grid_font, foreground_rgb)
                                         
                 elif idx == 2:
                     # Third Player Stock Icons
@@ -806,7 +1349,7 @@ class Meleetrix(SampleBase):
                     self.draw.rectangle((19, 37, 22, 40), fill=stockThree_fill, outline=foreground_rgb)
                     self.draw.rectangle((25, 37, 28, 40), fill=stockFour_fill, outline=foreground_rgb)
                     # Percentage Text
-                    self.draw.text((perc_loc, 43), percentage, font=self.grid_font, fill=foreground_rgb)
+                    self.draw_text((perc_loc, 43), percentage, self.grid_font, foreground_rgb)
                 
                 elif idx == 3:
                     # Fourth Player Stock Icons
@@ -815,7 +1358,7 @@ class Meleetrix(SampleBase):
                     self.draw.rectangle((50, 37, 53, 40), fill=stockThree_fill, outline=foreground_rgb)
                     self.draw.rectangle((56, 37, 59, 40), fill=stockFour_fill, outline=foreground_rgb)
                     # Percentage Text
-                    self.draw.text((perc_loc, 43), percentage, font=self.grid_font, fill=foreground_rgb)
+                    self.draw_text((perc_loc, 43), percentage, self.grid_font, foreground_rgb)
 
     # stagename_checker
     def stagename_checker(self, curr_stage):    
@@ -865,8 +1408,78 @@ class Meleetrix(SampleBase):
         else:
             return 0
 
-    # Waiting for game state
-    def state_waiting(self, offscreen_canvas):
+    # timeline_event: Note a percent/stock change for the match history
+    # Arguments:
+    #   index: Player index (0-3)
+    #   kind: 'percent' or 'stocks'
+    #   value: The new value
+    def timeline_event(self, index, kind, value):
+        if self.history is not None and self.match_started is not None:
+            self.timeline.append([round(time.time() - self.match_started, 2), index, kind, value])
+
+    # record_match: Queue the game that just ended for the history writer
+    def record_match(self):
+        if self.history is None or self.match_started is None:
+            return
+
+        players = []
+        for index in self.active_indexes:
+            prefix = "p" + str(index + 1) + "_"
+            players.append({
+                'port': index,
+                'nametag': getattr(self, prefix + 'nametag'),
+                'display_name': getattr(self, prefix + 'display_name'),
+                'character': getattr(self, prefix + 'character'),
+                'color': getattr(self, prefix + 'color'),
+                'stocks': getattr(self, prefix + 'stocks'),
+                'percent': getattr(self, prefix + 'perc'),
+            })
+
+        self.history.record({
+            'started_at': self.match_started,
+            'ended_at': time.time(),
+            'stage': self.stage,
+            'is_teams': self.is_teams,
+            'winner_port': self.winner_index,
+            'end_method': self.gameEnd_method,
+            'timeline': self.timeline,
+            'players': players,
+        })
+        self.match_started = None
+
+    # last_result_str: Short summary of the last game for the waiting screen
+    # Returns:
+    #   e.g. "Fox 3-1 Falco" (head-to-head for 1v1s), or "" without history
+    def last_result_str(self):
+        if self.history is None:
+            return ""
+        # Only hit the database when the writer has committed something new
+        version = self.history.version if self.shared_history_version is None else self.shared_history_version
+        if version != self.history_version:
+            self.history_version = version
+            recent = self.history.recent_results(1)
+            if len(recent) == 0:
+                self.history_line = ""
+            elif len(recent[0]['players']) == 2 and recent[0]['players'][0]['player'] != recent[0]['players'][1]['player']:
+                player_a, player_b = recent[0]['players']
+                wins_a, wins_b = self.history.head_to_head(player_a['player'], player_b['player'])
+                # The nametag, else the character; cut to five characters so
+                # the line fits the panel's 16 columns
+                label_a = (player_a['nametag'] or player_a['character'])[:5]
+                label_b = (player_b['nametag'] or player_b['character'])[:5]
+                self.history_line = label_a + " " + str(wins_a) + "-" + str(wins_b) + " " + label_b
+            else:
+                # Also mirror matches between two unnamed players, which have
+                # no head-to-head record of their own
+                winners = [p['nametag'] or p['character'] for p in recent[0]['players'] if p['won']]
+                self.history_line = ("Last: " + winners[0])[:15] if winners else ""
+        return self.history_line
+
+    # draw_waiting: Draw one step of the waiting screen to the main image
+    # Arguments:
+    #   waitloop: Step of the ellipsis animation (0-3)
+    #   history_str: Last result/head-to-head line, or "" for none
+    def draw_waiting(self, waitloop, history_str):
         # Create needed strings and variables
         wait_str = "Waiting"
         forgame_str = "for game"
@@ -875,26 +1488,45 @@ class Meleetrix(SampleBase):
         forgame_x = 5
         forgame_y = 31
         ellipsis_arr = ["", ".", "..", "..."]
+        history_x = self.stage_loc_determ(history_str)
+        history_y = 47
 
+        # Clear matrix, update elipsis_str based on loop
+        self.Clear_Image()
+        ellipsis_str = ellipsis_arr[waitloop]
+
+        # Drawing the text graphics
+        self.draw.text((waiting_x, waiting_y), wait_str, font=self.wait_font, fill=(255, 255, 255, 255))
+        self.draw.text((forgame_x, forgame_y), forgame_str + ellipsis_str, font=self.wait_font, fill=(255, 255, 255, 255))
+        if history_str:
+            self.draw.text((history_x, history_y), history_str, font=self.stage_font, fill=(150, 150, 150, 255))
+
+    # begin_waiting: Set up the waiting screen
+    # Returns:
+    #   Last result/head-to-head line, if match history is enabled
+    def begin_waiting(self):
+        history_str = self.last_result_str()
         # Clear matrix (needed if coming from postgame screen)
         self.Clear_Image()
+        self.state_changed.clear()
+        return history_str
+
+    # Waiting for game state
+    def state_waiting(self, offscreen_canvas):
+        history_str = self.begin_waiting()
         
         # Update the ellipsis str based on the current value 
         for waitloop in range(0,4):
-            
-            # Clear matrix, update elipsis_str based on loop
-            self.Clear_Image()
-            ellipsis_str = ellipsis_arr[waitloop]
-
-            # Drawing the text graphics, updating matrix, wait, clear
-            self.draw.text((waiting_x, waiting_y), wait_str, font=self.wait_font, fill=(255, 255, 255, 255))
-            self.draw.text((forgame_x, forgame_y), forgame_str + ellipsis_str, font=self.wait_font, fill=(255, 255, 255, 255))
+            self.draw_waiting(waitloop, history_str)
             
             # Set matrix screen to updated waiting image
-            offscreen_canvas.SetImage(self.image, 0, 0)
-            self.matrix.SwapOnVSync(offscreen_canvas)
+            offscreen_canvas = self.push_frame(offscreen_canvas, self.image)
+
+            # Leave straight away if a game starts mid-animation
+            if self.wait_for_change(.5):
+                break
 
-            time.sleep(.5)
+        return offscreen_canvas
 
     # At start of game
     def state_start_game(self):
@@ -903,65 +1535,211 @@ class Meleetrix(SampleBase):
         # If a game was active on boot, don't need to show the splash screen
         self.seen_splash = True
         # Create background image that contains static info
-        self.create_background()
+        with self.state_lock:
+            self.create_background()
         
-    
+    # draw_game_frame: Draw the in-game screen for one frame
+    # Returns:
+    #   perf_counter() time drawing started, for pacing
+    def draw_game_frame(self):
+        # Draw player stocks and other shapes
+        draw_start = time.perf_counter()
+        with self.state_lock:
+            self.draw_in_game()
+        self.metrics.draw_time.observe(time.perf_counter() - draw_start)
+        return draw_start
+
+    # finish_game_frame: Bookkeeping once a frame is on the panel
+    # Returns:
+    #   Seconds left of the frame, to wait out so the rate stays steady
+    def finish_game_frame(self, draw_start):
+        if self.deadline is not None:
+            self.track_deadline(time.perf_counter() - draw_start)
+        return max(0, self.frame_time() - (time.perf_counter() - draw_start))
+
     # While in game (two-player match)
     def state_game_active(self, offscreen_canvas):
+        draw_start = self.draw_game_frame()
 
-        # Draw player stocks and other shapes
-        self.draw_in_game()
+        # Draw PIL image to offscreen_canvas (stocks and background rects.),
+        # wait out the rest of the frame so the rate stays steady
+        offscreen_canvas = self.push_frame(offscreen_canvas, self.image)
+        time.sleep(self.finish_game_frame(draw_start))
+        return offscreen_canvas
 
-        # Draw PIL image to offscreen_canvas (stocks and background rects.)
-        offscreen_canvas.SetImage(self.image, 0, 0)
+    # load_shine: Load shine.png (splash screen)
+    def load_shine(self):
+        with Image.open("./assets/splash/shine.png") as shine_file:
+            return shine_file.convert('RGB')
+
+    # draw_shine: One step of the growing shine, drawn straight to the matrix
+    # Arguments:
+    #   shine_png: From load_shine
+    #   size: Width of the shine this step (1-30)
+    # Returns:
+    #   The resized shine, for draw_splash_text
+    def draw_shine(self, shine_png, size):
+        # Clear matrix, resize shine image for the current loop
+        resized_shine = shine_png.resize((size, int(size*1.2)))
+        self.matrix.Clear()
+
+        # Set image directly to matrix canvas
+        self.matrix.SetImage(self.correct_image(resized_shine), (32-int(size/2)), (22-int(size/2)))
+        if size == 1:
+            startup_timer.mark("first frame")
+        return resized_shine
+
+    # draw_splash_text: One step of the title fading in under the shine
+    # Arguments:
+    #   resized_shine: Last shine from draw_shine
+    #   step: 0-24, darkest to brightest
+    def draw_splash_text(self, resized_shine, step):
+        # Val used to minimize number of refreshes
+        val = step*10
+        size = resized_shine.width
+        Image.Image.paste(self.image, resized_shine, ((32-int(size/2)), (22-int(size/2))))
+        self.draw.text((6, 50), "Meleetrix 1.0", font=self.stage_font, fill=(val, val, val, val))
+
+    # finish_splash: Leave the splash screen (once the assets are ready)
+    def finish_splash(self):
+        # Clear matrix
+        self.Clear_Image()
+        # The shine was drawn straight to the matrix
+        self.canvas_changed()
 
-        # Draw to offscreen canvas, wait for short period
-        offscreen_canvas = self.matrix.SwapOnVSync(offscreen_canvas )
-        time.sleep(.05)
+        # Set splash to true
+        self.seen_splash = True
 
     def state_splash(self, offscreen_canvas):
-        # Load shine.png (splash screen) 
-        shine_png = Image.open("./assets/splash/shine.png").convert('RGB')
+        shine_png = self.load_shine()
         
         # Start small, get bigger
         for size in range(1, 31):
-            
-            # Clear matrix, resize shine image for the current loop
-            resized_shine = shine_png.resize((size, int(size*1.2)))
-            self.matrix.Clear()
-
-            # Set image directly to matrix canvas and sleep
-            self.matrix.SetImage(resized_shine, (32-int(size/2)), (22-int(size/2)))
+            resized_shine = self.draw_shine(shine_png, size)
             time.sleep(0.012)
 
         # Gradually make text brighter
-        for x in range(0,25):
-            # Val used to minimize number of refreshes
-            val = x*10
-
-            Image.Image.paste(self.image, resized_shine, ((32-int(size/2)), (22-int(size/2))))
-            self.draw.text((6, 50), "Meleetrix 1.0", font=self.stage_font, fill=(val, val, val, val))
-            
-            offscreen_canvas.SetImage(self.image, 0, 0)
-            self.matrix.SwapOnVSync(offscreen_canvas) 
+        for step in range(0,25):
+            self.draw_splash_text(resized_shine, step)
+            offscreen_canvas = self.push_frame(offscreen_canvas, self.image)
             time.sleep(.1)
-            
-        
-        time.sleep(0)
 
-        # Clear matrix
-        self.Clear_Image()
+        # Everything past the splash needs the fonts and palette
+        self.assets_ready.wait()
 
-        # Set splash to true
-        self.seen_splash = True
-        
+        self.finish_splash()
         return offscreen_canvas
 
+    # begin_postgame: Clear the canvas and draw the winner screen
+    def begin_postgame(self, offscreen_canvas):
+        offscreen_canvas.Clear()
+        self.canvas_changed()
+        self.draw_postgame()
+
+    # finish_postgame: Clear the canvas and reset postgame value
+    def finish_postgame(self, offscreen_canvas):
+        offscreen_canvas.Clear()
+        self.canvas_changed()
+        self.end_postgame()
+
     # state_postgame
     def state_postgame(self, offscreen_canvas):
+        self.begin_postgame(offscreen_canvas)
 
-        # Clear canvas, reset main image
-        offscreen_canvas.Clear()
+        # Update offscreen_canvas/matrix
+        offscreen_canvas = self.push_frame(offscreen_canvas, self.image)
+        time.sleep(10)
+        
+        # Once function is complete reset postgame value and exit
+        self.finish_postgame(offscreen_canvas)
+        return offscreen_canvas
+
+    # -------------------------------------------------------------------------
+    # async_render: the states above as coroutines, run on the websocket
+    # server's event loop. Message handlers and drawing share one thread, and
+    # idle screens wait on state_event instead of sleeping out their timeouts.
+
+    # wait_for_change_async: wait_for_change without blocking the event loop
+    async def wait_for_change_async(self, timeout):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while not self.state_changed.is_set():
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            # Handlers only run while we await, so no message can slip
+            # between the clear and the wait
+            self.state_event.clear()
+            try:
+                await asyncio.wait_for(self.state_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+    # animating: True if the in-game screen changes without new messages
+    def animating(self):
+        return self.animations_on() and any(marquee.scrolls for marquee in self.marquees.values())
+
+    async def state_waiting_async(self, offscreen_canvas):
+        history_str = self.begin_waiting()
+
+        for waitloop in range(0,4):
+            self.draw_waiting(waitloop, history_str)
+            offscreen_canvas = await self.push_frame_async(offscreen_canvas, self.image)
+            if await self.wait_for_change_async(.5):
+                break
+
+        return offscreen_canvas
+
+    async def state_game_active_async(self, offscreen_canvas):
+        # Anything applied from here on is picked up by the next frame
+        self.state_event.clear()
+
+        draw_start = self.draw_game_frame()
+        offscreen_canvas = await self.push_frame_async(offscreen_canvas, self.image)
+
+        # Never faster than the frame rate; past that, static screens wait
+        # for the next message rather than redrawing the same frame
+        await asyncio.sleep(self.finish_game_frame(draw_start))
+        if not self.animating():
+            await self.state_event.wait()
+        return offscreen_canvas
+
+    async def state_splash_async(self, offscreen_canvas):
+        shine_png = self.load_shine()
+
+        for size in range(1, 31):
+            resized_shine = self.draw_shine(shine_png, size)
+            await asyncio.sleep(0.012)
+
+        for step in range(0,25):
+            self.draw_splash_text(resized_shine, step)
+            offscreen_canvas = await self.push_frame_async(offscreen_canvas, self.image)
+            await asyncio.sleep(.1)
+
+        # load_assets runs on its own thread; wait for it off the loop
+        await asyncio.get_event_loop().run_in_executor(None, self.assets_ready.wait)
+
+        self.finish_splash()
+        return offscreen_canvas
+
+    async def state_postgame_async(self, offscreen_canvas):
+        self.begin_postgame(offscreen_canvas)
+        offscreen_canvas = await self.push_frame_async(offscreen_canvas, self.image)
+        await asyncio.sleep(10)
+        self.finish_postgame(offscreen_canvas)
+        return offscreen_canvas
+
+    # end_postgame: Leave the winner screen for the waiting screen
+    def end_postgame(self):
+        self.postgame = False
+        self.game_active = False
+        self.player_count = 0
+        self.finished_seq = self.game_seq
+
+    # draw_postgame: Draw the winner screen to a fresh main image
+    def draw_postgame(self):
+        # Reset main image
         self.image = Image.new("RGB", (64, 64))
         self.draw = ImageDraw.Draw(self.image)
 
@@ -999,12 +1777,8 @@ class Meleetrix(SampleBase):
             
             # Determine color to show based on color
             # Can't use char-color rgb because it's customizable
-            if color_str == 'Red':
-                winner_rgb = (102, 0, 0)
-            elif color_str == 'Blue':
-                winner_rgb = (102, 102, 255)
-            elif color_str == 'Green':
-                winner_rgb = (0, 153, 56)
+            from palette import COSTUME_BGS
+            winner_rgb = COSTUME_BGS.get(color_str.lower(), COSTUME_BGS['white'])
 
             # Assign char_str
             char_str = color_str + " Team"
@@ -1018,53 +1792,562 @@ class Meleetrix(SampleBase):
 
         # Draw 'Winner!' to canvas
         self.draw.text((9, 32), "Winner!", font=self.winner_font, fill=(255, 255, 255, 255))
-        
-        # Update offscreen_canvas/matrix
-        offscreen_canvas.SetImage(self.image, 0, 0)
-        self.matrix.SwapOnVSync(offscreen_canvas)
-        time.sleep(10)
-        
-        # Once function is complete reset postgame value and exit
-        offscreen_canvas.Clear()
-        self.postgame = False
-        self.game_active = False
-        self.player_count = 0
     
+    # -------------------------------------------------------------------------
+    # Message handlers - called from the websocket thread. Each one holds
+    # state_lock so the render loop never draws a half-applied update.
+
+    # apply_percent: Percent Change Update Message
+    def apply_percent(self, message):
+        with self.state_lock:
+            # Check the player index (scale: 0-3)
+            if message['playerIndex'] == 0:
+                self.p1_perc = str(int(message['percent'])) + "%"
+            elif message['playerIndex'] == 1:
+                self.p2_perc = str(int(message['percent'])) + "%"
+            elif message['playerIndex'] == 2:
+                self.p3_perc = str(int(message['percent'])) + "%"
+            elif message['playerIndex'] == 3:
+                self.p4_perc = str(int(message['percent'])) + "%"
+            self.timeline_event(message['playerIndex'], 'percent', int(message['percent']))
+            if message['playerIndex'] in self.sparklines:
+                self.sparklines[message['playerIndex']].add(message['percent'])
+
+    # apply_positions: Binary position frame (minimap), sent every game frame
+    # Arguments:
+    #   data: Bytes as sent by index.js
+    def apply_positions(self, data):
+        # Replaced whole rather than updated, so no lock is needed
+        self.frame, self.positions = decode_positions(data)
+
+    # apply_inputs: Binary input frame (input display), sent every game frame
+    # Arguments:
+    #   data: Bytes as sent by index.js
+    def apply_inputs(self, data):
+        # Replaced whole rather than updated, so no lock is needed
+        self.frame, self.inputs = decode_inputs(data)
+
+    # apply_count_change: Stock Count Change Update
+    def apply_count_change(self, message):
+        with self.state_lock:
+            stock_ct = message['stocksRemaining']
+
+            # A lost stock starts the sparkline over, along with the percent
+            sparkline = self.sparklines.get(message['playerIndex'])
+            if sparkline is not None and stock_ct != getattr(self, "p" + str(message['playerIndex'] + 1) + "_stocks", None):
+                sparkline.reset()
+
+            # First, check the player index
+            if message['playerIndex'] == 0:
+                self.p1_stocks = stock_ct
+                # If the number of stocks remaining is 0, update the percent
+                if stock_ct == 0:
+                    self.p1_perc = "-"
+
+            elif message['playerIndex'] == 1:
+                self.p2_stocks = stock_ct
+                # If the number of stocks remaining is 0, update the percent
+                if stock_ct == 0:
+                    self.p2_perc = "-"
+
+            elif message['playerIndex'] == 2:
+                self.p3_stocks = stock_ct
+                # If the number of stocks remaining is 0, update the percent
+                if stock_ct == 0:
+                    self.p3_perc = "-"
+
+            elif message['playerIndex'] == 3:
+                self.p4_stocks = stock_ct
+                # If the number of stocks remaining is 0, update the percent
+                if stock_ct == 0:
+                    self.p4_perc = "-"
+            self.timeline_event(message['playerIndex'], 'stocks', stock_ct)
+
+    # apply_game_end: Game End Update Message
+    def apply_game_end(self, message):
+        with self.state_lock:
+            self.gameEnd_method = message['gameEndMethod']
+            self.winner_index = message['winnerPlayerIndex']
+            self.game_active = False
+            self.postgame = True
+            self.end_seq += 1
+            self.current_game = None
+            # Hand the finished game to the history writer
+            self.record_match()
+
+    # apply_game_start: Game Start Update Message
+    def apply_game_start(self, message):
+        # Colors need the palette; only matters for a game arriving at startup
+        self.assets_ready.wait()
+        with self.state_lock:
+            # A new game always gets a fresh background, even if the last
+            # gameEnd never arrived
+            self.game_active = False
+            self.game_seq += 1
+            self.current_game = self.game_key(message)
+            # Reset active index list
+            self.active_indexes = []
+            # Start a fresh timeline for the match history
+            self.match_started = time.time()
+            self.timeline = []
+            # Set the number of players in the game overall
+            self.player_count = len(message['players'])
+            # Set the current stage name
+            self.stage = message['stageInfo']['name']
+            self.stage_id = message.get('stageId')
+            self.positions = []
+            # Fresh (preallocated) sparklines for a 2P game
+            self.sparklines = {}
+            if self.sparkline_active and self.player_count == 2 and self.minimap is None and self.input_display is None:
+                from sparkline import Sparkline
+                for player in message['players']:
+                    self.sparklines[player["playerIndex"]] = Sparkline(SPARKLINE_WIDTH, SPARKLINE_HEIGHT,
+                                                                       self.sparkline_config.get('full_scale', 150))
+            self.frame = None
+            # Rollback only happens on netplay, where players have connect codes
+            if self.settle is not None:
+                self.settle.reset(message['players'])
+                self.settle_holding = not self.settle_netplay_only or any(
+                    player.get('connectCode') for player in message['players'])
+            # Timed games count down; Slippi leaves timerType out of old replays
+            timer_type = message.get('timerType')
+            if timer_type == TIMER_DECREASING or (timer_type is None and message.get('startingTimerSeconds')):
+                self.timer_seconds = message.get('startingTimerSeconds') or 480
+            else:
+                self.timer_seconds = None
+            # Set the x-axis location to place the stage name;
+            # also assigns modified stage names for longer names
+            self.stage_x_loc = self.stage_loc_determ(self.stage)
+            # If game is Teams or not - needed for winning screen
+            self.is_teams = message['isTeams']
+            # Iterate over each player in the game, determining the
+            # character and color of each.
+            for player in message['players']:
+                # Retrieve playerIndex and names
+                index = player["playerIndex"]
+                nametag = player["nametag"]
+                display_name = player["displayName"]
+
+                # Add the active index to the list of stored active indexes
+                self.active_indexes.append(index)
+
+                # Create local variables for character color and name
+                char_color = player["CharacterColorName"]
+
+                # Use shortname if available - otherwise, use name
+                if "shortName" in player["characterInfo"]:
+                    char_name = player["characterInfo"]["shortName"]
+                else:
+                    char_name = player["characterInfo"]["name"]
+
+                # Call function to return character color RGB value
+                returned_colors = self.get_colors(char_color, char_name)
+                fg_color = returned_colors[0]
+                bg_color = returned_colors[1]
+
+                # Run function to determine correct icon based on extracted info
+                char_icon = self.create_icon_path(char_color, char_name)
+
+                # Player 1
+                if index == 0:
+                    self.p1_color = char_color
+                    self.p1_bg_color = bg_color
+                    self.p1_fg_color = fg_color
+                    self.p1_character = char_name
+                    self.p1_icon_path = char_icon
+                    self.p1_nametag = nametag
+                    self.p1_display_name = display_name
+                    self.p1_image = self.if_valid(char_icon)
+
+                # Player 2
+                elif index == 1:
+                    self.p2_color = char_color
+                    self.p2_bg_color = bg_color
+                    self.p2_fg_color = fg_color
+                    self.p2_character = char_name
+                    self.p2_icon_path = char_icon
+                    self.p2_nametag = nametag
+                    self.p2_display_name = display_name
+                    self.p2_image = self.if_valid(char_icon)
+
+                # Player 3
+                elif index == 2:
+                    self.p3_color = char_color
+                    self.p3_bg_color = bg_color
+                    self.p3_fg_color = fg_color
+                    self.p3_character = char_name
+                    self.p3_icon_path = char_icon
+                    self.p3_nametag = nametag
+                    self.p3_display_name = display_name
+                    self.p3_image = self.if_valid(char_icon)
+
+                # Player 4
+                elif index == 3:
+                    self.p4_color = char_color
+                    self.p4_bg_color = bg_color
+                    self.p4_fg_color = fg_color
+                    self.p4_character = char_name
+                    self.p4_icon_path = char_icon
+                    self.p4_nametag = nametag
+                    self.p4_display_name = display_name
+                    self.p4_image = self.if_valid(char_icon)
+
+                # Every player starts on 0% with a full set of stocks
+                setattr(self, "p" + str(index + 1) + "_perc", "0%")
+                setattr(self, "p" + str(index + 1) + "_stocks", player.get("startStocks", 4))
+
+        # Wake the render loop if it's idling on the waiting screen
+        self.state_changed.set()
+
+    # apply_snapshot: Full game state sent by index.js on every (re)connect
+    # Arguments:
+    #   message: gameStart payload, per-player percent/stocks and frame number
+    def apply_snapshot(self, message):
+        # Applied as one update: the render loop sees the old game or the new
+        # one, never a mix of the two
+        with self.state_lock:
+            # index.js reconnecting mid-game: the game, its sparklines and
+            # anything still held carry on, with whatever changed meanwhile
+            same_game = self.current_game is not None and self.game_key(message['gameStart']) == self.current_game
+            if not same_game:
+                self.postgame = False
+                self.apply_game_start(message['gameStart'])
+            for player in message['players']:
+                prefix = "p" + str(player['playerIndex'] + 1) + "_"
+                if not same_game or getattr(self, prefix + "perc", None) != str(int(player['percent'])) + "%":
+                    self.apply_percent(player)
+                if not same_game or getattr(self, prefix + "stocks", None) != player['stocksRemaining']:
+                    self.apply_count_change(player)
+            # Changes held from here on are compared with these, not 0%
+            if self.settle is not None:
+                self.settle.seed(message['players'], message['frame'])
+            self.frame = message['frame']
+
+    # game_key: Identifies a game the same way index.js's gameKey does, so a
+    # snapshot of the game already showing can be told from a new one
+    # Arguments:
+    #   message: gameStart payload
+    def game_key(self, message):
+        if message.get('randomSeed') is not None:
+            return str(message['randomSeed'])
+        return (message.get('stageId'),) + tuple((player['playerIndex'], player.get('characterId'), player.get('characterColor'))
+                                                 for player in message['players'])
+
+    # apply_message: Hand a decoded message to its handler
+    # Arguments:
+    #   message: Dict decoded from index.js's JSON
+    # Returns:
+    #   Messages applied by this call: the message itself unless it's being
+    #   held, after any held updates whose settle window has passed
+    def apply_message(self, message):
+        applied = self.release_settled()
+
+        # Position and input frames are the only binary messages
+        if isinstance(message, bytes):
+            if message[0] == INPUTS_MESSAGE:
+                self.apply_inputs(message)
+            else:
+                self.apply_positions(message)
+            if self.settle_holding and self.frame is not None:
+                self.settle.note_frame(self.frame, self.clock())
+            applied.append(message)
+            return applied
+
+        message_type = message['messageType']
+
+        # Held until no rollback has undone them for a few frames; index.js
+        # sends the frame each change was seen on
+        if self.settle_holding and message_type in ("playerPercent", "countChange") and message.get('frame') is not None:
+            self.settle.hold(message, self.clock())
+            return applied
+        if self.settle_holding and message.get('frame') is not None:
+            self.settle.note_frame(message['frame'], self.clock())
+
+        # Percent Change Update Message
+        if message_type == "playerPercent":
+            self.apply_percent(message)
+
+        # Stock Count Change Update
+        elif message_type == "countChange":
+            self.apply_count_change(message)
+
+        # Game End Update Message
+        elif message_type == "gameEnd":
+            # Whatever is still held is final now
+            if self.settle_holding:
+                for held in self.settle.flush():
+                    self.apply_settled(held)
+                    applied.append(held)
+                self.settle_holding = False
+            self.apply_game_end(message)
+
+        # Game Start Update Message
+        elif message_type == "gameStart":
+            self.apply_game_start(message)
+
+        # Frame number, sent once per second of game time for the clock
+        elif message_type == "clock":
+            self.frame = message['frame']
+
+        # Full state snapshot, sent whenever index.js (re)connects
+        elif message_type == "snapshot":
+            self.apply_snapshot(message)
+
+        applied.append(message)
+        return applied
+
+    # apply_settled: Apply a held percent/stock update
+    def apply_settled(self, message):
+        if message['messageType'] == "playerPercent":
+            self.apply_percent(message)
+        else:
+            self.apply_count_change(message)
+
+    # release_settled: Apply every held update whose settle window has passed
+    # Returns:
+    #   The updates applied
+    def release_settled(self):
+        if not self.settle_holding or not self.settle.pending:
+            return []
+        released = self.settle.due(self.clock())
+        for message in released:
+            self.apply_settled(message)
+        return released
+
+    # settle_delay: Seconds until the next held update is due, or None
+    def settle_delay(self):
+        if not self.settle_holding:
+            return None
+        return self.settle.next_due(self.clock())
+
+    # export_state: Copy of the state set by the message handlers
+    # Returns:
+    #   JSON-serializable dict, applied elsewhere with import_state
+    def export_state(self):
+        with self.state_lock:
+            state = {'game_seq': self.game_seq, 'end_seq': self.end_seq}
+            for name in SHARED_FIELDS:
+                state[name] = getattr(self, name, None)
+            for player in range(1, 5):
+                for field in PLAYER_FIELDS:
+                    key = "p" + str(player) + "_" + field
+                    if hasattr(self, key):
+                        state[key] = getattr(self, key)
+            state['inputs'] = self.inputs
+            state['sparklines'] = {index: sparkline.recent() for index, sparkline in self.sparklines.items()}
+            state['history_version'] = self.history.version if self.history is not None else None
+            return state
+
+    # import_state: Apply a state produced by export_state
+    # Arguments:
+    #   state: Dict from export_state (e.g. via shared memory)
+    def import_state(self, state):
+        with self.state_lock:
+            new_game = state['game_seq'] != self.game_seq
+            game_ended = state['end_seq'] != self.end_seq
+
+            for name in SHARED_FIELDS:
+                setattr(self, name, state[name])
+            for player in range(1, 5):
+                for field in PLAYER_FIELDS:
+                    key = "p" + str(player) + "_" + field
+                    if key in state:
+                        value = state[key]
+                        # JSON turns color tuples into lists
+                        setattr(self, key, tuple(value) if isinstance(value, list) else value)
+            # ...and port indexes into strings
+            self.inputs = {int(index): tuple(inputs) for index, inputs in state['inputs'].items()}
+            self.import_sparklines(state['sparklines'])
+            self.shared_history_version = state['history_version']
+
+            # A publish that raced end_postgame mustn't bring the finished
+            # game's scoreboard back; only a new game can
+            if not new_game and self.finished_seq == state['game_seq']:
+                self.player_count = 0
+
+            # Icons are only loaded when a new game arrives
+            if new_game:
+                for index in self.active_indexes:
+                    prefix = "p" + str(index + 1) + "_"
+                    setattr(self, prefix + "image", self.if_valid(getattr(self, prefix + "icon_path")))
+                self.game_active = False
+                self.postgame = False
+            if game_ended:
+                self.game_active = False
+                self.postgame = True
+
+            self.game_seq = state['game_seq']
+            self.end_seq = state['end_seq']
+
+        if new_game:
+            self.state_changed.set()
+
+    # import_sparklines: Match the ingest process's sparklines, which it keeps
+    # up to date from the percents only it receives
+    # Arguments:
+    #   shared: Player index (as a string) -> percents, oldest first
+    def import_sparklines(self, shared):
+        sparklines = {}
+        for index, percents in shared.items():
+            sparkline = self.sparklines.get(int(index))
+            if sparkline is None:
+                from sparkline import Sparkline
+                sparkline = Sparkline(SPARKLINE_WIDTH, SPARKLINE_HEIGHT, self.sparkline_config.get('full_scale', 150))
+            # Unchanged sparklines keep their drawn tile
+            if sparkline.recent() != percents:
+                sparkline.load(percents)
+            sparklines[int(index)] = sparkline
+        self.sparklines = sparklines
+
+    # share_state: Publish the state to shared memory after every applied
+    # message and every history commit (ingest process)
+    # Arguments:
+    #   shared_state: SharedState the render process reads
+    def share_state(self, shared_state):
+        def publish(message=None):
+            # The websocket thread and the history writer both publish
+            with self.state_lock:
+                shared_state.publish(self.export_state())
+        self.state_listeners.append(publish)
+        if self.history is not None:
+            self.history.committed = publish
+
+    # poll_shared_state: Pick up the latest state from the ingest process, if any
+    def poll_shared_state(self):
+        if self.state_reader is None:
+            return
+        update = self.state_reader.read(self.state_reader_seq)
+        if update is not None:
+            self.state_reader_seq, state = update
+            self.import_state(state)
+
+    # wait_for_change: Sleep until a new game arrives or the timeout passes
+    # Arguments:
+    #   timeout: Seconds to wait
+    # Returns:
+    #   True if a new game arrived
+    def wait_for_change(self, timeout):
+        if self.state_reader is None:
+            return self.state_changed.wait(timeout)
+
+        # The ingest process can't set our event, so poll its state instead
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.poll_shared_state()
+            if self.state_changed.is_set():
+                return True
+            time.sleep(0.01)
+        return False
+
+    # start_mirror: Start the browser mirror (runs on its own thread)
+    def start_mirror(self):
+        # Imported here: websockets and numpy would otherwise delay the splash
+        from mirror import FrameMirror
+        mirror_config = self.config.get('mirror', {})
+        mirror = FrameMirror(mirror_config.get('host', '0.0.0.0'), mirror_config.get('port', 8082),
+                             mirror_config.get('max_fps', 30))
+        mirror.start()
+        self.metrics.add_probe("meleetrix_mirror_clients", "Browsers connected to the mirror.", lambda: len(mirror.clients))
+        self.mirror = mirror
+
     # -------------------------------------------------------------------------
     # Main function - where the sausage is made
     def run(self):
 
+        # Rendering and the websocket server share one event loop instead
+        if self.config.get('async_render', False) and self.state_reader is None:
+            WebsocketConn.start_server(render=self.run_async)
+            return
+
+        # Browser mirror, if enabled; frames are offered to it once it's up
+        if self.config.get('mirror', {}).get('active', False):
+            threading.Thread(target=self.start_mirror, daemon=True).start()
+
         # Offscreen canvas        
         offscreen_canvas = self.matrix.CreateFrameCanvas()
 
+        # Delay between retries while the loop keeps failing
+        backoff = Backoff(0.05, 2.0)
+
         # Infinite while loop whose variables and states will be updated
         # as new information is received from the web socket
         while True:
             try:
+                # Updates from a separate ingest process, if one is running
+                self.poll_shared_state()
+
                 # Active Game 
                 if self.game_active == True:
-                    self.state_game_active(offscreen_canvas)
+                    self.metrics.state = "game_active"
+                    offscreen_canvas = self.state_game_active(offscreen_canvas)
 
                 # Postgame
                 elif self.postgame == True:
-                    self.state_postgame(offscreen_canvas)
+                    self.metrics.state = "postgame"
+                    offscreen_canvas = self.state_postgame(offscreen_canvas)
         
                 # Initiate Game Data
                 elif self.player_count != 0 and self.game_active == False:
+                    self.metrics.state = "start_game"
                     self.state_start_game()
                 
                 # Splash Screen (Launch)
                 elif self.seen_splash == False:
+                    self.metrics.state = "splash"
                     offscreen_canvas = self.state_splash(offscreen_canvas)
 
                 # Waiting for Game
                 elif self.seen_splash == True and self.game_active == False:
-                    self.state_waiting(offscreen_canvas)
-                
+                    self.metrics.state = "waiting"
+                    offscreen_canvas = self.state_waiting(offscreen_canvas)
+
+                backoff.reset()
             
+            # Don't exit: keep the last good frame up and try again shortly
+            except Exception as e:
+                traceback.print_exc()
+                self.metrics.render_errors.inc()
+                offscreen_canvas = self.show_last_frame(offscreen_canvas)
+                time.sleep(backoff.next_delay())
+
+    # run_async: run() as a coroutine, for async_render
+    async def run_async(self):
+        self.state_event = asyncio.Event()
+        self.state_listeners.append(lambda message: self.state_event.set())
+        # One thread, so swaps stay in order
+        self.swap_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="meleetrix-swap")
+
+        if self.config.get('mirror', {}).get('active', False):
+            threading.Thread(target=self.start_mirror, daemon=True).start()
+
+        offscreen_canvas = self.matrix.CreateFrameCanvas()
+        backoff = Backoff(0.05, 2.0)
+
+        while True:
+            try:
+                if self.game_active == True:
+                    self.metrics.state = "game_active"
+                    offscreen_canvas = await self.state_game_active_async(offscreen_canvas)
+                elif self.postgame == True:
+                    self.metrics.state = "postgame"
+                    offscreen_canvas = await self.state_postgame_async(offscreen_canvas)
+                elif self.player_count != 0 and self.game_active == False:
+                    self.metrics.state = "start_game"
+                    self.state_start_game()
+                elif self.seen_splash == False:
+                    self.metrics.state = "splash"
+                    offscreen_canvas = await self.state_splash_async(offscreen_canvas)
+                elif self.seen_splash == True and self.game_active == False:
+                    self.metrics.state = "waiting"
+                    offscreen_canvas = await self.state_waiting_async(offscreen_canvas)
+
+                backoff.reset()
+
             except Exception as e:
                 traceback.print_exc()
-                exit()
+                self.metrics.render_errors.inc()
+                offscreen_canvas = self.show_last_frame(offscreen_canvas)
+                await asyncio.sleep(backoff.next_delay())
 
 # -----------------------------------------------------------------------------
 # Create a global simple square object
@@ -1081,153 +2364,176 @@ class WebsocketConn():
         while True:
             try:
                 message = await websocket.recv()
-                # Convert to JSON
-                message = json.loads(message)
-                # After extracting components, check the type of message
-                message_type = message['messageType']
-                
-                # Percent Change Update Message
-                if message_type == "playerPercent":
-                    # Check the player index (scale: 0-3)
-                    if message['playerIndex'] == 0:
-                        game_obj.p1_perc = str(int(message['percent'])) + "%"
-                    elif message['playerIndex'] == 1:
-                        game_obj.p2_perc = str(int(message['percent'])) + "%"
-                    elif message['playerIndex'] == 2:
-                        game_obj.p3_perc = str(int(message['percent'])) + "%"
-                    elif message['playerIndex'] == 3:
-                        game_obj.p4_perc = str(int(message['percent'])) + "%"
-                
-                # Stock Count Change Update
-                if message_type == "countChange":
-                    stock_ct = message['stocksRemaining']
-
-                    # First, check the player index
-                    if message['playerIndex'] == 0:
-                        game_obj.p1_stocks = stock_ct
-                        # If the number of stocks remaining is 0, update the percent
-                        if stock_ct == 0:
-                            game_obj.p1_perc = "-"
-
-                    elif message['playerIndex'] == 1:
-                        game_obj.p2_stocks = stock_ct
-                        # If the number of stocks remaining is 0, update the percent
-                        if stock_ct == 0:
-                            game_obj.p2_perc = "-"
-
-                    elif message['playerIndex'] == 2:
-                        game_obj.p3_stocks = stock_ct
-                        # If the number of stocks remaining is 0, update the percent
-                        if stock_ct == 0:
-                            game_obj.p3_perc = "-"
-
-                    elif message['playerIndex'] == 3:
-                        game_obj.p4_stocks = stock_ct
-                        # If the number of stocks remaining is 0, update the percent
-                        if stock_ct == 0:
-                            game_obj.p4_perc = "-"
-                
-                # Game End Update Message
-                elif message_type == "gameEnd":
-                    game_obj.gameEnd_method = message['gameEndMethod']
-                    game_obj.winner_index = message['winnerPlayerIndex']
-                    game_obj.game_active = False
-                    game_obj.postgame = True
-                        
-                # Game Start Update Message
-                elif message_type == "gameStart":
-                    # Reset active index list
-                    game_obj.active_indexes = []
-                    # Set the number of players in the game overall
-                    game_obj.player_count = len(message['players'])
-                    # Set the current stage name
-                    game_obj.stage = message['stageInfo']['name']
-                    # Set the x-axis location to place the stage name;
-                    # also assigns modified stage names for longer names
-                    game_obj.stage_x_loc = game_obj.stage_loc_determ(game_obj.stage)
-                    # If game is Teams or not - needed for winning screen
-                    game_obj.is_teams = message['isTeams']
-                    # Iterate over each player in the game, determining the
-                    # character and color of each.
-                    for player in message['players']:
-                        # Retrieve playerIndex and names
-                        index = player["playerIndex"]
-                        nametag = player["nametag"]
-                        display_name = player["displayName"]
-
-                        # Add the active index to the list of stored active indexes
-                        game_obj.active_indexes.append(index)
-
-                        # Create local variables for character color and name
-                        char_color = player["CharacterColorName"]
-
-                        # Use shortname if available - otherwise, use name
-                        if "shortName" in player["characterInfo"]:
-                            char_name = player["characterInfo"]["shortName"]
-                        else:
-                            char_name = player["characterInfo"]["name"]
-
-                        # Call function to return character color RGB value
-                        returned_colors = game_obj.get_colors(char_color, char_name)
-                        fg_color = returned_colors[0]
-                        bg_color = returned_colors[1]
-
-                        # Run function to determine correct icon based on extracted info
-                        char_icon = game_obj.create_icon_path(char_color, char_name)
-
-                        # Player 1
-                        if index == 0:
-                            game_obj.p1_color = char_color
-                            game_obj.p1_bg_color = bg_color
-                            game_obj.p1_fg_color = fg_color
-                            game_obj.p1_character = char_name
-                            game_obj.p1_icon_path = char_icon
-                            game_obj.p1_nametag = nametag
-                            game_obj.p1_display_name = display_name
-                            game_obj.p1_image = game_obj.if_valid(char_icon)
-
-                        # Player 2
-                        elif index == 1:
-                            game_obj.p2_color = char_color
-                            game_obj.p2_bg_color = bg_color
-                            game_obj.p2_fg_color = fg_color
-                            game_obj.p2_character = char_name
-                            game_obj.p2_icon_path = char_icon
-                            game_obj.p2_nametag = nametag
-                            game_obj.p2_display_name = display_name
-                            game_obj.p2_image = game_obj.if_valid(char_icon)
-
-                        # Player 3
-                        elif index == 2:
-                            game_obj.p3_color = char_color
-                            game_obj.p3_bg_color = bg_color
-                            game_obj.p3_fg_color = fg_color
-                            game_obj.p3_character = char_name
-                            game_obj.p3_icon_path = char_icon
-                            game_obj.p3_nametag = nametag
-                            game_obj.p3_display_name = display_name
-                            game_obj.p3_image = game_obj.if_valid(char_icon)
-
-                        # Player 4
-                        elif index == 3:
-                            game_obj.p4_color = char_color
-                            game_obj.p4_bg_color = bg_color
-                            game_obj.p4_fg_color = fg_color
-                            game_obj.p4_character = char_name
-                            game_obj.p4_icon_path = char_icon
-                            game_obj.p4_nametag = nametag
-                            game_obj.p4_display_name = display_name
-                            game_obj.p4_image = game_obj.if_valid(char_icon)
+            # slp-realtime went away; it reconnects on its own, so just wait
+            except websockets.ConnectionClosed:
+                print("Socket connection closed, waiting for reconnect")
+                return
 
+            try:
+                # Kept as received, so bad messages replay exactly as they arrived
+                if game_obj.recorder is not None:
+                    game_obj.recorder.write(message)
+                # Messages already buffered behind this one
+                game_obj.metrics.queue_depth.set(len(getattr(websocket, 'messages', ())))
+                # Position and input frames arrive up to 60 times a second, in binary
+                if isinstance(message, bytes):
+                    message_type = BINARY_TYPES.get(message[0], "binary")
+                else:
+                    try:
+                        # Convert to JSON
+                        message = json.loads(message)
+                        # After extracting components, check the type of message
+                        message_type = message['messageType']
+                    except (ValueError, KeyError, TypeError):
+                        game_obj.metrics.decode_errors.inc()
+                        raise
+                WebsocketConn.dispatch(message, message_type)
+
+            # Count and skip anything that can't be decoded or applied
+            except Exception as e:
+                game_obj.metrics.skipped_messages.inc()
+                print("Skipping bad message:", repr(e))
+
+    # dispatch: Count a decoded message, apply it and pass it to the listeners
+    def dispatch(message, message_type):
+        game_obj.metrics.messages.inc(message_type)
+        WebsocketConn.notify(game_obj.apply_message(message))
+        WebsocketConn.schedule_settle()
+
+    # notify: Pass applied messages to the state listeners
+    def notify(applied):
+        for message in applied:
+            for listener in game_obj.state_listeners:
+                listener(message)
+
+    # schedule_settle: Release held updates when they're due, even if no
+    # other message arrives before then (runs on the server's loop)
+    def schedule_settle():
+        if game_obj.settle_timer is not None:
+            game_obj.settle_timer.cancel()
+            game_obj.settle_timer = None
+        delay = game_obj.settle_delay()
+        if delay is not None:
+            game_obj.settle_timer = asyncio.get_event_loop().call_later(delay, WebsocketConn.release_settled)
+
+    def release_settled():
+        game_obj.settle_timer = None
+        try:
+            WebsocketConn.notify(game_obj.release_settled())
+        except Exception as e:
+            game_obj.metrics.skipped_messages.inc()
+            print("Skipping bad message:", repr(e))
+        WebsocketConn.schedule_settle()
+
+    # apply_fanout: Message from the fan-out publisher, already decoded
+    def apply_fanout(message):
+        try:
+            message_type = BINARY_TYPES.get(message[0], "binary") if isinstance(message, bytes) else message['messageType']
+            WebsocketConn.dispatch(message, message_type)
+        except Exception as e:
+            game_obj.metrics.skipped_messages.inc()
+            print("Skipping bad message:", repr(e))
+
+    # prepare_server: Imports and files the server needs before listening
+    def prepare_server():
+        # Imported on this thread so the matrix thread doesn't wait on it
+        global websockets
+        import websockets
+
+        # Sessions recorded here can be exported as video with export.py
+        recording_config = game_obj.config.get('recording', {})
+        if recording_config.get('active', False) and game_obj.recorder is None:
+            from replay import SessionRecorder
+            game_obj.recorder = SessionRecorder(recording_config.get('dir', './recordings'))
+
+        # LAN fan-out: publish what this node applies, or apply what another publishes
+        fanout_config = game_obj.config.get('fanout', {})
+        role = fanout_config.get('role', 'off')
+        if role == "publisher" and game_obj.fanout is None:
+            from fanout import FanoutPublisher
+            publisher = FanoutPublisher(fanout_config.get('host', '0.0.0.0'), fanout_config.get('port', 8083),
+                                        fanout_config.get('queue_size', 64))
+            publisher.start()
+            game_obj.state_listeners.append(publisher.publish)
+            game_obj.metrics.add_probe("meleetrix_fanout_subscribers", "Nodes subscribed to this publisher.",
+                                       lambda: len(publisher.subscribers))
+            game_obj.metrics.add_probe("meleetrix_fanout_dropped", "Frames dropped from slow nodes' queues.",
+                                       lambda: publisher.dropped)
+            game_obj.fanout = publisher
+        elif role == "subscriber" and game_obj.fanout is None:
+            from fanout import FanoutSubscriber
+            subscriber = FanoutSubscriber(fanout_config.get('publisher', 'ws://127.0.0.1:8083'), WebsocketConn.apply_fanout)
+            game_obj.metrics.add_probe("meleetrix_fanout_missed", "Messages from the publisher that never arrived.",
+                                       lambda: subscriber.missed)
+            game_obj.fanout = subscriber
+
+    # Coroutine; start the websocket server (and metrics, if enabled) on the current loop
+    async def start_listeners():
+        await websockets.serve(WebsocketConn.handle_connection, 'localhost', 8081)
+        # A subscriber node takes its messages from the publisher too
+        if game_obj.config.get('fanout', {}).get('role') == "subscriber":
+            asyncio.ensure_future(game_obj.fanout.run())
+        # Metrics share this loop; an idle listener costs nothing between scrapes
+        metrics_config = game_obj.config.get('metrics', {})
+        if metrics_config.get('active', False):
+            await game_obj.metrics.serve(metrics_config.get('host', '127.0.0.1'), metrics_config.get('port', 9108))
+        # Let run.sh (or systemd) know index.js can connect now
+        notify_ready(game_obj.config.get('ready_file', ''))
+        startup_timer.mark("server ready")
+
+    # Coroutine; async_render's event loop: the renderer starts straight away,
+    # the listeners as soon as websockets is imported
+    async def serve_with_renderer(render):
+        loop = asyncio.get_event_loop()
+        render_task = loop.create_task(render())
+        await loop.run_in_executor(None, WebsocketConn.prepare_server)
+
+        backoff = Backoff(0.5, 10.0)
+        while True:
+            try:
+                await WebsocketConn.start_listeners()
+                break
             except Exception as e:
-                print("exception : ", e)
-                exit()
+                print("Websocket server failed:", repr(e))
+            await asyncio.sleep(backoff.next_delay())
+        await render_task
 
     # Create server, listen for incoming connections
-    def start_server():
-        asyncio.set_event_loop(asyncio.new_event_loop())
-        asyncio.get_event_loop().run_until_complete(websockets.serve(WebsocketConn.handle_connection, 'localhost', 8081))
-        asyncio.get_event_loop().run_forever()
+    # Supervised: if the server can't start (e.g. port still held), retry with backoff
+    # Arguments:
+    #   render: Coroutine function to run on the same loop (async_render only)
+    def start_server(render=None):
+        if render is not None:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(WebsocketConn.serve_with_renderer(render))
+            return
+
+        apply_policy("websocket", game_obj.scheduling.get('server'))
+        game_obj.server_scheduled.set()
+        WebsocketConn.prepare_server()
+
+        backoff = Backoff(0.5, 10.0)
+        while True:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(WebsocketConn.start_listeners())
+                backoff.reset()
+                loop.run_forever()
+            except Exception as e:
+                print("Websocket server failed:", repr(e))
+            finally:
+                loop.close()
+            time.sleep(backoff.next_delay())
+
+# Ingest process body: websocket server only, publishing state to shared memory
+# Arguments:
+#   shared_state: SharedState created (and inherited) from the render process
+def run_ingest_process(shared_state):
+    game_obj.load_assets()
+    game_obj.share_state(shared_state)
+    WebsocketConn.start_server()
 
 # Create a simple square instance, and run it
 def draw_to_matrix():
@@ -1238,10 +2544,39 @@ def draw_to_matrix():
 # Main function
 if __name__ == "__main__":
     print("Starting web socket and matrix!")
-    t1 = threading.Thread(target=WebsocketConn.start_server)
+    clear_ready(game_obj.config.get('ready_file', ''))
+
+    # Optionally run ingest in its own process, so JSON decoding and drawing
+    # don't share a GIL; the render loop then reads state from shared memory
+    if game_obj.config.get('separate_processes', False):
+        import multiprocessing
+        from sharedstate import SharedState
+        shared_state = SharedState()
+        # Forked explicitly: SharedState wraps a memoryview of the shared
+        # memory, which the child inherits but spawn/forkserver can't pickle
+        ingest = multiprocessing.get_context("fork").Process(target=run_ingest_process, args=(shared_state,), name="meleetrix-ingest", daemon=True)
+        ingest.start()
+        game_obj.state_reader = shared_state
+        threading.Thread(target=game_obj.load_assets, daemon=True).start()
+        try:
+            draw_to_matrix()
+        finally:
+            shared_state.close(unlink=True)
+        sys.exit(0)
+
+    t0 = threading.Thread(target=game_obj.load_assets, daemon=True)
     t2 = threading.Thread(target=draw_to_matrix)
+    # With async_render, the render thread runs the websocket server too
+    if game_obj.config.get('async_render', False):
+        t2.start()
+        t0.start()
+        t2.join()
+        sys.exit(0)
+
+    t1 = threading.Thread(target=WebsocketConn.start_server)
     t1.start()
     t2.start()
+    t0.start()
     t1.join()
     t2.join()
 
@@ -0,0 +1,52 @@
+# ttroy1, 2023
+# Scrolling name rows: each name is drawn once into a strip, and every frame
+# pastes a window sliced from it
+
+# -----------------------------------------------------------------------------
+from PIL import Image, ImageDraw
+
+# Blank pixels between the end of a name and its next repeat
+GAP = 12
+
+class Marquee(object):
+    # Arguments:
+    #   text: Name to show
+    #   font: PIL font to draw it with
+    #   width: Width of the window on the panel, in pixels
+    #   fg, bg: Text and background colors
+    #   speed: Scroll speed in pixels per second
+    #   start: Time scrolling starts from, in the same clock as window()
+    def __init__(self, text, font, width, fg, bg, speed, start):
+        self.width = width
+        self.speed = speed
+        self.start = start
+        text_width, self.height = font.getsize(text) if hasattr(font, "getsize") else font.getbbox(text)[2:]
+
+        # Names that fit don't scroll; the strip is just the window
+        self.scrolls = text_width > width
+        if self.scrolls:
+            # Name, gap, then the start of the name again, so any window
+            # over one cycle is a single contiguous slice
+            self.cycle = text_width + GAP
+            self.strip = Image.new("RGB", (self.cycle + width, self.height), bg)
+            draw = ImageDraw.Draw(self.strip)
+            draw.text((0, 0), text, font=font, fill=fg)
+            draw.text((self.cycle, 0), text, font=font, fill=fg)
+        else:
+            self.cycle = 1
+            self.strip = Image.new("RGB", (width, self.height), bg)
+            ImageDraw.Draw(self.strip).text(((width - text_width) // 2, 0), text, font=font, fill=fg)
+        # Slices by offset; a name has at most a few hundred
+        self.windows = {}
+
+    # window: The part of the strip to show at a point in time
+    # Arguments:
+    #   now: Current time, in the same clock as start
+    # Returns:
+    #   A (width x height) RGB image to paste onto the frame
+    def window(self, now):
+        offset = int((now - self.start) * self.speed) % self.cycle if self.scrolls else 0
+        window = self.windows.get(offset)
+        if window is None:
+            window = self.windows[offset] = self.strip.crop((offset, 0, offset + self.width, self.height))
+        return window
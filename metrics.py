@@ -0,0 +1,173 @@
+# ttroy1, 2023
+# Local Prometheus-format metrics for ingest rate, decode errors and frame timing
+
+# -----------------------------------------------------------------------------
+import asyncio
+import bisect
+import os
+import time
+
+# Default histogram bucket bounds, in seconds
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+
+# Each metric is only ever updated from one thread (counters from the websocket
+# loop, timings from the render loop), so plain attribute updates are enough
+# and recording costs no more than an add.
+
+# -----------------------------------------------------------------------------
+class Counter(object):
+    def __init__(self, name, help_str, label=None):
+        self.name = name
+        self.help_str = help_str
+        self.label = label
+        self.values = {}
+
+    # inc: Add to the counter, optionally for one label value
+    def inc(self, label_value=None, amount=1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def total(self):
+        return sum(self.values.values())
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.help_str, "# TYPE " + self.name + " counter"]
+        if not self.values:
+            lines.append(self.name + " 0")
+        for label_value, value in sorted(self.values.items(), key=lambda item: str(item[0])):
+            if label_value is None:
+                lines.append(self.name + " " + str(value))
+            else:
+                lines.append(self.name + '{' + self.label + '="' + str(label_value) + '"} ' + str(value))
+        return lines
+
+# -----------------------------------------------------------------------------
+class Gauge(object):
+    def __init__(self, name, help_str):
+        self.name = name
+        self.help_str = help_str
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def render(self):
+        return ["# HELP " + self.name + " " + self.help_str, "# TYPE " + self.name + " gauge",
+                self.name + " " + str(self.value)]
+
+# -----------------------------------------------------------------------------
+class Histogram(object):
+    def __init__(self, name, help_str, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help_str = help_str
+        self.buckets = buckets
+        # One slot per bucket, plus one for +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    # observe: Record a single measurement
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.help_str, "# TYPE " + self.name + " histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(self.name + '_bucket{le="' + str(bound) + '"} ' + str(cumulative))
+        cumulative += self.counts[-1]
+        lines.append(self.name + '_bucket{le="+Inf"} ' + str(cumulative))
+        lines.append(self.name + "_sum " + repr(self.sum))
+        lines.append(self.name + "_count " + str(cumulative))
+        return lines
+
+# -----------------------------------------------------------------------------
+# rss_bytes: Resident set size of this process, from /proc
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+# -----------------------------------------------------------------------------
+class Metrics(object):
+    def __init__(self):
+        # Ingest (websocket loop)
+        self.messages = Counter("meleetrix_messages_total", "Messages received from slp-realtime, by type.", "type")
+        self.decode_errors = Counter("meleetrix_decode_errors_total", "Messages that could not be decoded.")
+        self.skipped_messages = Counter("meleetrix_skipped_messages_total", "Messages skipped because they could not be decoded or applied.")
+        self.queue_depth = Gauge("meleetrix_ingest_queue_depth", "Messages waiting in the websocket receive queue.")
+
+        # Rendering (matrix loop)
+        self.frames = Counter("meleetrix_frames_total", "Frames swapped onto the matrix.")
+        self.frames_skipped = Counter("meleetrix_frames_skipped_total", "Frames not swapped because nothing changed.")
+        self.partial_updates = Counter("meleetrix_partial_updates_total", "Frames written to the canvas as a changed region or pixels only.")
+        self.render_errors = Counter("meleetrix_render_errors_total", "Render loop iterations that raised an exception.")
+        self.frame_overruns = Counter("meleetrix_frame_overruns_total", "In-game frames whose draw, SetImage and swap went over the deadline budget.")
+        self.draw_time = Histogram("meleetrix_draw_in_game_seconds", "Time spent in draw_in_game.")
+        self.set_image_time = Histogram("meleetrix_set_image_seconds", "Time spent in SetImage.")
+        self.swap_time = Histogram("meleetrix_swap_on_vsync_seconds", "Time spent in SwapOnVSync.")
+        self.state = "starting"
+
+        # FPS is worked out between scrapes, so nothing is done per frame for it
+        self.last_scrape = time.monotonic()
+        self.last_frames = 0
+        # Extra (name, help, callable) gauges read only when scraped
+        self.probes = []
+
+    # add_probe: Register a gauge whose value is read at scrape time
+    def add_probe(self, name, help_str, read):
+        self.probes.append((name, help_str, read))
+
+    # render: Build the full Prometheus text exposition
+    def render(self):
+        now = time.monotonic()
+        frames = self.frames.total()
+        elapsed = now - self.last_scrape
+        fps = (frames - self.last_frames) / elapsed if elapsed > 0 else 0.0
+        self.last_scrape = now
+        self.last_frames = frames
+
+        lines = []
+        for metric in (self.messages, self.decode_errors, self.skipped_messages, self.queue_depth,
+                       self.frames, self.frames_skipped, self.partial_updates, self.render_errors, self.frame_overruns,
+                       self.draw_time, self.set_image_time, self.swap_time):
+            lines.extend(metric.render())
+        skipped = self.frames_skipped.total()
+        skip_ratio = skipped / float(skipped + frames) if skipped + frames > 0 else 0.0
+        lines.extend(["# HELP meleetrix_frame_skip_ratio Share of rendered frames that needed no swap.",
+                      "# TYPE meleetrix_frame_skip_ratio gauge", "meleetrix_frame_skip_ratio " + str(round(skip_ratio, 4))])
+        lines.extend(["# HELP meleetrix_render_fps Frames per second since the previous scrape.",
+                      "# TYPE meleetrix_render_fps gauge", "meleetrix_render_fps " + str(round(fps, 2))])
+        lines.extend(["# HELP meleetrix_state Current state of the Meleetrix.run loop.",
+                      "# TYPE meleetrix_state gauge", 'meleetrix_state{state="' + self.state + '"} 1'])
+        lines.extend(["# HELP process_resident_memory_bytes Resident memory size in bytes.",
+                      "# TYPE process_resident_memory_bytes gauge", "process_resident_memory_bytes " + str(rss_bytes())])
+        for name, help_str, read in self.probes:
+            lines.extend(["# HELP " + name + " " + help_str, "# TYPE " + name + " gauge", name + " " + str(read())])
+        return "\n".join(lines) + "\n"
+
+    # handle_request: Answer a single HTTP request with the current metrics
+    async def handle_request(self, reader, writer):
+        try:
+            # Read (and ignore) the request head; every path returns the metrics
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 5)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            body = self.render().encode()
+            writer.write(b"HTTP/1.0 200 OK\r\n"
+                         b"Content-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    # serve: Start the HTTP listener on the running event loop
+    # Arguments:
+    #   host, port: Address to bind; keep host local unless scraped remotely
+    async def serve(self, host, port):
+        return await asyncio.start_server(self.handle_request, host, port)
@@ -0,0 +1,97 @@
+# ttroy1, 2023
+# Stage minimap: stage outlines and player positions scaled to the panel
+
+# -----------------------------------------------------------------------------
+import struct
+
+# Binary position frames from index.js: message type, frame number, player
+# count, then the player index and x/y position (Melee units) of each player
+POSITIONS_HEADER = struct.Struct("<BiB")
+POSITIONS_ENTRY = struct.Struct("<Bff")
+POSITIONS_MESSAGE = 1
+
+# Stage geometry by Slippi stage ID, in Melee units: x of the main stage's
+# right edge (stages are symmetric about x = 0), and (left x, right x, y)
+# for each platform. Unknown stages are drawn as a plain flat stage.
+STAGES = {
+    2: {'edge': 63.35, 'platforms': [(-49.5, -21.0, 16.1), (21.0, 49.5, 22.6), (-14.25, 14.25, 42.75)]},  # Fountain of Dreams
+    3: {'edge': 87.75, 'platforms': [(-55.0, -25.0, 25.0), (25.0, 55.0, 25.0)]},  # Pokemon Stadium
+    8: {'edge': 56.0, 'platforms': [(-59.5, -28.0, 23.45), (28.0, 59.5, 23.45), (-15.75, 15.75, 42.0)]},  # Yoshi's Story
+    28: {'edge': 77.27, 'platforms': [(-61.39, -31.73, 30.14), (31.73, 61.39, 30.14), (-19.02, 19.02, 51.43)]},  # Dream Land
+    31: {'edge': 68.4, 'platforms': [(-57.6, -20.0, 27.2), (20.0, 57.6, 27.2), (-18.8, 18.8, 54.4)]},  # Battlefield
+    32: {'edge': 85.57, 'platforms': []},  # Final Destination
+}
+DEFAULT_STAGE = {'edge': 80.0, 'platforms': []}
+# Space shown around the stage: to the sides (as a multiple of the edge),
+# below the stage and above it, in Melee units
+SIDE_MARGIN = 1.45
+BELOW = 45.0
+ABOVE = 105.0
+
+# Dot colors by port, matching the in-game port colors
+PORT_COLORS = [(230, 40, 40), (60, 110, 255), (255, 200, 0), (40, 200, 70)]
+STAGE_COLOR = (150, 150, 150)
+PLATFORM_COLOR = (90, 90, 90)
+
+# -----------------------------------------------------------------------------
+# decode_positions: Read a binary position frame
+# Arguments:
+#   data: Bytes as sent by index.js
+# Returns:
+#   (frame number, [[player index, x, y], ...])
+def decode_positions(data):
+    message_type, frame, count = POSITIONS_HEADER.unpack_from(data, 0)
+    if message_type != POSITIONS_MESSAGE:
+        raise ValueError("Unknown binary message type " + str(message_type))
+    end = POSITIONS_HEADER.size + count * POSITIONS_ENTRY.size
+    positions = [list(entry) for entry in POSITIONS_ENTRY.iter_unpack(data[POSITIONS_HEADER.size:end])]
+    return frame, positions
+
+# -----------------------------------------------------------------------------
+class Minimap(object):
+    # Arguments:
+    #   box: (left, top, right, bottom) panel pixels the stage is drawn in
+    def __init__(self, box=(0, 11, 64, 57)):
+        self.box = box
+        self.set_stage(None)
+
+    # set_stage: Work out the scale for a stage; call once per game
+    # Arguments:
+    #   stage_id: Slippi stage ID (None or unknown for a generic stage)
+    def set_stage(self, stage_id):
+        self.stage = STAGES.get(stage_id, DEFAULT_STAGE)
+        left, top, right, bottom = self.box
+        half_width = self.stage['edge'] * SIDE_MARGIN
+        # One scale for both axes, so the stage keeps its shape
+        self.scale = min((right - left) / (2 * half_width), (bottom - top) / (BELOW + ABOVE))
+        self.center_x = (left + right) / 2.0
+        self.ground_y = bottom - BELOW * self.scale
+
+    # to_pixel: Panel pixel for a stage position, clamped to the minimap
+    def to_pixel(self, x, y):
+        left, top, right, bottom = self.box
+        pixel_x = int(round(self.center_x + x * self.scale))
+        pixel_y = int(round(self.ground_y - y * self.scale))
+        return (min(max(pixel_x, left + 1), right - 1), min(max(pixel_y, top + 1), bottom - 1))
+
+    # draw_stage: Draw the stage outline (for the game's background image)
+    def draw_stage(self, draw):
+        edge = self.stage['edge']
+        left_x, ground_y = self.to_pixel(-edge, 0)
+        right_x = self.to_pixel(edge, 0)[0]
+        # Main stage, with a short underside so it reads as solid ground
+        draw.line((left_x, ground_y + 1, right_x, ground_y + 1), fill=STAGE_COLOR)
+        draw.line((left_x + 2, ground_y + 2, right_x - 2, ground_y + 2), fill=PLATFORM_COLOR)
+        for platform_left, platform_right, platform_y in self.stage['platforms']:
+            x0, y = self.to_pixel(platform_left, platform_y)
+            x1 = self.to_pixel(platform_right, platform_y)[0]
+            draw.line((x0, y + 1, x1, y + 1), fill=PLATFORM_COLOR)
+
+    # draw_players: Draw a 2x2 dot per player, standing on its position
+    # Arguments:
+    #   draw: ImageDraw for the frame
+    #   positions: [[player index, x, y], ...] from decode_positions
+    def draw_players(self, draw, positions):
+        for index, x, y in positions:
+            pixel_x, pixel_y = self.to_pixel(x, y)
+            draw.rectangle((pixel_x - 1, pixel_y - 1, pixel_x, pixel_y), fill=PORT_COLORS[index % 4])
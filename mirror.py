@@ -0,0 +1,158 @@
+# ttroy1, 2023
+# Browser mirror: serves the frames sent to the LED panel to any number of
+# websocket clients (e.g. an OBS browser source), as a keyframe followed by
+# compressed deltas of the changed pixels
+
+# -----------------------------------------------------------------------------
+import asyncio
+import http
+import struct
+import threading
+import zlib
+
+import numpy as np
+import websockets
+
+# First byte of every message
+KEYFRAME = b"\x01"
+DELTA = b"\x02"
+# Delta run header: first pixel index, pixel count (both little-endian uint16)
+RUN = struct.Struct("<HH")
+VIEWER_PATH = "./assets/mirror/index.html"
+
+# -----------------------------------------------------------------------------
+# encode_delta: Changed pixels between two frames, as runs of consecutive pixels
+# Arguments:
+#   old, new: Frames as RGB bytes of the same size
+# Returns:
+#   Uncompressed payload: for each run, a RUN header then its RGB bytes
+def encode_delta(old, new):
+    old_pixels = np.frombuffer(old, np.uint8).reshape(-1, 3)
+    new_pixels = np.frombuffer(new, np.uint8).reshape(-1, 3)
+    changed = np.flatnonzero(np.any(old_pixels != new_pixels, axis=1))
+    if changed.size == 0:
+        return b""
+
+    # Split the changed indexes wherever they stop being consecutive
+    breaks = np.flatnonzero(np.diff(changed) != 1) + 1
+    starts = changed[np.concatenate(([0], breaks))]
+    ends = changed[np.concatenate((breaks - 1, [changed.size - 1]))] + 1
+    parts = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        parts.append(RUN.pack(start, end - start))
+        parts.append(new[start * 3:end * 3])
+    return b"".join(parts)
+
+# -----------------------------------------------------------------------------
+class FrameMirror(object):
+    # Arguments:
+    #   host, port: Address for the viewer page and its websocket
+    #   max_fps: Most frames sent to any one client per second
+    def __init__(self, host, port, max_fps=30):
+        self.host = host
+        self.port = port
+        self.min_interval = 1.0 / max_fps
+        # Latest frame as RGB bytes, and a counter bumped for every new one
+        self.frame = None
+        self.version = 0
+        # Latest frame published while no client was connected, for the next
+        # one to start from
+        self.idle_frame = None
+        # One wake-up event per connected client
+        self.clients = set()
+        # Deltas to the current version, by the version a client last received;
+        # clients that are in step share one encoding
+        self.deltas = {}
+        self.deltas_version = None
+        self.loop = None
+        with open(VIEWER_PATH, "rb") as f:
+            self.viewer = f.read()
+
+    # start: Serve from a thread of our own, so clients never hold up
+    # handle_connection or the render loop
+    def start(self):
+        ready = threading.Event()
+        threading.Thread(target=self.serve_forever, args=(ready,), name="meleetrix-mirror", daemon=True).start()
+        ready.wait()
+
+    def serve_forever(self, ready):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(websockets.serve(self.handle_client, self.host, self.port,
+                                                          process_request=self.serve_viewer))
+            print("Mirror viewer at http://" + self.host + ":" + str(self.port) + "/")
+        finally:
+            ready.set()
+        self.loop.run_forever()
+
+    # publish: Offer a new frame to the clients (render thread)
+    # Costs a copy of the frame, plus a wake-up while any client is connected
+    # Arguments:
+    #   image: The PIL image just sent to the panel
+    def publish(self, image):
+        if self.loop is None:
+            return
+        if not self.clients:
+            self.idle_frame = image.tobytes()
+            return
+        self.loop.call_soon_threadsafe(self.set_frame, image.tobytes())
+
+    def set_frame(self, frame):
+        self.idle_frame = None
+        self.frame = frame
+        self.version += 1
+        for wake in self.clients:
+            wake.set()
+
+    # encode: Message bringing a client from the frame it has to the current one
+    def encode(self, sent_version, sent):
+        if sent is None:
+            return KEYFRAME + zlib.compress(self.frame)
+
+        if self.deltas_version != self.version:
+            self.deltas = {}
+            self.deltas_version = self.version
+        message = self.deltas.get(sent_version)
+        if message is None:
+            payload = encode_delta(sent, self.frame)
+            # A full keyframe is smaller once most of the panel has changed
+            if len(payload) >= len(self.frame):
+                message = KEYFRAME + zlib.compress(self.frame)
+            else:
+                message = DELTA + zlib.compress(payload)
+            self.deltas[sent_version] = message
+        return message
+
+    # handle_client: Send one client every frame it can keep up with
+    async def handle_client(self, websocket, path):
+        wake = asyncio.Event()
+        self.clients.add(wake)
+        sent = None
+        sent_version = None
+        try:
+            # Start from the last frame drawn, even if nobody was watching it
+            idle_frame = self.idle_frame
+            if idle_frame is not None:
+                self.set_frame(idle_frame)
+            if self.frame is not None:
+                wake.set()
+            while True:
+                await wake.wait()
+                wake.clear()
+                # Only the newest frame is sent: a slow client skips whatever
+                # arrived while it was still receiving the last one
+                message = self.encode(sent_version, sent)
+                sent, sent_version = self.frame, self.version
+                await websocket.send(message)
+                await asyncio.sleep(self.min_interval)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.clients.discard(wake)
+
+    # serve_viewer: Answer plain HTTP requests with the viewer page
+    def serve_viewer(self, path, request_headers):
+        if request_headers.get("Upgrade", "").lower() == "websocket":
+            return None
+        return (http.HTTPStatus.OK, [("Content-Type", "text/html; charset=utf-8")], self.viewer)
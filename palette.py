@@ -0,0 +1,127 @@
+# ttroy1, 2023
+# Colour pipeline for Meleetrix: character/colour pairings and panel correction
+
+# -----------------------------------------------------------------------------
+import os
+import numpy as np
+from PIL import Image
+
+# Foreground used whenever no custom foreground applies
+DEFAULT_FG = (255, 255, 0)
+# Background used for disabled backgrounds and default/black costumes
+EMPTY_BG = (0, 0, 0)
+# Generic background colors, keyed by lowercase costume color name
+COSTUME_BGS = {
+    'red': (102, 0, 0),
+    'blue': (102, 102, 255),
+    'green': (0, 153, 56),
+    'white': (130, 130, 130),
+    'yellow': (117, 106, 45),
+    'purple': (37, 12, 46),
+    # Pikachu-specific
+    'party hat': (102, 102, 255),
+    'cowboy hat': (0, 153, 56),
+    # Puff-specific
+    'crown': (133, 103, 27),
+    'headband': (7, 125, 94),
+}
+# Offsets into the flattened (R, G, B) lookup table, one per channel
+CHANNEL_OFFSETS = np.array([0, 256, 512], dtype=np.uint16)
+
+# -----------------------------------------------------------------------------
+# build_lut: Create a flattened per-channel gamma/brightness lookup table
+# Arguments:
+#   gamma: A single exponent, or a list of three (R, G, B) exponents
+#   brightness: Scale applied after gamma (0.0 - 1.0)
+# Returns:
+#   A uint8 array of 768 values; R, G and B tables back to back
+def build_lut(gamma=1.0, brightness=1.0):
+    if isinstance(gamma, (int, float)):
+        gamma = [gamma, gamma, gamma]
+
+    levels = np.arange(256, dtype=np.float64) / 255.0
+    tables = [255.0 * brightness * np.power(levels, channel_gamma) for channel_gamma in gamma]
+    return np.clip(np.rint(np.concatenate(tables)), 0, 255).astype(np.uint8)
+
+# -----------------------------------------------------------------------------
+class Palette(object):
+    # Build the (character, color) table and the panel lookup table once at load
+    # Arguments:
+    #   color_config: The 'colors' section of config.json
+    #   icon_dir: Folder of <character>-<color>.png icons used to seed the table
+    def __init__(self, color_config, icon_dir="./assets/icons"):
+        self.backgrounds_active = color_config['backgrounds_active']
+        self.custom_backgrounds_active = color_config['custom_backgrounds_active']
+        self.custom_foregrounds_active = color_config['custom_foregrounds_active']
+        self.custom_char_bgs = color_config['custom_char_bgs']
+        self.custom_char_fgs = color_config['custom_char_fgs']
+
+        # Every character/color pairing that has an icon is resolved up front
+        self.table = {}
+        if os.path.isdir(icon_dir):
+            for filename in os.listdir(icon_dir):
+                if filename.endswith(".png") and "-" in filename:
+                    char_name, char_color = filename[:-4].split("-", 1)
+                    self.table[(char_name, char_color)] = self.resolve(char_color, char_name)
+
+        # Panel correction; skipped entirely when it would be a no-op
+        self.lut = build_lut(color_config.get('gamma', 1.0), color_config.get('brightness', 1.0))
+        self.identity = bool(np.array_equal(self.lut, np.tile(np.arange(256, dtype=np.uint8), 3)))
+
+    # resolve: Work out the foreground/background pairing for a character
+    # Arguments:
+    #   char_color: The name of the active color
+    #   char_name: The name of the active character
+    # Returns:
+    #   (fg, bg) tuple of RGB tuples
+    def resolve(self, char_color, char_name):
+        char_color = char_color.lower()
+        color_pairing = char_name.lower() + "-" + char_color
+
+        # First, check for a character/skin specific foreground color
+        if self.custom_foregrounds_active == True and color_pairing in self.custom_char_fgs:
+            fg = tuple(self.custom_char_fgs[color_pairing])
+        else:
+            fg = DEFAULT_FG
+
+        # Backgrounds disabled in general, or the char is using a default color
+        if self.backgrounds_active == False or char_color in ['default', 'black']:
+            bg = EMPTY_BG
+        # Then, check if the active character has a custom background color
+        elif self.custom_backgrounds_active == True and color_pairing in self.custom_char_bgs:
+            bg = tuple(self.custom_char_bgs[color_pairing])
+        # Otherwise, use the generic color (or none for colors without one)
+        else:
+            bg = COSTUME_BGS.get(char_color, EMPTY_BG)
+
+        return (fg, bg)
+
+    # lookup: Return the (fg, bg) pairing for a character, from the prebuilt table
+    # Arguments:
+    #   char_color: The name of the active color
+    #   char_name: The name of the active character
+    def lookup(self, char_color, char_name):
+        key = (char_name.lower(), char_color.lower())
+        try:
+            return self.table[key]
+        except KeyError:
+            # Pairings without an icon are resolved once, then kept
+            self.table[key] = self.resolve(char_color, char_name)
+            return self.table[key]
+
+    # correct: Apply the gamma/brightness table to an RGB frame
+    # Arguments:
+    #   frame: (height, width, 3) uint8 array
+    # Returns:
+    #   Corrected uint8 array of the same shape (the input itself if no-op)
+    def correct(self, frame):
+        if self.identity:
+            return frame
+        # One vectorized lookup: each channel indexes its own third of the table
+        return self.lut[frame + CHANNEL_OFFSETS]
+
+    # apply: Colour-correct a PIL image ready for SetImage
+    def apply(self, image):
+        if self.identity:
+            return image
+        return Image.fromarray(self.correct(np.asarray(image.convert("RGB"))))
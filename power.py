@@ -0,0 +1,92 @@
+# ttroy1, 2023
+# Per-frame current estimate for the panel, and brightness limiting to keep
+# frames within the power supply's budget
+
+# -----------------------------------------------------------------------------
+import time
+import numpy as np
+from PIL import Image
+
+# Bits rgbmatrix's CIE1931 mapping works in
+PWM_LEVELS = (1 << 11) - 1
+
+# -----------------------------------------------------------------------------
+# duty_table: Share of the time an LED is lit, by brightness and channel value
+# Returns:
+#   (101, 256) float array; row b is --led-brightness b, column the 8-bit value
+def duty_table():
+    lightness = np.arange(101, dtype=np.float64)[:, None] * np.arange(256, dtype=np.float64)[None, :] / 255.0
+    luminance = np.where(lightness <= 8, lightness / 902.3, ((lightness + 16) / 116.0) ** 3)
+    return np.rint(PWM_LEVELS * luminance) / PWM_LEVELS
+
+# -----------------------------------------------------------------------------
+class PowerLimiter(object):
+    # Arguments:
+    #   power_config: The 'power' section of config.json
+    def __init__(self, power_config):
+        self.volts = power_config.get('volts', 5.0)
+        self.idle_amps = power_config.get('idle_amps', 0.2)
+        self.budget_amps = power_config.get('budget_amps', 8.0)
+        self.idle_dim = power_config.get('idle_dim', 0.5)
+        self.log_interval = power_config.get('log_interval', 60)
+        # Every LED channel of a 64x64 panel fully on draws panel_max_amps
+        self.amps_per_channel = power_config.get('panel_max_amps', 4.0) / (64 * 64 * 3)
+        self.duty = duty_table()
+
+        # Latest estimate, and the running figures for the next log line
+        self.watts = 0.0
+        self.limited = 0
+        self.log_started = time.monotonic()
+        self.log_frames = 0
+        self.log_watts = 0.0
+        self.log_peak = 0.0
+
+    # limit: Estimate a frame's current and dim it if it's over budget
+    # Arguments:
+    #   frame: Colour-corrected frame about to be written to the canvas
+    #   brightness: --led-brightness the matrix runs at (1-100)
+    #   idle: True for idle screens, which are dimmed regardless
+    # Returns:
+    #   The frame to write (the same image if it needed no change)
+    def limit(self, frame, brightness, idle=False):
+        pixels = np.asarray(frame)
+        # A histogram of channel values is all the estimate needs, at every
+        # brightness at once
+        counts = np.bincount(pixels.reshape(-1), minlength=256)
+        amps = self.idle_amps + self.amps_per_channel * self.duty.dot(counts)
+
+        # Brightness the frame can be shown at: dimmed if idle, then the
+        # highest level that fits the budget
+        target = int(brightness * self.idle_dim) if idle else brightness
+        target = max(1, min(target, 100))
+        if amps[target] > self.budget_amps:
+            # Current only rises with brightness, so take the last level that fits
+            fits = np.flatnonzero(amps[1:target + 1] <= self.budget_amps)
+            target = int(fits[-1]) + 1 if len(fits) else 1
+        self.record(amps[target] * self.volts)
+
+        if target >= brightness:
+            return frame
+        if not idle:
+            self.limited += 1
+        # Brightness scales each value before the CIE mapping, so scaling the
+        # values has the same effect for this one frame
+        scaled = (pixels.astype(np.uint16) * target // brightness).astype(np.uint8)
+        return Image.fromarray(scaled, "RGB")
+
+    # record: Keep the estimate, and log the period's figures when it's due
+    def record(self, watts):
+        self.watts = watts
+        self.log_frames += 1
+        self.log_watts += watts
+        self.log_peak = max(self.log_peak, watts)
+        now = time.monotonic()
+        if self.log_interval and now - self.log_started >= self.log_interval:
+            print("Power: %.1f W mean, %.1f W peak (%.2f A at %.0f V) over %d frames; %d frame(s) dimmed to fit %.1f A"
+                  % (self.log_watts / self.log_frames, self.log_peak, self.log_peak / self.volts, self.volts,
+                     self.log_frames, self.limited, self.budget_amps))
+            self.log_started = now
+            self.log_frames = 0
+            self.log_watts = 0.0
+            self.log_peak = 0.0
+            self.limited = 0
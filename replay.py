@@ -0,0 +1,95 @@
+# ttroy1, 2023
+# Recording the slp-realtime message stream, and reading it back for export.py
+
+# -----------------------------------------------------------------------------
+import json
+import os
+import time
+
+from inputs import INPUTS_MESSAGE
+
+# Seconds the winner screen stays up after a gameEnd (see state_postgame)
+POSTGAME_SECONDS = 10
+
+# -----------------------------------------------------------------------------
+class SessionRecorder(object):
+    # Opens a new session file; one is created each time main.py starts
+    # Arguments:
+    #   directory: Folder the session files are written to
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, time.strftime("session-%Y%m%d-%H%M%S.jsonl"))
+        # Line buffered: a crash loses at most the message being written
+        self.file = open(self.path, "a", buffering=1)
+        print("Recording session to", self.path)
+
+    # write: Append one message, as received, with its arrival time
+    # Arguments:
+    #   message: Raw websocket message (str or bytes)
+    def write(self, message):
+        # Binary messages (position and input frames) are written as hex after a '#'
+        if isinstance(message, bytes):
+            message = "#" + message.hex()
+        # Time and message are tab separated; JSON messages never contain a raw tab
+        self.file.write("%.3f\t%s\n" % (time.time(), message))
+
+    def close(self):
+        self.file.close()
+
+# -----------------------------------------------------------------------------
+# message_type: Type of a recorded message; binary messages are position or
+# input frames
+def message_type(message):
+    if isinstance(message, bytes):
+        return "inputs" if message[0] == INPUTS_MESSAGE else "positions"
+    return message['messageType']
+
+# read_session: Load a recorded session
+# Arguments:
+#   path: Session file written by SessionRecorder
+# Returns:
+#   List of (seconds, message), where a message is a dict or, for position
+#   and input frames, bytes; anything main.py would skip is left out
+def read_session(path):
+    messages = []
+    with open(path) as f:
+        for line in f:
+            stamp, _, raw = line.rstrip("\n").partition("\t")
+            try:
+                if raw.startswith("#"):
+                    message = bytes.fromhex(raw[1:])
+                else:
+                    message = json.loads(raw)
+                    message['messageType']
+                messages.append((float(stamp), message))
+            except (ValueError, KeyError, TypeError):
+                continue
+    messages.sort(key=lambda item: item[0])
+    return messages
+
+# compress_idle: Shorten long gaps between games, keeping in-game time as is
+# Arguments:
+#   messages: List from read_session
+#   max_idle: Longest waiting screen to keep between games, in seconds
+# Returns:
+#   New list with timestamps shifted so that each idle stretch (after the
+#   winner screen) lasts at most max_idle seconds
+def compress_idle(messages, max_idle):
+    compressed = []
+    shift = 0.0
+    in_game = False
+    previous = None
+    for stamp, message in messages:
+        if previous is not None and not in_game:
+            idle = stamp - previous - POSTGAME_SECONDS
+            if idle > max_idle:
+                shift += idle - max_idle
+        compressed.append((stamp - shift, message))
+
+        kind = message_type(message)
+        if kind in ("gameStart", "snapshot"):
+            in_game = True
+        elif kind == "gameEnd":
+            in_game = False
+        previous = stamp
+    return compressed
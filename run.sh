@@ -1,5 +1,12 @@
 sudo pkill -f main.py
 sudo pkill -f index.js
-sudo python3 main.py --led-rows=64 --led-cols=64 --led-gpio-mapping='adafruit-hat' --led-slowdown-gpio=3 &
-sleep 2
+# Must match ready_file in config.json
+READY_FILE=/tmp/meleetrix.ready
+sudo rm -f $READY_FILE
+sudo python3 main.py --led-rows=64 --led-cols=64 --led-gpio-mapping='adafruit-hat' &
+# Start index.js as soon as main.py is accepting connections (10s at most)
+for i in $(seq 1 200); do
+    [ -f $READY_FILE ] && break
+    sleep 0.05
+done
 sudo nohup node index.js &
@@ -4,7 +4,6 @@ import sys
 import os
 
 sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/..'))
-from rgbmatrix import RGBMatrix, RGBMatrixOptions
 
 
 class SampleBase(object):
@@ -31,15 +30,32 @@ class SampleBase(object):
         self.parser.add_argument("--led-no-drop-privs", dest="drop_privileges", help="Don't drop privileges from 'root' after initializing the hardware.", action='store_false')
         self.parser.set_defaults(drop_privileges=True)
 
+    # set_matrix_defaults: Take defaults from config.json's matrix section
+    # (written by calibrate.py); arguments given on the command line still win
+    def set_matrix_defaults(self, matrix_config):
+        names = {'pwm_bits': 'led_pwm_bits', 'pwm_lsb_nanoseconds': 'led_pwm_lsb_nanoseconds',
+                 'slowdown_gpio': 'led_slowdown_gpio', 'brightness': 'led_brightness'}
+        self.parser.set_defaults(**{names[key]: value for key, value in matrix_config.items() if key in names})
+
     def usleep(self, value):
         time.sleep(value / 1000000.0)
 
     def run(self):
         print("Running")
 
+    # Called just before and after the matrix is created; rgbmatrix drops
+    # root while it's created (unless --led-no-drop-privs is given)
+    def before_matrix(self, options):
+        pass
+
+    def after_matrix(self):
+        pass
+
     def process(self):
         self.args = self.parser.parse_args()
 
+        # Imported here so importing this module stays cheap
+        from rgbmatrix import RGBMatrix, RGBMatrixOptions
         options = RGBMatrixOptions()
 
         if self.args.led_gpio_mapping != None:
@@ -68,7 +84,9 @@ class SampleBase(object):
         if not self.args.drop_privileges:
           options.drop_privileges=False
 
+        self.before_matrix(options)
         self.matrix = RGBMatrix(options = options)
+        self.after_matrix()
 
         try:
             # Start loop
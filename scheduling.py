@@ -0,0 +1,118 @@
+# ttroy1, 2023
+# Thread placement (CPU affinity and scheduling policy) for the render,
+# websocket and rgbmatrix refresh threads, and the refresh rate rgbmatrix
+# reports with --led-show-refresh
+
+# -----------------------------------------------------------------------------
+import collections
+import os
+import re
+import threading
+import time
+
+# Scheduling policies by config name; SCHED_FIFO/SCHED_RR need root
+POLICIES = {
+    "other": getattr(os, "SCHED_OTHER", 0),
+    "fifo": getattr(os, "SCHED_FIFO", 1),
+    "rr": getattr(os, "SCHED_RR", 2),
+}
+
+# rgbmatrix's refresh report: backspaces over the last value, then e.g. " 142.3Hz"
+REFRESH_PATTERN = re.compile(rb"\x08* *(\d+(?:\.\d+)?)Hz")
+# The start of a report cut off at the end of a read
+PARTIAL_PATTERN = re.compile(rb"\x08* *\d*(?:\.\d*)?\Z")
+
+# -----------------------------------------------------------------------------
+# thread_ids: Kernel thread IDs of every thread in this process
+def thread_ids():
+    try:
+        return set(int(tid) for tid in os.listdir("/proc/self/task"))
+    except OSError:
+        return set()
+
+# python_thread_ids: Kernel thread IDs of the threads Python started (3.8+;
+# empty on older versions, which don't expose them)
+def python_thread_ids():
+    return set(thread.native_id for thread in threading.enumerate() if getattr(thread, "native_id", None))
+
+# apply_policy: Pin a thread to CPUs and set its scheduling policy
+# Arguments:
+#   name: Thread's name, for messages
+#   settings: Dict from config: cpus (list of core numbers), policy ("other",
+#             "fifo" or "rr"), priority (1-99, fifo/rr only) and nice
+#   tid: Kernel thread ID; 0 for the calling thread
+# Returns:
+#   True if every setting was applied
+def apply_policy(name, settings, tid=0):
+    if not settings:
+        return True
+    try:
+        if settings.get('cpus'):
+            os.sched_setaffinity(tid, settings['cpus'])
+        policy = settings.get('policy')
+        if policy is not None:
+            priority = settings.get('priority', 1) if policy != "other" else 0
+            os.sched_setscheduler(tid, POLICIES[policy], os.sched_param(priority))
+        # On Linux, PRIO_PROCESS with a thread ID sets that thread alone
+        if 'nice' in settings:
+            os.setpriority(os.PRIO_PROCESS, tid, settings['nice'])
+    except (OSError, KeyError, AttributeError) as e:
+        # Usually EPERM: real-time policies need root, before rgbmatrix drops it
+        print("Couldn't apply scheduling to the", name, "thread:", repr(e))
+        return False
+    return True
+
+# -----------------------------------------------------------------------------
+class RefreshMonitor(object):
+    # Reads what rgbmatrix writes to stderr and keeps the refresh rates it
+    # reports; everything else is passed through to the real stderr
+    # Arguments:
+    #   window: Seconds of samples summarized by stats()
+    def __init__(self, window=10.0):
+        self.window = window
+        self.samples = collections.deque()
+        self.lock = threading.Lock()
+        self.stderr_fd = None
+
+    # start: Redirect fd 2 through the monitor; call before creating the matrix
+    def start(self):
+        read_fd, write_fd = os.pipe()
+        self.stderr_fd = os.dup(2)
+        os.dup2(write_fd, 2)
+        os.close(write_fd)
+        threading.Thread(target=self.read_loop, args=(read_fd,), name="meleetrix-refresh", daemon=True).start()
+
+    def read_loop(self, read_fd):
+        pending = b""
+        while True:
+            chunk = os.read(read_fd, 4096)
+            if not chunk:
+                break
+            pending += chunk
+            now = time.monotonic()
+            with self.lock:
+                for match in REFRESH_PATTERN.finditer(pending):
+                    self.samples.append((now, float(match.group(1))))
+                while self.samples and self.samples[0][0] < now - self.window:
+                    self.samples.popleft()
+            # Pass the rest through, holding back a report cut off mid-way
+            rest = REFRESH_PATTERN.sub(b"", pending)
+            cut = PARTIAL_PATTERN.search(rest).start()
+            passthrough, pending = rest[:cut], rest[cut:]
+            if passthrough:
+                os.write(self.stderr_fd, passthrough)
+
+    # stats: Refresh rate over the last window
+    # Returns:
+    #   (mean, min, max) in Hz, or None if rgbmatrix hasn't reported yet
+    def stats(self):
+        with self.lock:
+            rates = [rate for stamp, rate in self.samples]
+        if not rates:
+            return None
+        return (sum(rates) / len(rates), min(rates), max(rates))
+
+    # latest: Most recent refresh rate, or 0 before the first report
+    def latest(self):
+        with self.lock:
+            return self.samples[-1][1] if self.samples else 0.0
@@ -0,0 +1,110 @@
+# ttroy1, 2023
+# Settle window for percent and stock updates: on netplay, rollback can make
+# slp-realtime report a change that is corrected a few frames later, so each
+# update is held until it has gone a few game frames without being replaced
+
+# -----------------------------------------------------------------------------
+# Melee runs at 60 frames a second
+FRAMES_PER_SECOND = 60.0
+# Message types held, and the field each one sets
+SETTLED_FIELDS = {"playerPercent": "percent", "countChange": "stocksRemaining"}
+
+class SettleWindow(object):
+    # Arguments:
+    #   frames: Game frames an update must go unreplaced before it's applied
+    def __init__(self, frames):
+        self.frames = frames
+        # Updates that replaced one still held, leaving the screen as it was
+        self.reverted = 0
+        self.reset()
+
+    # reset: Drop everything held (a new game started)
+    # Arguments:
+    #   players: The gameStart message's players, who start on 0% with
+    #            their starting stocks
+    def reset(self, players=()):
+        # (playerIndex, messageType) -> (frame, message)
+        self.pending = {}
+        # Last value applied for each key, to spot a change that was undone
+        self.shown = {}
+        for player in players:
+            self.shown[(player['playerIndex'], "playerPercent")] = 0
+            self.shown[(player['playerIndex'], "countChange")] = player.get('startStocks', 4)
+        # Latest game frame seen, and when, for estimating the current one
+        self.latest_frame = None
+        self.latest_at = 0.0
+
+    # seed: Record values applied without going through the window, e.g. the
+    # per-player percents and stocks of a snapshot
+    # Arguments:
+    #   players: Dicts with playerIndex, percent and stocksRemaining
+    #   frame: Game frame the values are from; anything held from before it
+    #          is already included, so it's dropped
+    def seed(self, players, frame=None):
+        if frame is not None:
+            for key in [key for key, (held_frame, message) in self.pending.items() if held_frame <= frame]:
+                del self.pending[key]
+        for player in players:
+            self.shown[(player['playerIndex'], "playerPercent")] = player['percent']
+            self.shown[(player['playerIndex'], "countChange")] = player['stocksRemaining']
+
+    # note_frame: Record the game frame a message was sent on
+    # Arguments:
+    #   frame: Game frame number
+    #   now: Monotonic time it arrived
+    def note_frame(self, frame, now):
+        if self.latest_frame is None or frame >= self.current_frame(now):
+            self.latest_frame = frame
+            self.latest_at = now
+
+    # current_frame: Estimate of the game frame being played now; frames
+    # keep coming at 60 a second between the messages that report them
+    def current_frame(self, now):
+        if self.latest_frame is None:
+            return None
+        return self.latest_frame + (now - self.latest_at) * FRAMES_PER_SECOND
+
+    # hold: Hold an update, replacing any held for the same player and type
+    # Arguments:
+    #   message: playerPercent or countChange message with a frame field
+    #   now: Monotonic time it arrived
+    def hold(self, message, now):
+        self.note_frame(message['frame'], now)
+        key = (message['playerIndex'], message['messageType'])
+        value = message[SETTLED_FIELDS[message['messageType']]]
+        if key in self.pending and self.shown.get(key) == value:
+            # Put back the way it was before the screen ever saw it
+            del self.pending[key]
+            self.reverted += 1
+            return
+        self.pending[key] = (message['frame'], message)
+
+    # due: Take the updates whose window has passed, oldest frame first
+    # Arguments:
+    #   now: Monotonic time
+    def due(self, now):
+        current = self.current_frame(now)
+        if current is None:
+            return []
+        ready = [key for key, (frame, message) in self.pending.items() if frame + self.frames <= current]
+        return self.take(ready)
+
+    # flush: Take every held update, oldest frame first (the game ended)
+    def flush(self):
+        return self.take(list(self.pending))
+
+    def take(self, keys):
+        held = sorted((self.pending.pop(key) for key in keys), key=lambda entry: entry[0])
+        for frame, message in held:
+            self.shown[(message['playerIndex'], message['messageType'])] = message[SETTLED_FIELDS[message['messageType']]]
+        # Without their frame: wherever they're passed on to (fan-out nodes)
+        # applies them as they are, rather than holding them a second time
+        return [{key: value for key, value in message.items() if key != 'frame'} for frame, message in held]
+
+    # next_due: Seconds until the next held update can be applied, or None
+    def next_due(self, now):
+        current = self.current_frame(now)
+        if not self.pending or current is None:
+            return None
+        first = min(frame for frame, message in self.pending.values())
+        return max(0.0, (first + self.frames - current) / FRAMES_PER_SECOND)
@@ -0,0 +1,88 @@
+# ttroy1, 2023
+# Game state shared between the ingest and render processes
+
+# -----------------------------------------------------------------------------
+import json
+import struct
+import time
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python 3.7 and older
+    shared_memory = None
+
+# Header: sequence number (odd while a write is in progress), then payload
+# length; written separately, so the sequence number can go last
+SEQ = struct.Struct("<Q")
+LENGTH = struct.Struct("<I")
+HEADER_SIZE = SEQ.size + LENGTH.size
+# Room for the JSON encoded state, which is around 1 KB for four players
+DEFAULT_SIZE = 64 * 1024
+
+# -----------------------------------------------------------------------------
+class SharedState(object):
+    # Create the shared block; do this before forking the ingest process,
+    # which then uses the inherited object directly
+    # Arguments:
+    #   size: Bytes to reserve, header included
+    def __init__(self, size=DEFAULT_SIZE):
+        if shared_memory is None:
+            raise RuntimeError("Separate ingest/render processes need Python 3.8 or newer")
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.buf = self.shm.buf
+        self.capacity = size - HEADER_SIZE
+        SEQ.pack_into(self.buf, 0, 0)
+        LENGTH.pack_into(self.buf, SEQ.size, 0)
+        # Writer-side copy of the sequence number
+        self.seq = 0
+
+    # publish: Write a new state (writer side only)
+    # Arguments:
+    #   state: JSON-serializable dict
+    def publish(self, state):
+        payload = json.dumps(state, separators=(',', ':')).encode()
+        if len(payload) > self.capacity:
+            print("Shared state too large to publish:", len(payload), "bytes")
+            return
+
+        # Odd sequence number: readers retry rather than use a torn copy.
+        # The even one is written last, once the length and payload are in.
+        # Each field is packed first and copied in: pack_into straight into
+        # the block briefly leaves it zero, which a reader could take for a
+        # finished write
+        self.seq += 1
+        self.buf[0:SEQ.size] = SEQ.pack(self.seq)
+        self.buf[HEADER_SIZE:HEADER_SIZE + len(payload)] = payload
+        self.buf[SEQ.size:HEADER_SIZE] = LENGTH.pack(len(payload))
+        self.seq += 1
+        self.buf[0:SEQ.size] = SEQ.pack(self.seq)
+
+    # read: Fetch the state if it has changed (reader side)
+    # Arguments:
+    #   last_seq: Sequence number of the last state the reader applied
+    # Returns:
+    #   (seq, state dict), or None if nothing new (or the writer is mid-update)
+    def read(self, last_seq):
+        for attempt in range(3):
+            seq = SEQ.unpack_from(self.buf, 0)[0]
+            if seq == last_seq:
+                return None
+            if seq & 1:
+                # Writer is part way through; give it a moment
+                time.sleep(0)
+                continue
+            length = min(LENGTH.unpack_from(self.buf, SEQ.size)[0], self.capacity)
+            payload = bytes(self.buf[HEADER_SIZE:HEADER_SIZE + length])
+            # Only trust the length and payload if no write started while
+            # either was being read
+            if SEQ.unpack_from(self.buf, 0)[0] == seq:
+                return (seq, json.loads(payload.decode()))
+        return None
+
+    # close: Release the block (call unlink=True from the creating process)
+    def close(self, unlink=False):
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
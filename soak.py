@@ -0,0 +1,275 @@
+# ttroy1, 2023
+# Soak test: replays thousands of synthetic games through the message handlers
+# and the render path on a headless matrix, and fails if memory or open file
+# handles keep growing
+#
+# Usage:
+#   python soak.py --games 5000
+
+# -----------------------------------------------------------------------------
+import argparse
+import asyncio
+import contextlib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Players per game, weighted towards singles like real sessions
+PLAYER_COUNTS = [2, 2, 2, 3, 4]
+STAGES = [(2, "Fountain of Dreams"), (3, "Pokemon Stadium"), (8, "Yoshi's Story"),
+          (28, "Dream Land N64"), (31, "Battlefield"), (32, "Final Destination")]
+
+# -----------------------------------------------------------------------------
+class HeadlessCanvas(object):
+    # Stands in for an rgbmatrix canvas; keeps nothing but the last image size
+    def __init__(self):
+        self.size = None
+
+    def SetImage(self, image, x=0, y=0, unsafe=True):
+        self.size = image.size
+
+    def SetPixel(self, x, y, r, g, b):
+        pass
+
+    def Clear(self):
+        pass
+
+class HeadlessMatrix(HeadlessCanvas):
+    # Double buffered like RGBMatrix: SwapOnVSync hands back the old front canvas
+    def __init__(self):
+        HeadlessCanvas.__init__(self)
+        self.front = HeadlessCanvas()
+        self.back = HeadlessCanvas()
+
+    def CreateFrameCanvas(self):
+        return self.back
+
+    def SwapOnVSync(self, canvas, framerate_fraction=1):
+        self.front, canvas = canvas, self.front
+        return canvas
+
+# -----------------------------------------------------------------------------
+class ScriptedSocket(object):
+    # Feeds a list of messages to handle_connection, then closes
+    def __init__(self, messages, closed):
+        self.messages = messages
+        self.closed = closed
+        self.position = 0
+
+    async def recv(self):
+        if self.position >= len(self.messages):
+            raise self.closed(None, None)
+        self.position += 1
+        return self.messages[self.position - 1]
+
+# -----------------------------------------------------------------------------
+# icon_pairs: (character, color) pairs that have icons, as slp-realtime names them
+def icon_pairs(icon_dir="./assets/icons"):
+    pairs = []
+    for name in sorted(os.listdir(icon_dir)):
+        if name.endswith(".png"):
+            character, _, color = name[:-4].rpartition("-")
+            pairs.append((character.title(), color.title()))
+    return pairs
+
+# synthetic_game: Messages for one random game, as index.js would send them
+# Arguments:
+#   rng: random.Random
+#   pairs: From icon_pairs
+# Returns:
+#   List of lists of JSON strings; the render path runs between each batch
+def synthetic_game(rng, pairs):
+    import json
+    count = rng.choice(PLAYER_COUNTS)
+    stage_id, stage_name = rng.choice(STAGES)
+    players = []
+    for index in range(count):
+        character, color = rng.choice(pairs)
+        players.append({"playerIndex": index, "nametag": rng.choice(["", "MANG", "ARMD", "HBOX"]),
+                        "displayName": rng.choice(["", "Player " + str(index + 1), "Some Much Longer Name"]),
+                        "startStocks": 4, "CharacterColorName": color,
+                        "characterInfo": {"name": character, "shortName": character}})
+    batches = [[json.dumps({"messageType": "gameStart", "isTeams": count == 4 and rng.random() < 0.5,
+                            "stageId": stage_id, "stageInfo": {"name": stage_name}, "players": players})]]
+
+    stocks = [4] * count
+    percents = [0] * count
+    while sum(1 for s in stocks if s > 0) > 1:
+        batch = []
+        for hit in range(rng.randint(1, 4)):
+            index = rng.randrange(count)
+            if stocks[index] == 0:
+                continue
+            percents[index] += rng.randint(1, 25)
+            batch.append(json.dumps({"messageType": "playerPercent", "playerIndex": index, "percent": percents[index]}))
+            if percents[index] > 130:
+                stocks[index] -= 1
+                percents[index] = 0
+                batch.append(json.dumps({"messageType": "countChange", "playerIndex": index, "stocksRemaining": stocks[index]}))
+        # Now and then, something index.js would never send
+        if rng.random() < 0.02:
+            batch.append(rng.choice(["", "{", "[]", '{"messageType": "playerPercent"}']))
+        batches.append(batch)
+
+    winner = max(range(count), key=lambda index: stocks[index])
+    batches.append([json.dumps({"messageType": "gameEnd", "gameEndMethod": 2, "winnerPlayerIndex": winner})])
+    return batches
+
+# -----------------------------------------------------------------------------
+# open_fds: Number of file descriptors this process has open
+def open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+# keeps_growing: True if a series ends clearly above where it settled
+# Arguments:
+#   values: Samples taken after warm-up
+#   tolerance: Growth allowed between the first and last third
+def keeps_growing(values, tolerance):
+    third = max(1, len(values) // 3)
+    return min(values[-third:]) - max(values[:third]) > tolerance
+
+# take_snapshot: Traced allocations, less tracemalloc's own (the snapshots
+# the soak keeps would otherwise show up as growth)
+def take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+# -----------------------------------------------------------------------------
+# play_game: Run one game through handle_connection and the render states
+# Arguments:
+#   game: The Meleetrix instance handle_connection updates
+#   canvas: Canvas to draw the next frame to
+#   loop: Event loop to run handle_connection on
+#   batches: From synthetic_game
+#   played: Games played so far, for the waiting screen's animation step
+#   closed: websockets.ConnectionClosed, raised when a batch runs out
+# Returns:
+#   The canvas to draw the next frame to
+def play_game(game, canvas, loop, batches, played, closed):
+    import main
+    for batch in batches:
+        loop.run_until_complete(main.WebsocketConn.handle_connection(ScriptedSocket(batch, closed), "/"))
+        # One pass of the render loop's states, minus the sleeps
+        if game.game_active:
+            canvas = game.state_game_active(canvas)
+        elif game.player_count != 0 and not game.postgame:
+            game.state_start_game()
+            canvas = game.state_game_active(canvas)
+    if game.postgame:
+        game.draw_postgame()
+        canvas = game.push_frame(canvas, game.image)
+        game.end_postgame()
+    game.draw_waiting(played % 4, game.last_result_str())
+    canvas = game.push_frame(canvas, game.image)
+
+    return canvas
+
+# -----------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Replay synthetic games through Meleetrix on a headless matrix and check for leaks.")
+    parser.add_argument("--games", type=int, default=2000, help="Games to play. Default: 2000")
+    parser.add_argument("--sample-every", type=int, default=50, help="Games between samples. Default: 50")
+    parser.add_argument("--warmup", type=int, default=200, help="Games played before the baseline is taken. Default: 200")
+    parser.add_argument("--rss-tolerance", type=float, default=4.0, help="RSS growth allowed, in MB. Default: 4")
+    parser.add_argument("--heap-tolerance", type=float, default=1.0, help="Traced Python heap growth allowed, in MB. Default: 1")
+    parser.add_argument("--fd-tolerance", type=int, default=0, help="Open file handle growth allowed. Default: 0")
+    parser.add_argument("--top", type=int, default=3, help="Top allocators shown at each sample. Default: 3")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed, so a failing run can be repeated")
+    args = parser.parse_args()
+
+    # main.py loads config.json and its assets relative to the repo
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import main
+    import websockets
+    from metrics import rss_bytes
+    # Normally imported by start_server, which the soak doesn't run
+    main.websockets = websockets
+
+    game = main.game_obj
+    history_dir = tempfile.mkdtemp(prefix="meleetrix-soak-")
+    # A scratch history database, no recording, and no network listeners
+    game.config = dict(game.config, history=dict(game.config.get('history', {}), active=True,
+                                                 db_path=os.path.join(history_dir, "history.db")),
+                       recording={'active': False}, mirror={'active': False})
+    game.matrix = HeadlessMatrix()
+    game.load_assets()
+    # No frame pacing; the soak runs as fast as it can
+    game.frame_interval = 0
+    game.seen_splash = True
+
+    rng = random.Random(args.seed)
+    pairs = icon_pairs()
+    canvas = game.matrix.CreateFrameCanvas()
+    loop = asyncio.new_event_loop()
+    # main.py prints on every connection; only the soak's own report is shown
+    quiet = open(os.devnull, "w")
+    samples = []
+    baseline_snapshot = None
+    # Snapshot at the last sample, and how many intervals each allocation
+    # site (file:line) has grown in
+    previous_snapshot = None
+    grew_in = {}
+    began = time.perf_counter()
+    print("%8s %10s %10s %6s %8s" % ("games", "rss MB", "heap MB", "fds", "frames"))
+
+    for played in range(1, args.games + 1):
+        with contextlib.redirect_stdout(quiet):
+            canvas = play_game(game, canvas, loop, synthetic_game(rng, pairs), played, websockets.ConnectionClosed)
+
+        if played == args.warmup:
+            tracemalloc.start()
+            baseline_snapshot = take_snapshot()
+        if played >= args.warmup and played % args.sample_every == 0:
+            heap = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+            samples.append((played, rss_bytes() / 1e6, heap / 1e6, open_fds()))
+            print("%8d %10.1f %10.2f %6d %8d" % (samples[-1] + (game.metrics.frames.total(),)))
+
+            # Top allocators over this interval alone, so growth that starts
+            # late isn't averaged away by the whole run
+            snapshot = take_snapshot()
+            changes = snapshot.compare_to(previous_snapshot or baseline_snapshot, "lineno")
+            for stat in changes:
+                if stat.size_diff > 0:
+                    site = str(stat.traceback)
+                    grew_in[site] = grew_in.get(site, 0) + 1
+            for stat in changes[:args.top]:
+                print("         " + str(stat))
+            previous_snapshot = snapshot
+
+    elapsed = time.perf_counter() - began
+    print("Played %d games in %.0f s" % (args.games, elapsed))
+    if game.history is not None:
+        game.history.close()
+    shutil.rmtree(history_dir, ignore_errors=True)
+    if len(samples) < 3:
+        print("Not enough samples after warm-up to judge growth")
+        return 0
+
+    failures = []
+    if keeps_growing([s[1] for s in samples], args.rss_tolerance):
+        failures.append("RSS")
+    if keeps_growing([s[2] for s in samples], args.heap_tolerance):
+        failures.append("traced heap")
+    if keeps_growing([s[3] for s in samples], args.fd_tolerance):
+        failures.append("open file handles")
+
+    print("Top allocators since warm-up:")
+    for stat in take_snapshot().compare_to(baseline_snapshot, "lineno")[:10]:
+        print("  " + str(stat))
+    # A site that grew in every interval is the likeliest leak
+    steady = sorted(site for site, count in grew_in.items() if count == len(samples))
+    if steady:
+        print("Grew in every interval:")
+        for site in steady:
+            print("  " + site)
+    if failures:
+        print("FAIL: " + ", ".join(failures) + " kept growing")
+        return 1
+    print("OK: memory and file handles stayed flat")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+# ttroy1, 2023
+# Percent-over-time sparklines: a fixed-size ring buffer of percents per
+# player, drawn as a small bar chart tile
+
+# -----------------------------------------------------------------------------
+import numpy as np
+from PIL import Image
+
+class Sparkline(object):
+    # Arguments:
+    #   width: Columns in the tile; also how many percents are kept
+    #   height: Rows in the tile
+    #   full_scale: Percent drawn at full height (higher percents are clipped)
+    def __init__(self, width, height, full_scale=150.0):
+        self.width = width
+        self.height = height
+        self.full_scale = float(full_scale)
+        # Preallocated once; a game of any length never grows them
+        self.values = np.zeros(width, dtype=np.float32)
+        self.head = 0
+        self.count = 0
+        self.row_index = np.arange(height, dtype=np.int16)[:, None]
+        self.pixels = np.zeros((height, width, 3), dtype=np.uint8)
+        # Rebuilt on the next draw after the values change
+        self.tile = None
+
+    # add: Record a new percent
+    def add(self, percent):
+        self.values[self.head] = percent
+        self.head = (self.head + 1) % self.width
+        self.count = min(self.count + 1, self.width)
+        self.tile = None
+
+    # reset: Forget every percent (a stock was lost, so percent starts over)
+    def reset(self):
+        self.head = 0
+        self.count = 0
+        self.tile = None
+
+    # recent: The recorded percents, oldest first
+    def recent(self):
+        return np.roll(self.values, -self.head)[self.width - self.count:].tolist()
+
+    # load: Replace every percent, e.g. with another process's recent()
+    # Arguments:
+    #   percents: Percents, oldest first; only the last width are kept
+    def load(self, percents):
+        percents = percents[len(percents) - min(len(percents), self.width):]
+        self.count = len(percents)
+        self.values[:self.count] = percents
+        self.head = self.count % self.width
+        self.tile = None
+
+    # image: The sparkline as a (width x height) tile, newest percent on the right
+    # Arguments:
+    #   fg, bg: Bar and background colors
+    def image(self, fg, bg):
+        if self.tile is None:
+            # Oldest first, right-aligned; empty columns stay at height 0
+            ordered = np.roll(self.values, -self.head)
+            heights = np.zeros(self.width, dtype=np.int16)
+            if self.count:
+                scaled = np.rint(ordered[self.width - self.count:] * (self.height / self.full_scale))
+                # Any damage at all shows as at least one pixel
+                heights[self.width - self.count:] = np.clip(scaled, ordered[self.width - self.count:] > 0, self.height)
+            # Every column at once: a pixel is lit if it's within its column's bar
+            lit = self.row_index >= (self.height - heights)[None, :]
+            self.pixels[:] = bg
+            self.pixels[lit] = fg
+            self.tile = Image.fromarray(self.pixels, "RGB")
+        return self.tile
@@ -0,0 +1,52 @@
+# ttroy1, 2023
+# Startup phase timing and the readiness signal run.sh waits on
+
+# -----------------------------------------------------------------------------
+import os
+import socket
+import threading
+import time
+
+class PhaseTimer(object):
+    # Starts timing as soon as it's created; create it before the heavy imports
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+        self.lock = threading.Lock()
+
+    # mark: Record (and print) that a startup phase has finished
+    # Arguments:
+    #   phase: Short name of the phase, e.g. "imports"
+    def mark(self, phase):
+        with self.lock:
+            elapsed = time.perf_counter() - self.start
+            self.phases.append((phase, elapsed))
+        print("Startup: %-12s %6.0f ms" % (phase, elapsed * 1000))
+
+# -----------------------------------------------------------------------------
+# notify_ready: Tell the launcher that the websocket server is accepting connections
+# Arguments:
+#   ready_file: Path of the file run.sh polls for (skipped if empty)
+def notify_ready(ready_file):
+    if ready_file:
+        with open(ready_file, "w") as f:
+            f.write(str(os.getpid()) + "\n")
+
+    # Also support running as a systemd Type=notify service
+    notify_socket = os.environ.get("NOTIFY_SOCKET")
+    if notify_socket:
+        # Abstract namespace sockets are given with a leading '@'
+        if notify_socket.startswith("@"):
+            notify_socket = "\0" + notify_socket[1:]
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(b"READY=1", notify_socket)
+        except OSError as e:
+            print("sd_notify failed:", e)
+        finally:
+            sock.close()
+
+# clear_ready: Remove a stale ready file left by an earlier run
+def clear_ready(ready_file):
+    if ready_file and os.path.exists(ready_file):
+        os.remove(ready_file)
@@ -1,2 +1,3 @@
 sudo pkill -f main.py
 sudo pkill -f index.js
+sudo rm -f /tmp/meleetrix.ready
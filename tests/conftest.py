@@ -0,0 +1,9 @@
+# ttroy1, 2023
+# Tests import the modules from the repository root, as main.py does
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# main.py loads config.json and the fonts relative to the working directory
+os.chdir(ROOT)
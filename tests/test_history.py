@@ -0,0 +1,36 @@
+# ttroy1, 2023
+# Match history: head-to-head records from the SQLite store
+
+from history import MatchHistory
+
+# match: A finished 1v1 for MatchHistory.record
+def match(winner_port, player_0, player_1):
+    players = []
+    for port, (nametag, character) in enumerate((player_0, player_1)):
+        players.append({'port': port, 'nametag': nametag, 'display_name': None, 'character': character,
+                        'color': "Default", 'stocks': 1 if port == winner_port else 0, 'percent': "0%"})
+    return {'started_at': 0.0, 'ended_at': 1.0, 'stage': "Battlefield", 'is_teams': False,
+            'winner_port': winner_port, 'end_method': 2, 'timeline': [], 'players': players}
+
+def record_all(tmp_path, matches):
+    history = MatchHistory(str(tmp_path / "history.db"), flush_interval=0.01)
+    for finished in matches:
+        history.record(finished)
+    # Flushes the queue and stops the writer
+    history.close()
+    return history
+
+def test_head_to_head_counts_each_game_once(tmp_path):
+    history = record_all(tmp_path, [match(0, ("AAA", "Fox"), ("BBB", "Falco")),
+                                    match(0, ("AAA", "Fox"), ("BBB", "Falco")),
+                                    match(0, ("BBB", "Falco"), ("AAA", "Fox"))])
+    assert history.head_to_head("AAA", "BBB") == (2, 1)
+    assert history.head_to_head("BBB", "AAA") == (1, 2)
+
+def test_mirror_match_with_the_same_name(tmp_path):
+    # Two unnamed Fox players share a key; their games can't be split by player
+    history = record_all(tmp_path, [match(0, (None, "Fox"), (None, "Fox")),
+                                    match(1, (None, "Fox"), (None, "Fox"))])
+    assert history.head_to_head("Fox", "Fox") is None
+    # A mirror match doesn't add to anyone else's record either
+    assert history.head_to_head("Fox", "Falco") == (0, 0)
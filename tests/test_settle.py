@@ -0,0 +1,40 @@
+# ttroy1, 2023
+# Settle window: held percent/stock updates
+
+from settle import SettleWindow
+
+PLAYERS = [{'playerIndex': 0, 'startStocks': 4}, {'playerIndex': 1, 'startStocks': 4}]
+
+def percent(index, value, frame):
+    return {'messageType': "playerPercent", 'playerIndex': index, 'percent': value, 'frame': frame}
+
+def test_released_updates_have_no_frame():
+    window = SettleWindow(6)
+    window.reset(PLAYERS)
+    window.hold(percent(0, 12.0, 100), 0.0)
+    assert window.due(0.0) == []
+    # A second later the game is well past frame 106
+    assert window.due(1.0) == [{'messageType': "playerPercent", 'playerIndex': 0, 'percent': 12.0}]
+
+def test_flushed_updates_have_no_frame():
+    window = SettleWindow(6)
+    window.reset(PLAYERS)
+    window.hold(percent(1, 30.0, 200), 0.0)
+    assert [message.get('frame') for message in window.flush()] == [None]
+
+def test_undone_update_is_never_released():
+    window = SettleWindow(6)
+    window.reset(PLAYERS)
+    window.hold(percent(0, 12.0, 100), 0.0)
+    window.hold(percent(0, 0, 102), 0.0)
+    assert window.due(1.0) == []
+    assert window.reverted == 1
+
+def test_seed_drops_updates_the_snapshot_includes():
+    window = SettleWindow(6)
+    window.reset(PLAYERS)
+    window.hold(percent(0, 12.0, 100), 0.0)
+    window.hold(percent(1, 8.0, 130), 0.0)
+    window.seed([{'playerIndex': 0, 'percent': 12.0, 'stocksRemaining': 4},
+                 {'playerIndex': 1, 'percent': 0, 'stocksRemaining': 4}], 120)
+    assert [message['playerIndex'] for message in window.flush()] == [1]
@@ -0,0 +1,152 @@
+# ttroy1, 2023
+# Shared state: games driven through separate ingest and render processes
+
+import multiprocessing
+import time
+
+import main
+from inputs import INPUTS_HEADER, INPUTS_ENTRY, INPUTS_MESSAGE
+from sharedstate import SharedState
+
+# game_start: A 2P gameStart as index.js sends it
+def game_start():
+    characters = [("Fox", "Green"), ("Falco", "Purple")]
+    return {'messageType': "gameStart", 'isTeams': False, 'stageId': 32, 'stageInfo': {'name': "Final Destination"},
+            'players': [{'playerIndex': index, 'nametag': "TAG" + str(index), 'displayName': "Player " + str(index),
+                         'CharacterColorName': color, 'characterInfo': {'name': name, 'shortName': name}}
+                        for index, (name, color) in enumerate(characters)]}
+
+# make_game: A Meleetrix with history (and sparklines or the input display) on
+def make_game(db_path, inputs):
+    game = main.Meleetrix()
+    game.sparkline_active = True
+    game.config['history'] = {'active': True, 'db_path': db_path, 'flush_interval': 0.01}
+    game.config['inputs'] = {'active': inputs}
+    game.load_assets()
+    return game
+
+# run_ingest: Ingest process body; applies each batch of messages it's sent,
+# then acknowledges it once the resulting state is published
+def run_ingest(shared_state, conn, db_path, inputs):
+    ingest = make_game(db_path, inputs)
+    ingest.share_state(shared_state)
+    while True:
+        messages = conn.recv()
+        if messages is None:
+            break
+        for message in messages:
+            for applied in ingest.apply_message(message):
+                for listener in ingest.state_listeners:
+                    listener(applied)
+        conn.send(True)
+    # Commits the finished game, which publishes again
+    ingest.history.close()
+    conn.send(True)
+
+class Processes(object):
+    # Render side in this process, ingest in a forked one, as main.py runs them
+    def __init__(self, tmp_path, inputs=False):
+        db_path = str(tmp_path / "history.db")
+        self.shared_state = SharedState()
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.ingest = multiprocessing.get_context("fork").Process(target=run_ingest, daemon=True,
+                                                                  args=(self.shared_state, child_conn, db_path, inputs))
+        self.ingest.start()
+        self.render = make_game(db_path, inputs)
+        self.render.state_reader = self.shared_state
+        self.finished = False
+
+    # send: Have the ingest process apply messages (None: finish up), then
+    # pick up what it published
+    def send(self, messages):
+        self.finished = messages is None
+        self.conn.send(messages)
+        assert self.conn.poll(10)
+        self.conn.recv()
+        self.render.poll_shared_state()
+
+    def close(self):
+        if not self.finished:
+            self.conn.send(None)
+        self.ingest.join(10)
+        self.render.history.close()
+        self.shared_state.close(unlink=True)
+
+def test_one_game_across_processes(tmp_path):
+    processes = Processes(tmp_path)
+    render = processes.render
+    try:
+        processes.send([game_start()])
+        assert render.player_count == 2
+        assert render.state_changed.is_set()
+        assert sorted(render.sparklines) == [0, 1]
+
+        processes.send([{'messageType': "playerPercent", 'playerIndex': 0, 'percent': 12.0},
+                        {'messageType': "playerPercent", 'playerIndex': 0, 'percent': 30.0}])
+        assert render.p1_perc == "30%"
+        assert render.sparklines[0].recent() == [12.0, 30.0]
+        assert render.sparklines[1].recent() == []
+
+        processes.send([{'messageType': "countChange", 'playerIndex': 1, 'stocksRemaining': 0},
+                        {'messageType': "gameEnd", 'gameEndMethod': 2, 'winnerPlayerIndex': 0}])
+        assert render.postgame
+        render.end_postgame()
+        # Published after the render process finished the game's postgame
+        processes.send([{'messageType': "clock", 'frame': 3600}])
+        assert render.player_count == 0
+        assert not render.postgame
+
+        processes.send(None)
+        assert render.last_result_str() == "TAG0 1-0 TAG1"
+    finally:
+        processes.close()
+
+def test_inputs_reach_the_render_process(tmp_path):
+    processes = Processes(tmp_path, inputs=True)
+    render = processes.render
+    try:
+        processes.send([game_start()])
+        frame = INPUTS_HEADER.pack(INPUTS_MESSAGE, 120, 2) + INPUTS_ENTRY.pack(0, 0x0100, 127, 0, 0, -127, 255, 0) + \
+            INPUTS_ENTRY.pack(1, 0, 0, 0, 0, 0, 0, 0)
+        processes.send([frame])
+        assert render.frame == 120
+        assert render.inputs == {0: (0x0100, 127, 0, 0, -127, 255, 0), 1: (0, 0, 0, 0, 0, 0, 0)}
+        assert render.sparklines == {}
+    finally:
+        processes.close()
+
+# publish_many: Writer process body; states of varying length, each of which
+# can be checked on its own
+def publish_many(shared_state, count):
+    for number in range(1, count + 1):
+        shared_state.publish({'number': number, 'padding': "x" * (number * 37 % 2000), 'check': number * 7})
+
+def test_reader_racing_the_writer():
+    shared_state = SharedState()
+    writer = multiprocessing.get_context("fork").Process(target=publish_many, args=(shared_state, 20000), daemon=True)
+    try:
+        writer.start()
+        last_seq = 0
+        last_number = 0
+        reads = 0
+        while True:
+            # Checked before reading, so the last state is read after it exits
+            writing = writer.is_alive()
+            update = shared_state.read(last_seq)
+            if update is None:
+                if not writing:
+                    break
+                time.sleep(0)
+                continue
+            last_seq, state = update
+            # Whole, and never older than the last one read
+            assert state['check'] == state['number'] * 7
+            assert len(state['padding']) == state['number'] * 37 % 2000
+            assert state['number'] > last_number
+            last_number = state['number']
+            reads += 1
+        writer.join(10)
+        assert last_number == 20000
+        assert reads > 1
+    finally:
+        shared_state.close(unlink=True)
@@ -0,0 +1,42 @@
+# ttroy1, 2023
+# Snapshots from index.js: a reconnect mid-game, or a different game
+
+import main
+
+def game_start(seed):
+    characters = [("Fox", "Green"), ("Falco", "Purple")]
+    return {'messageType': "gameStart", 'isTeams': False, 'stageId': 32, 'randomSeed': seed,
+            'stageInfo': {'name': "Final Destination"},
+            'players': [{'playerIndex': index, 'nametag': "", 'displayName': "", 'CharacterColorName': color,
+                         'characterInfo': {'name': name, 'shortName': name}}
+                        for index, (name, color) in enumerate(characters)]}
+
+def snapshot(seed, percents, frame):
+    return {'messageType': "snapshot", 'gameStart': game_start(seed), 'frame': frame,
+            'players': [{'playerIndex': index, 'percent': percent, 'stocksRemaining': 4}
+                        for index, percent in enumerate(percents)]}
+
+def make_game():
+    game = main.Meleetrix()
+    game.sparkline_active = True
+    game.load_assets()
+    game.apply_message(game_start(1234))
+    for percent in (10.0, 20.0):
+        game.apply_message({'messageType': "playerPercent", 'playerIndex': 0, 'percent': percent})
+    return game
+
+def test_snapshot_of_the_same_game_keeps_its_history():
+    game = make_game()
+    game_seq = game.game_seq
+    game.apply_message(snapshot(1234, [35.0, 0], 900))
+    assert game.game_seq == game_seq
+    assert game.p1_perc == "35%"
+    assert game.sparklines[0].recent() == [10.0, 20.0, 35.0]
+    assert game.sparklines[1].recent() == []
+
+def test_snapshot_of_another_game_starts_over():
+    game = make_game()
+    game_seq = game.game_seq
+    game.apply_message(snapshot(5678, [35.0, 0], 900))
+    assert game.game_seq == game_seq + 1
+    assert game.sparklines[0].recent() == [35.0]